@@ -0,0 +1,159 @@
+"""
+Hub-side aggregation of the status events published by the robots
+"""
+
+import logging
+import math
+
+from common import StatusEvent, StatusEventType
+from metrics import Histogram, RingBuffer
+
+# number of recent samples kept per metric
+HISTORY = 1024
+# window the throughput is computed over (seconds)
+THROUGHPUT_WINDOW = 300.0
+# highest delivery rate the throughput is counted exactly at (deliveries per second), which sizes its ring buffers
+MAX_DELIVERY_RATE = 100.0
+# orders and trips still not dropped off this long after their deadline or acceptance are given up on (seconds)
+EXPIRY = 3600.0
+
+
+class StatusAggregator:
+    """
+    Rolling fleet metrics computed from robot status events
+
+    Every metric lives in a fixed-size ring buffer, so memory use stays constant however long the hub runs; the
+    deliveries are kept for a whole throughput window at up to max_rate deliveries a second. Orders and trips
+    that are never dropped off (a robot that went away) are forgotten after expiry, the orders counting as
+    deadline misses.
+    Times are on the hub clock (seconds, the clock the order deadlines are expressed in), except cycle times
+    which are measured on the clock of the robot that served the trip.
+
+    Robots periodically publish their cumulative time-in-state, event latency and control loop histograms; the
+    latest ones of every robot are kept and merged into fleet-wide histograms on demand.
+    """
+
+    def __init__(
+        self,
+        history: int = HISTORY,
+        window: float = THROUGHPUT_WINDOW,
+        max_rate: float = MAX_DELIVERY_RATE,
+        expiry: float = EXPIRY,
+    ):
+        self.window = window
+        self.expiry = expiry
+        # hub time of every delivered order / package
+        deliveries = max(history, math.ceil(window * max_rate))
+        self.order_deliveries = RingBuffer(deliveries)
+        self.package_deliveries = RingBuffer(deliveries)
+        # robot time from accepting a trip to dropping it off
+        self.cycle_times = RingBuffer(history)
+        # 1.0 for a successful pick or missed deadline, 0.0 otherwise
+        self.picks = RingBuffer(history)
+        self.deadline_misses = RingBuffer(history)
+
+        # deadlines of the orders currently out with a robot
+        self.deadlines: dict[str, int] = {}
+        # robot time each trip was accepted at, and hub time the acceptance was received at
+        self.accepted: dict[str, tuple[float, float]] = {}
+        # hub time of the next check for orders and trips to expire
+        self._next_expiry = 0.0
+        # last known state of every robot
+        self.robot_states: dict[str, str] = {}
+        # latest exported time-in-state / event latency histograms of every robot
+        self.robot_dwell: dict[str, dict[str, dict]] = {}
+        self.robot_latency: dict[str, dict[str, dict]] = {}
+        self.robot_loops: dict[str, dict[str, dict]] = {}
+        # seconds each recent trip spent in every state, from one dropoff to the next
+        self.trip_time_in_state: dict[str, RingBuffer] = {}
+        self.history = history
+        self.events_received = 0
+
+    def expect(self, order_id: str, deadline: int):
+        """Register the deadline of an order that was dispatched"""
+        self.deadlines[order_id] = deadline
+
+    def record(self, event: StatusEvent, now: float):
+        """Account for a status event received at the given hub time"""
+        self.events_received += 1
+        self._expire(now)
+        match event["type"]:
+            case StatusEventType.ORDER_ACCEPTED:
+                self.accepted[event["order_id"]] = (event["timestamp"], now)
+            case StatusEventType.PACKAGE_PICKED:
+                self.picks.append(1.0)
+            case StatusEventType.PACKAGE_FAILED:
+                self.picks.append(0.0)
+            case StatusEventType.DROPOFF:
+                accepted = self.accepted.pop(event["order_id"], None)
+                if accepted is not None:
+                    self.cycle_times.append(event["timestamp"] - accepted[0])
+                for state, seconds in event.get("time_in_state", {}).items():
+                    if state not in self.trip_time_in_state:
+                        self.trip_time_in_state[state] = RingBuffer(self.history)
+                    self.trip_time_in_state[state].append(seconds)
+                for package in event["packages"]:
+                    self.package_deliveries.append(now)
+                # packages are tagged with their order when the hub batched several orders into the trip
+                orders = {package.get("order_id", event["order_id"]) for package in event["packages"] + event["failed"]}
+                for order_id in orders:
+                    self.order_deliveries.append(now)
+                    deadline = self.deadlines.pop(order_id, None)
+                    if deadline is not None:
+                        self.deadline_misses.append(1.0 if now > deadline else 0.0)
+            case StatusEventType.STATE_TRANSITION:
+                self.robot_states[event["robot"]] = event["to_state"]
+            case StatusEventType.STATE_DWELL:
+                self.robot_dwell[event["robot"]] = event["dwell"]
+                self.robot_latency[event["robot"]] = event.get("latency", {})
+                self.robot_loops[event["robot"]] = event.get("loops", {})
+
+    def _expire(self, now: float):
+        """Forget the orders and trips that outlived the expiry, checking at most once per throughput window"""
+        if now < self._next_expiry:
+            return
+        self._next_expiry = now + self.window
+        for order_id, deadline in list(self.deadlines.items()):
+            if now - deadline > self.expiry:
+                del self.deadlines[order_id]
+                self.deadline_misses.append(1.0)
+        self.accepted = {
+            order_id: times for order_id, times in self.accepted.items() if now - times[1] <= self.expiry
+        }
+
+    @staticmethod
+    def _merge(exports: dict[str, dict[str, dict]]) -> dict[str, dict]:
+        """Summaries of the histograms of all robots, merged by name, skipping those that cannot be merged"""
+        merged: dict[str, Histogram] = {}
+        for robot, histograms in exports.items():
+            for name, data in histograms.items():
+                try:
+                    histogram = Histogram.from_export(data)
+                    if name in merged:
+                        merged[name].merge(histogram)
+                    else:
+                        merged[name] = histogram
+                except ValueError as e:
+                    logging.warning(f"skipping histogram {name} of robot {robot}: {e}")
+        return {name: histogram.summary() for name, histogram in merged.items()}
+
+    def snapshot(self, now: float) -> dict:
+        """Current values of all metrics"""
+        self._expire(now)
+        since = now - self.window
+        return {
+            "events_received": self.events_received,
+            "orders_per_hour": self.order_deliveries.count_since(since) * 3600 / self.window,
+            "packages_per_hour": self.package_deliveries.count_since(since) * 3600 / self.window,
+            "cycle_time_mean": self.cycle_times.mean(),
+            "cycle_time_p50": self.cycle_times.percentile(50),
+            "cycle_time_p95": self.cycle_times.percentile(95),
+            "pick_success_rate": self.picks.mean(),
+            "deadline_miss_rate": self.deadline_misses.mean(),
+            "orders_out": len(self.deadlines),
+            "robot_states": dict(self.robot_states),
+            "time_in_state": self._merge(self.robot_dwell),
+            "trip_time_in_state": {state: times.mean() for state, times in self.trip_time_in_state.items()},
+            "event_latency": self._merge(self.robot_latency),
+            "control_loops": self._merge(self.robot_loops),
+        }
@@ -0,0 +1,77 @@
+"""
+Aisle-aware order batching for the hub
+
+Combines queued orders that can be picked on the same trip into a single tour for one robot.
+"""
+
+from typing import Callable
+
+from common import TIME_PER_ORDER, TIME_PER_PACKAGE, OrderData
+from order_book import OrderBook
+
+# how many of the most urgent queued orders are considered for a batch
+BATCH_WINDOW = 32
+# most packages a robot is given on a single trip
+MAX_BATCH_PACKAGES = 6
+
+
+def estimate_service_time(num_packages: int) -> int:
+    """Rough time for a robot to pick and deliver the given number of packages on one trip"""
+    return TIME_PER_ORDER + TIME_PER_PACKAGE * num_packages
+
+
+def build_trip(
+    primary: OrderData,
+    book: OrderBook,
+    now: float,
+    window: int = BATCH_WINDOW,
+    max_packages: int = MAX_BATCH_PACKAGES,
+    estimate: Callable[[int], float] = estimate_service_time,
+) -> tuple[OrderData, list[OrderData]]:
+    """Build a single trip around an order popped from the book
+
+    Queued orders are added to the trip, most urgent first, if they only touch aisles up to the furthest
+    aisle the trip already visits (so the robot travels no further down the line) and if every order on the
+    trip still makes its deadline with the extra packages. Merged orders are removed from the book.
+
+    :param primary: order the trip is built for, already removed from the book
+    :param book: queued orders to draw from
+    :param now: current time on the same clock as the order deadlines
+    :param window: number of queued orders to consider
+    :param max_packages: capacity of the robot for one trip
+    :param estimate: service time of a trip with the given number of packages
+    :return: merged order whose packages are tagged with the id of the order they belong to,
+        and the original orders it was built from
+    """
+    members = [primary]
+    num_packages = len(primary["packages"])
+    deadline = primary["deadline"]
+    furthest_aisle = max(package["aisle"] for package in primary["packages"])
+
+    if now + estimate(num_packages) <= deadline:
+        for candidate in book.most_urgent(window):
+            if num_packages >= max_packages:
+                break
+            total = num_packages + len(candidate["packages"])
+            finish = now + estimate(total)
+            if (
+                total <= max_packages
+                and finish <= min(deadline, candidate["deadline"])
+                and all(package["aisle"] <= furthest_aisle for package in candidate["packages"])
+            ):
+                book.cancel(candidate["id"])
+                members.append(candidate)
+                num_packages = total
+                deadline = min(deadline, candidate["deadline"])
+
+    trip: OrderData = {
+        "id": primary["id"] if len(members) == 1 else "+".join(order["id"] for order in members),
+        "deadline": deadline,
+        "packages": [
+            {"color": package["color"], "aisle": package["aisle"], "order_id": order["id"]}
+            for order in members
+            for package in order["packages"]
+        ],
+        "orders": [order["id"] for order in members],
+    }
+    return trip, members
@@ -0,0 +1,102 @@
+"""
+Color detection pipeline benchmark
+
+Feeds frames through color_detect.run, the per-frame image processing of the camera process, while it looks for
+packages of every color. Frames are rendered by the simulated camera of hal.py as the robot drives down an aisle,
+or read from a directory of recorded frames. Reports the time and CPU time per frame and the frame rate the pipeline sustains,
+for the fast path (color_detect.find_packages_fast) and the original whole-frame processing, along with the
+number of frames in which each path saw a centered package of each color, which should agree.
+"""
+
+import argparse
+import atexit
+import glob
+import logging
+import math
+import os
+import sys
+import tempfile
+import time
+
+# synthetic frames come from the simulator, which gets a world of its own
+os.environ.setdefault("DELIVERPI_HAL", "sim")
+if "DELIVERPI_SIM_STATE" not in os.environ:
+    os.environ["DELIVERPI_SIM_STATE"] = os.path.join(tempfile.gettempdir(), f"deliverpi_bench_{os.getpid()}")
+    atexit.register(lambda path: os.path.exists(path) and os.remove(path), os.environ["DELIVERPI_SIM_STATE"])
+
+import cv2  # noqa: E402
+import numpy as np  # noqa: E402
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import color_detect  # noqa: E402
+import hal  # noqa: E402
+
+# camera servo position color_detect.start turns the camera to
+PICKING_PAN = 3000
+
+
+def synthetic_frames(count: int, aisle: int = 0) -> list[np.ndarray]:
+    """Frames seen while driving down an aisle with the camera turned towards the shelves"""
+    world = hal.SimWorld.get()
+    camera = hal.SimCamera()
+    track = world.track
+    x = track.layout.position(aisle) * hal.TRACK_SCALE
+    length = track.layout.aisle_length * hal.TRACK_SCALE
+    world.set_pan(PICKING_PAN)
+    frames = []
+    for i in range(count):
+        world.place(x, length * i / count, math.pi / 2)
+        frames.append(camera.render())
+    return frames
+
+
+def recorded_frames(directory: str) -> list[np.ndarray]:
+    paths = sorted(glob.glob(os.path.join(directory, "*.png")) + glob.glob(os.path.join(directory, "*.jpg")))
+    return [cv2.imread(path) for path in paths]
+
+
+def run(frames: list[np.ndarray], colors: tuple[str, ...] = color_detect.PACKAGE_COLORS, repeat: int = 3, fast: bool = True) -> dict:
+    color_detect.lab_data, _ = hal.load_config()
+    color_detect.setTargetColor(colors)
+    color_detect.FAST_PATH = fast
+    color_detect.__isRunning = True
+    best = best_cpu = float("inf")
+    for _ in range(repeat):
+        centered = dict.fromkeys(colors, 0)
+        start, start_cpu = time.perf_counter(), time.process_time()
+        for frame in frames:
+            # keep looking rather than stopping at the first package found
+            color_detect.start_pick_up = False
+            color_detect.run(frame)
+            height, width = frame.shape[:2]
+            for color in {c.color for c in color_detect.candidates if color_detect.is_centered(c, width, height)}:
+                centered[color] += 1
+        best = min(best, time.perf_counter() - start)
+        best_cpu = min(best_cpu, time.process_time() - start_cpu)
+    color_detect.__isRunning = False
+    color_detect.FAST_PATH = True
+    return {
+        "fast": fast,
+        "ms_per_frame": best / len(frames) * 1000,
+        "cpu_ms_per_frame": best_cpu / len(frames) * 1000,
+        "frames_per_sec": len(frames) / best,
+        "centered": centered,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--frames", type=int, default=100, help="number of synthetic frames")
+    parser.add_argument("--recorded", help="directory of recorded frames (.png/.jpg) to use instead")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    frames = recorded_frames(args.recorded) if args.recorded else synthetic_frames(args.frames)
+    for fast in (False, True):
+        result = run(frames, repeat=args.repeat, fast=fast)
+        print(
+            f"{'fast' if fast else 'full'}: {result['ms_per_frame']:6.2f} ms/frame "
+            f"{result['cpu_ms_per_frame']:6.2f} ms CPU/frame {result['frames_per_sec']:8.1f} frames/s, centered "
+            + " ".join(f"{color} {count}" for color, count in result["centered"].items())
+        )
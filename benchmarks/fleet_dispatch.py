@@ -0,0 +1,95 @@
+"""
+Fleet dispatch benchmark for the hub
+
+Starts a HubThread, fills it with orders from a PUB socket standing in for the central server, then lets
+a growing number of simulated robots (plain REQ sockets, like the controller's) request orders as fast as
+they can. Reports the ingest rate, and dispatch latency percentiles and orders/sec for each fleet size.
+"""
+
+import argparse
+import logging
+import os
+import statistics
+import sys
+import threading
+import time
+
+import zmq
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from hub import HubThread  # noqa: E402
+
+BASE_PORT = 18000
+
+
+def robot(ctx: zmq.Context, hub_port: int, name: str, quota: int, latencies: list[float]):
+    sock = ctx.socket(zmq.REQ)
+    sock.identity = name.encode()
+    sock.connect(f"tcp://localhost:{hub_port}")
+    for _ in range(quota):
+        start = time.perf_counter()
+        sock.send(b"")
+        sock.recv()
+        latencies.append(time.perf_counter() - start)
+    sock.close()
+
+
+def run(fleet_size: int, orders: int, port: int = BASE_PORT) -> dict:
+    # fresh ports for every run so lingering connections of the previous hub never interfere
+    server_port, hub_port = port, port + 1
+    hub = HubThread("localhost", server_port, hub_port)
+    hub.start()
+    ctx = zmq.Context()
+    server = ctx.socket(zmq.PUB)
+    server.bind(f"tcp://*:{server_port}")
+    time.sleep(0.5)  # slow joiner
+    # every order goes further down the line than the ones before it, so the hub never batches them
+    # and each request is answered with exactly one order
+    start = time.perf_counter()
+    for i in range(orders):
+        server.send_json({"deadline": i, "packages": [{"color": "RED", "aisle": i}]})
+    while len(hub.orders) < orders:
+        time.sleep(0.001)
+    ingest = time.perf_counter() - start
+
+    latencies: list[float] = []
+    quota = orders // fleet_size
+    threads = [
+        threading.Thread(target=robot, args=(ctx, hub_port, f"robot-{i}", quota, latencies))
+        for i in range(fleet_size)
+    ]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    hub.stop()
+    hub.join()
+    server.close()
+    hub.ctx.destroy(linger=0)
+    ctx.destroy(linger=0)
+
+    latencies.sort()
+    return {
+        "robots": fleet_size,
+        "ingest_per_sec": orders / ingest,
+        "orders_per_sec": len(latencies) / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--orders", type=int, default=5000)
+    parser.add_argument("--fleet", type=int, nargs="+", default=[1, 5, 10, 25, 50])
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    for i, size in enumerate(args.fleet):
+        result = run(size, args.orders, BASE_PORT + 2 * i)
+        print(
+            f"{result['robots']:>3} robots: {result['ingest_per_sec']:8.0f} orders/s in, {result['orders_per_sec']:8.0f} orders/s out, "
+            f"p50 {result['p50_ms']:.2f} ms, p99 {result['p99_ms']:.2f} ms"
+        )
@@ -0,0 +1,117 @@
+"""
+Line tracking benchmark
+
+Drives the simulated robot of hal.py around a stadium shaped loop (two straights joined by half circles) with
+each tracker of line_tracking.py, at increasing speeds, once in each direction. The simulation runs on a virtual
+clock advanced by the tracker's control period, so a lap takes a fraction of its real duration. Reports the lap
+time, the number of times all four sensors lost the line and whether the lap was finished. As on the robot, the
+tracker steers by the readings of line_filter.LineFilter, and a lap is abandoned when the filter declares the line
+lost (the line follower would stop to search for it) or the robot strays too far from the line.
+"""
+
+import argparse
+import math
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import hal  # noqa: E402
+from line_filter import LineFilter  # noqa: E402
+from line_tracking import PidTracker, TableTracker, Tracker  # noqa: E402
+
+STRAIGHT = 150.0
+RADIUS = 50.0
+# segments approximating each half circle
+ARC_SEGMENTS = 36
+# distance from the line (cm) at which the robot is considered off the track
+OFF_TRACK = 20.0
+MAX_LAP_TIME = 120.0
+SPEEDS = (20, 30, 45, 60, 80)
+
+
+class LoopTrack(hal.SimTrack):
+    """Closed stadium shaped line, centered on the origin, with nothing else on it"""
+
+    def __init__(self, straight: float = STRAIGHT, radius: float = RADIUS):
+        half = straight / 2
+        points = []
+        for center, start in ((half, -math.pi / 2), (-half, math.pi / 2)):
+            for i in range(ARC_SEGMENTS + 1):
+                angle = start + math.pi * i / ARC_SEGMENTS
+                points.append((center + radius * math.cos(angle), radius * math.sin(angle)))
+        points.append(points[0])
+        self.segments = np.array([(*a, *b) for a, b in zip(points, points[1:])])
+        self.blocks = []
+        self.start = (0.0, -radius, 0.0)
+
+    def distance(self, x: float, y: float) -> float:
+        """Distance from a point to the line"""
+        start = self.segments[:, :2]
+        direction = self.segments[:, 2:] - start
+        t = np.clip(((np.array((x, y)) - start) * direction).sum(axis=1) / (direction**2).sum(axis=1), 0.0, 1.0)
+        return float(np.sqrt((((x, y) - (start + t[:, None] * direction)) ** 2).sum(axis=1)).min())
+
+
+def lap(tracker: Tracker, track: LoopTrack, clockwise: bool = False) -> dict:
+    now = 0.0
+    with tempfile.NamedTemporaryFile(prefix="deliverpi_lap_") as state:
+        world = hal.SimWorld(state.name, track, clock=lambda: now)
+        line_filter = LineFilter(clock=lambda: now)
+        chassis, sensors = hal.SimChassis(world), hal.SimLineSensor(world)
+        x, y, heading = track.start
+        world.place(x, y, math.pi if clockwise else heading)
+        progress, angle = 0.0, math.atan2(y, x)
+        losses, seen, finished = 0, True, False
+        while now < MAX_LAP_TIME:
+            reading = sensors.readData()
+            if any(reading):
+                seen = True
+            elif seen:
+                losses += 1
+                seen = False
+            filtered = line_filter.update(reading)
+            if filtered.line_lost:
+                break
+            steering = tracker.update(filtered.sensors)
+            if steering is not None:
+                chassis.set_velocity(steering.speed, 90, steering.yaw)
+            now += tracker.period
+            x, y, _ = world.pose()
+            if track.distance(x, y) > OFF_TRACK:
+                break
+            new_angle = math.atan2(y, x)
+            progress += math.remainder(new_angle - angle, math.tau)
+            angle = new_angle
+            if abs(progress) >= math.tau:
+                finished = True
+                break
+    return {"finished": finished, "lap_time": now, "losses": losses}
+
+
+def run(make_tracker, speed: float) -> dict:
+    """Laps in both directions with a fresh tracker each"""
+    laps = [lap(make_tracker(speed), LoopTrack(), clockwise) for clockwise in (False, True)]
+    return {
+        "speed": speed,
+        "finished": all(result["finished"] for result in laps),
+        "lap_time": sum(result["lap_time"] for result in laps) / len(laps),
+        "losses": sum(result["losses"] for result in laps),
+    }
+
+
+TRACKERS = {"table": TableTracker, "pid": PidTracker}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--speeds", type=float, nargs="+", default=SPEEDS)
+    parser.add_argument("--tracker", choices=list(TRACKERS), nargs="+", default=list(TRACKERS))
+    args = parser.parse_args()
+    for name in args.tracker:
+        for speed in args.speeds:
+            result = run(TRACKERS[name], speed)
+            lap_time = f"{result['lap_time']:6.1f} s" if result["finished"] else "   DNF  "
+            print(f"{name:>5} speed {speed:4.0f}: lap {lap_time} {result['losses']:3d} line losses")
@@ -0,0 +1,190 @@
+"""
+Line sensor noise benchmark
+
+Adds hallucinated black to the readings of the simulated line sensor (every white sample turns black with some
+probability) and compares steering on the raw readings with steering on the readings of line_filter.LineFilter:
+    laps of the loop track of line_following.py with the PID tracker: phantom intersections seen (the loop has
+    none), line losses declared and whether the lap was finished
+    driving off the end of a straight line: time from the line really leaving the array to its loss being
+    detected, by the original one second rule on the raw readings (LegacyLossRule) or by the filter
+Runs on a virtual clock like line_following.py.
+"""
+
+import argparse
+import math
+import os
+import random
+import sys
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import hal  # noqa: E402
+from line_filter import LineFilter  # noqa: E402
+from line_following import OFF_TRACK, LoopTrack  # noqa: E402
+from line_tracking import SEARCH_YAW, PidTracker, TableTracker, at_intersection  # noqa: E402
+
+NOISE = (0.0, 0.01, 0.03, 0.1)
+SPEEDS = (20, 30, 45)
+LAP_SPEED = 45
+MAX_TIME = 60.0
+STRAIGHT_LENGTH = 100.0
+# time without seeing the line before the original rule declared it lost (s)
+LEGACY_LOSS_TIME = 1.0
+
+
+class StraightTrack(hal.SimTrack):
+    """A single straight line along +x, ending STRAIGHT_LENGTH from the origin"""
+
+    def __init__(self):
+        self.segments = np.array([(0.0, 0.0, STRAIGHT_LENGTH, 0.0)])
+        self.blocks = []
+        self.start = (10.0, 0.0, 0.0)
+
+
+class NoisyLineSensor(hal.SimLineSensor):
+    def __init__(self, world: hal.SimWorld, noise: float, rng: random.Random):
+        super().__init__(world)
+        self.noise = noise
+        self.rng = rng
+
+    def readData(self) -> list[bool]:
+        return [black or self.rng.random() < self.noise for black in super().readData()]
+
+
+class LegacyLossRule:
+    """The line loss rule of the trackers before the line filter: lost after a second of raw readings without
+    the line
+    """
+
+    def __init__(self, period: float):
+        self.period = period
+        self.unseen = 0.0
+
+    def update(self, raw: list[bool]) -> bool:
+        """Whether the line is declared lost with this reading"""
+        if any(raw):
+            self.unseen = 0.0
+            return False
+        self.unseen += self.period
+        if self.unseen >= LEGACY_LOSS_TIME:
+            self.unseen = 0.0
+            return True
+        return False
+
+
+class Drive:
+    """The simulated robot on a track, driven on a virtual clock"""
+
+    def __init__(self, track: hal.SimTrack, noise: float, seed: int, pose: tuple[float, float, float] | None = None):
+        self.now = 0.0
+        self._state = tempfile.NamedTemporaryFile(prefix="deliverpi_noise_")
+        self.world = hal.SimWorld(self._state.name, track, clock=lambda: self.now)
+        self.world.place(*(pose or track.start))
+        self.chassis = hal.SimChassis(self.world)
+        self.clean = hal.SimLineSensor(self.world)
+        self.sensor = NoisyLineSensor(self.world, noise, random.Random(seed))
+
+    def close(self):
+        self._state.close()
+
+
+def lap(noise: float, filtered: bool, seed: int = 0) -> dict:
+    drive = Drive(LoopTrack(), noise, seed)
+    tracker = PidTracker(LAP_SPEED)
+    line_filter = LineFilter(clock=lambda: drive.now)
+    legacy = LegacyLossRule(tracker.period)
+    track = drive.world.track
+    x, y, _ = track.start
+    progress, angle = 0.0, math.atan2(y, x)
+    phantoms = losses = 0
+    intersection = lost = finished = False
+    while drive.now < MAX_TIME:
+        raw = drive.sensor.readData()
+        if filtered:
+            reading = line_filter.update(raw)
+            sensors = reading.sensors
+            if reading.line_lost and not lost:
+                losses += 1
+            lost = reading.line_lost
+        else:
+            sensors = raw
+            if legacy.update(raw):
+                losses += 1
+                drive.chassis.set_velocity(0, 90, SEARCH_YAW)
+                tracker.reset()
+        # the loop has no intersection: every one seen is a phantom, which the robot would stop at
+        if at_intersection(sensors) and not intersection:
+            phantoms += 1
+        intersection = at_intersection(sensors)
+        if lost:
+            drive.chassis.set_velocity(0, 90, line_filter.search_yaw())
+            tracker.reset()
+        elif not intersection:
+            steering = tracker.update(sensors)
+            if steering is not None:
+                drive.chassis.set_velocity(steering.speed, 90, steering.yaw)
+        drive.now += tracker.period
+        x, y, _ = drive.world.pose()
+        if track.distance(x, y) > OFF_TRACK:
+            break
+        new_angle = math.atan2(y, x)
+        progress += math.remainder(new_angle - angle, math.tau)
+        angle = new_angle
+        if abs(progress) >= math.tau:
+            finished = True
+            break
+    drive.close()
+    return {"noise": noise, "filtered": filtered, "phantom_intersections": phantoms, "losses": losses, "finished": finished}
+
+
+def loss_latency(speed: float, noise: float, filtered: bool, seed: int = 0) -> float | None:
+    """Time from the line leaving the array at the end of a straight line to the loss being detected (s)"""
+    drive = Drive(StraightTrack(), noise, seed)
+    tracker = TableTracker(speed)
+    line_filter = LineFilter(clock=lambda: drive.now)
+    legacy = LegacyLossRule(tracker.period)
+    left = None
+    while drive.now < MAX_TIME:
+        raw = drive.sensor.readData()
+        if left is None and not any(drive.clean.readData()):
+            left = drive.now
+        if filtered:
+            reading = line_filter.update(raw)
+            detected = reading.line_lost
+            sensors = reading.sensors
+        else:
+            sensors = raw
+            detected = legacy.update(raw)
+        if detected:
+            drive.close()
+            return drive.now - left if left is not None else 0.0
+        steering = tracker.update(sensors) if not at_intersection(sensors) else None
+        if steering is not None:
+            drive.chassis.set_velocity(steering.speed, 90, steering.yaw)
+        drive.now += tracker.period
+    drive.close()
+    return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--noise", type=float, nargs="+", default=NOISE, help="probability of a white sample turning black")
+    parser.add_argument("--speeds", type=float, nargs="+", default=SPEEDS)
+    args = parser.parse_args()
+    print(f"laps at speed {LAP_SPEED}")
+    for noise in args.noise:
+        for filtered in (False, True):
+            result = lap(noise, filtered)
+            print(
+                f"  noise {noise:4.2f} {'filtered' if filtered else '     raw'}: "
+                f"{result['phantom_intersections']:4d} phantom intersections {result['losses']:3d} line losses "
+                f"{'finished' if result['finished'] else 'DNF'}"
+            )
+    print("line loss detection")
+    for speed in args.speeds:
+        for noise in args.noise:
+            latencies = [loss_latency(speed, noise, filtered) for filtered in (False, True)]
+            raw, filtered = (f"{latency * 1000:6.0f} ms" if latency is not None else " missed " for latency in latencies)
+            print(f"  speed {speed:3.0f} noise {noise:4.2f}: raw {raw} filtered {filtered}")
@@ -0,0 +1,251 @@
+"""
+Benchmark suite
+
+Runs the benchmarks of this directory on small fixed workloads and writes the results as JSON:
+    {"machine": {...}, "metrics": {"<benchmark>.<metric>": {"value": ..., "unit": ..., "higher_is_better": ...}}}
+The suite is run several times and every metric reports the median of its runs, along with their spread (range
+over median). The results are compared with a baseline (baseline.json next to this file by default) and the run
+fails if the median of a metric got worse by more than its regression threshold, widened for metrics whose runs
+spread wider than it either now or in the baseline. Baselines only mean something on the machine they were
+recorded on: record one with --save-baseline before comparing. Everything runs headless on the CPU, the camera
+frames coming from the simulated drivers of hal.py.
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import time
+from typing import Callable, NotRequired, TypedDict
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import color_pipeline  # noqa: E402  (sets up the simulated drivers before anything imports hal)
+import fleet_dispatch  # noqa: E402
+import line_following  # noqa: E402
+import line_noise  # noqa: E402
+import state_machine  # noqa: E402
+import validation  # noqa: E402
+import wire  # noqa: E402
+import wire_format  # noqa: E402
+from common import OrderValidator  # noqa: E402
+from generate_orders import generate_orders  # noqa: E402
+from route_planner import AisleLayout  # noqa: E402
+from warehouse_sim import WarehouseSimulation, repeat_trace  # noqa: E402
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+# largest relative change in the wrong direction that is not a regression, for metrics that do not spread
+DEFAULT_THRESHOLD = 0.1
+# benchmarks going through sockets and threads are noisier
+THRESHOLDS = {"hub": 0.2}
+# a change is only a regression if it also exceeds this many times the spread of the runs
+NOISE_MARGIN = 1.0
+HUB_PORT = 18500
+
+
+class Metric(TypedDict):
+    value: float
+    unit: str
+    higher_is_better: bool
+    # (largest - smallest) / median of the runs, and the value of every run
+    spread: NotRequired[float]
+    runs: NotRequired[list[float]]
+
+
+def _metric(value: float, unit: str, higher_is_better: bool = True) -> Metric:
+    return {"value": value, "unit": unit, "higher_is_better": higher_is_better}
+
+
+def bench_hub() -> dict[str, Metric]:
+    result = fleet_dispatch.run(fleet_size=5, orders=2000, port=HUB_PORT)
+    return {
+        "ingest": _metric(result["ingest_per_sec"], "orders/s"),
+        "dispatch": _metric(result["orders_per_sec"], "orders/s"),
+        "dispatch_p99": _metric(result["p99_ms"], "ms", higher_is_better=False),
+    }
+
+
+def bench_validation() -> dict[str, Metric]:
+    orders = validation.make_orders(20000)
+    validator = OrderValidator(validation.NUM_AISLES)
+    is_valid = validator.is_valid
+    single = validation.measure("validator", lambda batch: [is_valid(order) for order in batch], orders, 5)
+    batch = validation.measure("validator batch", validator.validate_batch, orders, 5)
+    return {
+        "single": _metric(single["ns_per_order"], "ns/order", higher_is_better=False),
+        "batch": _metric(batch["ns_per_order"], "ns/order", higher_is_better=False),
+    }
+
+
+def bench_wire() -> dict[str, Metric]:
+    orders = wire_format.make_orders(5000)
+    events = wire_format.make_events(wire_format.make_trips(orders))
+    metrics = {}
+    for name, messages, kind in (("order", orders, wire.MessageKind.ORDER), ("status", events, wire.MessageKind.STATUS)):
+        for result in wire_format.codec(name, messages, kind, 3):
+            if result["format"] == wire.WireFormat.BINARY:
+                metrics[f"{name}_encode"] = _metric(result["encode_ns"], "ns/message", higher_is_better=False)
+                metrics[f"{name}_decode"] = _metric(result["decode_ns"], "ns/message", higher_is_better=False)
+    return metrics
+
+
+def bench_state_machine() -> dict[str, Metric]:
+    untraced = state_machine.run(20000)
+    traced = state_machine.run(20000, trace_capacity=256)
+    return {
+        "transitions": _metric(untraced["transitions_per_sec"], "transitions/s"),
+        "transitions_traced": _metric(traced["transitions_per_sec"], "transitions/s"),
+    }
+
+
+def bench_color_pipeline() -> dict[str, Metric]:
+    frames = color_pipeline.synthetic_frames(60)
+    full = color_pipeline.run(frames, fast=False)
+    fast = color_pipeline.run(frames, fast=True)
+    return {
+        "frame": _metric(full["ms_per_frame"], "ms/frame", higher_is_better=False),
+        "frame_fast": _metric(fast["ms_per_frame"], "ms/frame", higher_is_better=False),
+        "frame_fast_cpu": _metric(fast["cpu_ms_per_frame"], "ms/frame", higher_is_better=False),
+    }
+
+
+def bench_line_following() -> dict[str, Metric]:
+    """Lap times in simulated time, so these only change with the steering or the simulator"""
+    table = line_following.run(line_following.TableTracker, 30)
+    pid = line_following.run(line_following.PidTracker, 60)
+    return {
+        "table_lap": _metric(table["lap_time"], "s", higher_is_better=False),
+        "pid_lap": _metric(pid["lap_time"], "s", higher_is_better=False),
+    }
+
+
+def bench_line_noise() -> dict[str, Metric]:
+    """Filtered line sensor readings with hallucinated black, in simulated time"""
+    lap = line_noise.lap(0.1, filtered=True)
+    latency = line_noise.loss_latency(30, 0.03, filtered=True)
+    return {
+        "phantom_intersections": _metric(lap["phantom_intersections"], "per lap", higher_is_better=False),
+        "loss_latency": _metric(latency * 1000, "ms", higher_is_better=False),
+    }
+
+
+def bench_order_cycle() -> dict[str, Metric]:
+    """Full order cycles through scheduling, batching and the robot state machines, in simulated time"""
+    duration = 6 * 3600
+    trace = repeat_trace(lambda repetition: generate_orders(3, 6, 1, 3, 3, 0, 30, repetition), duration)
+    simulation = WarehouseSimulation(trace, num_robots=4, layout=AisleLayout(num_aisles=3), seed=0)
+    start = time.perf_counter()
+    report = simulation.run()
+    elapsed = time.perf_counter() - start
+    return {
+        "orders": _metric(report["orders_completed"] / elapsed, "orders/s"),
+        "speedup": _metric(report["simulated_hours"] * 3600 / elapsed, "simulated s/s"),
+    }
+
+
+BENCHMARKS: dict[str, Callable[[], dict[str, Metric]]] = {
+    "hub": bench_hub,
+    "validation": bench_validation,
+    "wire": bench_wire,
+    "state_machine": bench_state_machine,
+    "color_pipeline": bench_color_pipeline,
+    "line_following": bench_line_following,
+    "line_noise": bench_line_noise,
+    "order_cycle": bench_order_cycle,
+}
+
+
+def _summarise(runs: list[Metric]) -> Metric:
+    values = [metric["value"] for metric in runs]
+    median = statistics.median(values)
+    return {
+        **runs[0],
+        "value": median,
+        "spread": (max(values) - min(values)) / abs(median) if median else 0.0,
+        "runs": values,
+    }
+
+
+def run(names: list[str], repeat: int = 1) -> dict:
+    """Run the benchmarks given `repeat` times, in suite order, reporting the median and spread of each metric"""
+    runs: dict[str, list[Metric]] = {}
+    for _ in range(repeat):
+        for name in BENCHMARKS:
+            if name not in names:
+                continue
+            print(f"running {name}", file=sys.stderr)
+            for metric, value in BENCHMARKS[name]().items():
+                runs.setdefault(f"{name}.{metric}", []).append(value)
+    metrics = {key: _summarise(values) for key, values in runs.items()}
+    return {
+        "machine": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+            "repeat": repeat,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        },
+        "metrics": metrics,
+    }
+
+
+def compare(results: dict, baseline: dict, threshold: float | None = None) -> list[str]:
+    """Print how every metric moved against the baseline and return the names of those that regressed"""
+    regressions = []
+    for name, metric in results["metrics"].items():
+        base = baseline["metrics"].get(name)
+        if base is None or not base["value"]:
+            print(f"{name:>32}: {metric['value']:12.2f} {metric['unit']} (no baseline)", file=sys.stderr)
+            continue
+        change = metric["value"] / base["value"] - 1
+        worse = -change if metric["higher_is_better"] else change
+        floor = threshold if threshold is not None else THRESHOLDS.get(name.split(".")[0], DEFAULT_THRESHOLD)
+        noise = max(metric.get("spread", 0.0), base.get("spread", 0.0))
+        limit = max(floor, NOISE_MARGIN * noise)
+        regressed = worse > limit
+        if regressed:
+            regressions.append(name)
+        print(
+            f"{name:>32}: {metric['value']:12.2f} {metric['unit']} ({change:+.1%}, limit {limit:.0%})"
+            f"{' REGRESSION' if regressed else ''}",
+            file=sys.stderr,
+        )
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS), default=list(BENCHMARKS))
+    parser.add_argument("-o", "--output", help="file to write the results to, stdout if not given")
+    parser.add_argument("--baseline", default=BASELINE, help="baseline to compare with")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the baseline")
+    parser.add_argument("--repeat", type=int, default=5, help="runs of the suite to take the median of")
+    parser.add_argument(
+        "--threshold", type=float, help="regression threshold for every metric before noise (e.g. 0.1 for 10%%)"
+    )
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    results = run(args.only, args.repeat)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s): {', '.join(regressions)}", file=sys.stderr)
+            exit(1)
+    else:
+        print(f"no baseline at {args.baseline}, record one with --save-baseline", file=sys.stderr)
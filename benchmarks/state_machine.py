@@ -0,0 +1,56 @@
+"""
+State machine benchmark
+
+Drives a StateMachine over the controller's transition table through the events of a delivery trip, with and
+without a transition trace, and reports transitions per second. Logging is disabled so the cost measured is
+the state machine's own.
+"""
+
+import argparse
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from states import CONTROLLER_TRANSITIONS, ControllerStates, StateMachine  # noqa: E402
+
+# events of a trip picking two packages in one aisle, with a path blockage on the way back, from IdleState
+TRIP_EVENTS = [
+    "order_received",
+    "picking_init",
+    "color_detected",
+    "order_grabbed",
+    "color_detected",
+    "exiting",
+    "to_hub",
+    "path_blocked",
+    "path_unblocked",
+    "movement_complete",
+]
+
+
+def run(trips: int, trace_capacity: int = 0, repeat: int = 3) -> dict:
+    machine = StateMachine(CONTROLLER_TRANSITIONS, ControllerStates.InitState, trace_capacity)
+    machine.transition("init_done")
+    transition = machine.transition
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(trips):
+            for event in TRIP_EVENTS:
+                transition(event)
+        best = min(best, time.perf_counter() - start)
+    assert machine.state is ControllerStates.IdleState
+    return {"trace_capacity": trace_capacity, "transitions_per_sec": trips * len(TRIP_EVENTS) / best}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--trips", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+    for capacity in (0, 256):
+        result = run(args.trips, capacity, args.repeat)
+        print(f"trace {result['trace_capacity']:>3}: {result['transitions_per_sec']:10.0f} transitions/s")
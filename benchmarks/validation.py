@@ -0,0 +1,94 @@
+"""
+Order validation benchmark
+
+Validates a stream of decoded orders, like the hub does on ingest, with the checks validate_order_data used
+to perform and with OrderValidator, one order at a time and as a batch. Reports the cost per order
+and the ingest rate each of them sustains.
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import OrderValidator, PackageColor  # noqa: E402
+
+NUM_AISLES = 3
+
+
+def legacy_validate_order_data(data) -> bool:
+    """The chain of checks validate_order_data performed before OrderValidator"""
+    if not isinstance(data, dict):
+        return False
+    if len(data) != 2 + ("id" in data) + ("orders" in data):
+        return False
+    if "id" in data and not isinstance(data["id"], str):
+        return False
+    if "orders" in data and not isinstance(data["orders"], list):
+        return False
+    if "deadline" not in data or not isinstance(data["deadline"], int):
+        return False
+    if "packages" not in data or not isinstance(data["packages"], list):
+        return False
+    if len(data["packages"]) == 0:
+        return False
+    for package in data["packages"]:
+        if len(package) != (3 if "order_id" in package else 2):
+            return False
+        if "order_id" in package and not isinstance(package["order_id"], str):
+            return False
+        if "color" not in package or not isinstance(package["color"], str):
+            return False
+        if "aisle" not in package or not isinstance(package["aisle"], int):
+            return False
+    return True
+
+
+def make_orders(count: int, seed: int = 0) -> list:
+    rng = random.Random(seed)
+    colors = [color.value for color in PackageColor]
+    orders = [
+        {
+            "id": f"bench:{i}",
+            "deadline": rng.randrange(10000),
+            "packages": [
+                {"color": rng.choice(colors), "aisle": rng.randrange(NUM_AISLES)} for _ in range(rng.randint(1, 3))
+            ],
+        }
+        for i in range(count)
+    ]
+    # decode them like the hub would receive them
+    return json.loads(json.dumps(orders))
+
+
+def measure(name: str, validate, orders: list, repeat: int) -> dict:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        validate(orders)
+        best = min(best, time.perf_counter() - start)
+    return {"validator": name, "ns_per_order": best / len(orders) * 1e9, "orders_per_sec": len(orders) / best}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--orders", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    orders = make_orders(args.orders)
+    validator = OrderValidator(NUM_AISLES)
+    is_valid = validator.is_valid
+    results = [
+        measure("legacy", lambda batch: [legacy_validate_order_data(order) for order in batch], orders, args.repeat),
+        measure("validator", lambda batch: [is_valid(order) for order in batch], orders, args.repeat),
+        measure("validator batch", validator.validate_batch, orders, args.repeat),
+    ]
+    for result in results:
+        print(
+            f"{result['validator']:>15}: {result['ns_per_order']:8.0f} ns/order"
+            f" {result['orders_per_sec']:12.0f} orders/s"
+        )
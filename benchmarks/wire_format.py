@@ -0,0 +1,131 @@
+"""
+Wire format benchmark
+
+Compares the JSON messages the server, hub and robots used to exchange with the binary format of wire.py:
+encode and decode cost and bytes per message for orders, batched trips and status events, and the rate at which
+orders go through a local PUSH/PULL socket pair in either format.
+"""
+
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+import zmq
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import wire  # noqa: E402
+from common import PackageColor, StatusEventType  # noqa: E402
+
+PORT = 18300
+
+
+def make_orders(count: int, seed: int = 0) -> list[dict]:
+    rng = random.Random(seed)
+    colors = [color.value for color in PackageColor]
+    return [
+        {
+            "id": f"orders.json:{i}",
+            "deadline": rng.randrange(100000),
+            "packages": [{"color": rng.choice(colors), "aisle": rng.randrange(3)} for _ in range(rng.randint(1, 3))],
+        }
+        for i in range(count)
+    ]
+
+
+def make_trips(orders: list[dict]) -> list[dict]:
+    # pairs of orders batched into one trip, the way the hub sends them to the robots
+    trips = []
+    for first, second in zip(orders[::2], orders[1::2]):
+        packages = [dict(package, order_id=order["id"]) for order in (first, second) for package in order["packages"]]
+        trips.append({"id": first["id"], "deadline": first["deadline"], "packages": packages,
+                      "orders": [first["id"], second["id"]]})
+    return trips
+
+
+def make_events(trips: list[dict]) -> list[dict]:
+    return [
+        {
+            "type": StatusEventType.DROPOFF.value,
+            "robot": "robot-1",
+            "timestamp": time.time(),
+            "order_id": trip["id"],
+            "packages": trip["packages"],
+            "failed": [],
+        }
+        for trip in trips
+    ]
+
+
+def codec(name: str, messages: list[dict], kind: wire.MessageKind, repeat: int) -> list[dict]:
+    results = []
+    for wire_format in wire.WireFormat:
+        encoded = [wire.encode(message, kind, wire_format) for message in messages]
+        assert all(wire.decode(frames) == message for frames, message in zip(encoded, messages))
+        encode_time = decode_time = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for message in messages:
+                wire.encode(message, kind, wire_format)
+            encode_time = min(encode_time, time.perf_counter() - start)
+            start = time.perf_counter()
+            for frames in encoded:
+                wire.decode(frames)
+            decode_time = min(decode_time, time.perf_counter() - start)
+        results.append({
+            "message": name,
+            "format": str(wire_format),
+            "encode_ns": encode_time / len(messages) * 1e9,
+            "decode_ns": decode_time / len(messages) * 1e9,
+            "bytes": sum(len(frame) for frames in encoded for frame in frames) / len(messages),
+        })
+    return results
+
+
+def transport(orders: list[dict], wire_format: wire.WireFormat, port: int) -> dict:
+    """Orders per second sent, received and decoded over a local TCP socket pair"""
+    ctx = zmq.Context()
+    pull = ctx.socket(zmq.PULL)
+    pull.bind(f"tcp://127.0.0.1:{port}")
+    push = ctx.socket(zmq.PUSH)
+    push.connect(f"tcp://127.0.0.1:{port}")
+
+    def send():
+        for order in orders:
+            push.send_multipart(wire.encode(order, wire.MessageKind.ORDER, wire_format), copy=False)
+
+    sender = threading.Thread(target=send)
+    start = time.perf_counter()
+    sender.start()
+    for _ in orders:
+        wire.decode(pull.recv_multipart(copy=False))
+    elapsed = time.perf_counter() - start
+    sender.join()
+    ctx.destroy(linger=0)
+    return {"format": str(wire_format), "orders_per_sec": len(orders) / elapsed}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    orders = make_orders(args.messages)
+    trips = make_trips(orders)
+    events = make_events(trips)
+    results = (
+        codec("order", orders, wire.MessageKind.ORDER, args.repeat)
+        + codec("trip", trips, wire.MessageKind.ORDER, args.repeat)
+        + codec("status event", events, wire.MessageKind.STATUS, args.repeat)
+    )
+    for r in results:
+        print(
+            f"{r['message']:>12} {r['format']:>6}: encode {r['encode_ns']:6.0f} ns, decode {r['decode_ns']:6.0f} ns,"
+            f" {r['bytes']:5.1f} bytes"
+        )
+    for i, wire_format in enumerate(wire.WireFormat):
+        r = transport(orders, wire_format, PORT + i)
+        print(f"{'transport':>12} {r['format']:>6}: {r['orders_per_sec']:8.0f} orders/s")
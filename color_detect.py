@@ -6,17 +6,19 @@
 """
 import json
 import logging
+import os
 import sys
-sys.path.append('/home/pi/TurboPi/')
 import cv2
 import time
 import math
 import signal
-import Camera
 import threading
+from typing import NamedTuple
 import numpy as np
-import yaml_handle
 import zmq
+import hal
+from color_lut import ColorTable
+from frame_pipeline import FramePipeline
 
 logging.basicConfig(filename="logs.txt", level=logging.DEBUG, format=f'[CAMERA PROCESS] %(asctime)s - %(levelname)s - %(message)s')
 
@@ -28,23 +30,21 @@ if sys.version_info.major == 2:
 
 servo1 = 1500
 servo2 = 1500
-target_color = ('red', 'green', 'blue')
+# colors of the packages looked for
+target_colors = set()
 
 lab_data = None
 servo_data = None
 
-# zmq setup for sending responses
-context = zmq.Context()
-dealer_socket = context.socket(zmq.DEALER)
-dealer_socket.identity = b"camera"
-dealer_socket.connect("tcp://localhost:5575")
+# zmq socket for talking to the controller, connected when run as a program so run() can be imported on its own
+dealer_socket = None
 
 
 def load_config():
-    global lab_data, servo_data
+    global lab_data, servo_data, color_table
     
-    lab_data = yaml_handle.get_yaml_data(yaml_handle.lab_file_path)
-    servo_data = yaml_handle.get_yaml_data(yaml_handle.servo_file_path)
+    lab_data, servo_data = hal.load_config()
+    color_table = ColorTable(lab_data, PACKAGE_COLORS)
 
 # 初始位置(initial position)
 def initMove():
@@ -60,25 +60,48 @@ range_rgb = {
 
 _stop = False
 __exit = False
-color_list = []
+# frames in which each target color was seen centered so far
+votes = {}
 size = (640, 480)
 __isRunning = False
 detect_color = 'None'
 start_pick_up = False
 draw_color = range_rgb["black"]
+# packages seen in the last frame processed, and the one detected
+candidates = []
+detected_package = None
+
+# colors segmented in every frame
+PACKAGE_COLORS = ('red', 'green', 'blue')
+# frames a package has to be seen centered in before it is detected
+VOTES = 3
+# area of an accepted package (pixels of the 640x480 frame)
+MIN_AREA = 2500
+MAX_AREA = 15000
+# how far off the image center an accepted package may be, as a fraction of the image size
+CENTER_TOLERANCE = 0.2
+# look only around the image center, at a lower resolution and without LAB conversion (find_packages_fast);
+# DELIVERPI_COLOR_FAST=0 processes whole frames the original way
+FAST_PATH = os.environ.get("DELIVERPI_COLOR_FAST", "1") != "0"
+FAST_SCALE = 2
+color_table = None
+# no preview window (DELIVERPI_HEADLESS=1); a simulated robot without a display is always headless
+HEADLESS = os.environ.get("DELIVERPI_HEADLESS", "0") != "0" or (hal.SIMULATED and not os.environ.get("DISPLAY"))
 
 
 # 变量重置(variables reset)
 def reset(): 
     global _stop
-    global color_list
+    global votes
     global detect_color
+    global detected_package
     global start_pick_up
     global servo1, servo2
     
     _stop = False
-    color_list = []
+    votes = {}
     detect_color = 'None'
+    detected_package = None
     start_pick_up = False
     servo1 = servo_data['servo1']
     servo2 = servo_data['servo2']
@@ -93,12 +116,11 @@ def init():
 # app开始玩法调用(app start program call)
 def start():
     global __isRunning
-    global target_color
     reset()
     board.pwm_servo_set_position(0.15, [[2, 3000]])
     time.sleep(1)
     __isRunning = True
-    logging.info(f"ColorDetect started for {target_color}")
+    logging.info(f"ColorDetect started for {sorted(target_colors)}")
 
 # app停止玩法调用(app stop program call)
 def stop():
@@ -120,10 +142,13 @@ def exit():
     set_rgb('None')
     logging.info("ColorDetect Exit")
 
-def setTargetColor(color):
-    global target_color
+def setTargetColor(colors):
+    global target_colors
+    global votes
 
-    target_color = color
+    target_colors = {str.lower(color) for color in colors}
+    # forget the sightings of the colors no longer looked for
+    votes = {color: count for color, count in votes.items() if color in target_colors}
     return (True, ())
 
 
@@ -138,21 +163,96 @@ def set_rgb(color):
     else:
         board.set_rgb([[1, 0, 0, 0], [2, 0, 0, 0]])
 
-# 找出面积最大的轮廓(find the contour with the largest area)
-# 参数为要比较的轮廓的列表(the parameter is a list of contours to compare)
-def getAreaMaxContour(contours):
-    contour_area_temp = 0
-    contour_area_max = 0
-    area_max_contour = None
+class Candidate(NamedTuple):
+    """A package seen in a frame"""
+
+    color: str
+    # area (pixels of the 640x480 frame) and center of the blob
+    area: float
+    centroid: tuple[float, float]
+    # fraction of its bounding rectangle the blob fills, packages being solid boxes
+    confidence: float
+    # corners of the bounding rectangle, for drawing
+    box: np.ndarray
+
+    def to_dict(self) -> dict:
+        return {"color": self.color, "area": self.area, "centroid": list(self.centroid), "confidence": self.confidence}
+
+
+def is_centered(candidate, img_w, img_h):
+    center_x, center_y = candidate.centroid
+    return abs(center_x - img_w / 2) < img_w * CENTER_TOLERANCE and abs(center_y - img_h / 2) < img_h * CENTER_TOLERANCE
+
+# 找出掩模中大小像包裹的色块(find the blobs of a mask the size of a package)
+# scale (one factor, or one per axis) and offset map the mask back to the coordinates of the frame, area_scale is
+# the area of a frame pixel relative to a pixel of a frame of the size find_packages works at
+def find_blobs(color, frame_mask, scale=1, offset=(0, 0), area_scale=1.0):
+    opened = cv2.morphologyEx(frame_mask, cv2.MORPH_OPEN, np.ones((3, 3), np.uint8))  # 开运算(opening operation)
+    closed = cv2.morphologyEx(opened, cv2.MORPH_CLOSE, np.ones((3, 3), np.uint8))  # 闭运算(closing operation)
+    contours = cv2.findContours(closed, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)[-2]  # 找出轮廓(find contours)
+    blobs = []
+    for c in contours:
+        if scale != 1:
+            c = (c * scale + offset).astype(np.float32)
+        area = math.fabs(cv2.contourArea(c))  # 计算轮廓面积(calculate contour area)
+        if not MIN_AREA * area_scale < area < MAX_AREA * area_scale:
+            continue
+        moments = cv2.moments(c)
+        rect = cv2.minAreaRect(c)
+        rect_area = rect[1][0] * rect[1][1]
+        blobs.append(Candidate(
+            color,
+            area,
+            (moments['m10'] / moments['m00'], moments['m01'] / moments['m00']),
+            min(area / rect_area, 1.0) if rect_area else 0.0,
+            np.intp(cv2.boxPoints(rect)),
+        ))
+    return blobs
+
+# 找出画面中所有颜色的包裹(find the packages of every color in a frame)
+def find_packages(img):
+    img_h, img_w = img.shape[:2]
+    # candidates are reported in the coordinates of the frame, as by find_packages_fast
+    scale = (img_w / size[0], img_h / size[1])
+    frame_resize = cv2.resize(img, size, interpolation=cv2.INTER_NEAREST)
+    frame_gb = cv2.GaussianBlur(frame_resize, (3, 3), 3)
 
-    for c in contours:  # 历遍所有轮廓(iterate through all contours)
-        contour_area_temp = math.fabs(cv2.contourArea(c))  # 计算轮廓面积(calculate contour area)
-        if contour_area_temp > contour_area_max:
-            contour_area_max = contour_area_temp
-            if contour_area_temp > 1000:  # 只有在面积大于300时，最大面积的轮廓才是有效的，以过滤干扰(only the maximal contour with an area greater than 300 is considered valid to filter out interference)
-                area_max_contour = c
+    frame_lab = cv2.cvtColor(frame_gb, cv2.COLOR_BGR2LAB)  # 将图像转换到LAB空间(convert the image to the LAB space)
 
-    return area_max_contour, contour_area_max  # 返回最大的轮廓(return the maximal contour)
+    packages = []
+    for color in PACKAGE_COLORS:
+        if color in lab_data:
+            frame_mask = cv2.inRange(frame_lab, tuple(lab_data[color]['min']), tuple(lab_data[color]['max']))
+            packages += find_blobs(color, frame_mask, scale, area_scale=scale[0] * scale[1])
+    return packages
+
+# Same as find_packages, only looking at the part of the frame a package can be accepted in (its center within
+# CENTER_TOLERANCE of the image center), downscaled by FAST_SCALE and classified with the color lookup table
+# instead of a LAB conversion: one lookup gives every color at once. Colors with too few pixels for a package
+# skip the contour search.
+def find_packages_fast(img):
+    global color_table
+
+    if color_table is None or color_table.lab_data is not lab_data:
+        color_table = ColorTable(lab_data, PACKAGE_COLORS)
+    img_h, img_w = img.shape[:2]
+    # the frame is not resized to size as in find_packages, the package areas are scaled to the frame instead
+    area_scale = img_w * img_h / (size[0] * size[1])
+    # room for the rest of the largest package accepted around its center
+    margin = math.sqrt(MAX_AREA * area_scale) / 2
+    x0 = max(int(img_w * (0.5 - CENTER_TOLERANCE) - margin), 0)
+    x1 = min(int(img_w * (0.5 + CENTER_TOLERANCE) + margin), img_w)
+    y0 = max(int(img_h * (0.5 - CENTER_TOLERANCE) - margin), 0)
+    y1 = min(int(img_h * (0.5 + CENTER_TOLERANCE) + margin), img_h)
+    roi = cv2.resize(img[y0:y1, x0:x1], ((x1 - x0) // FAST_SCALE, (y1 - y0) // FAST_SCALE), interpolation=cv2.INTER_AREA)
+
+    classes = color_table.classify(roi)
+    packages = []
+    for color in color_table.colors:
+        frame_mask = classes & color_table.bit(color)
+        if cv2.countNonZero(frame_mask) * FAST_SCALE ** 2 > MIN_AREA * area_scale:
+            packages += find_blobs(color, frame_mask, FAST_SCALE, (x0, y0), area_scale)
+    return packages
 
 # 机器人移动逻辑处理(robot movement logic processing)
 def move():
@@ -160,7 +260,6 @@ def move():
     global __isRunning
     global detect_color
     global start_pick_up
-    global target_color
 
     while True:
         if __isRunning:
@@ -168,10 +267,17 @@ def move():
                 board.set_buzzer(1900, 0.1, 0.9, 1)# 设置蜂鸣器响0.1秒(set the buzzer to emit for 0.1 second)
                 set_rgb(detect_color) # 设置扩展板上的彩灯与检测到的颜色一样(set the colored light on the expansion board to match the detected color)
                 
-                dealer_socket.send_multipart([b"", b"color_detected"])
-                stop()
+                # the other colors stay looked for, so the camera need not turn again for the next package of the aisle
+                target_colors.discard(detect_color)
+                report = {
+                    "event": "color_detected",
+                    "package": detected_package.to_dict(),
+                    "candidates": [c.to_dict() for c in candidates],
+                }
+                dealer_socket.send_multipart([b"", json.dumps(report).encode()])
+                if not target_colors:
+                    stop()
                 detect_color = 'None'
-                setTargetColor(None)
                 start_pick_up = False
                 set_rgb(detect_color)
             else:
@@ -192,115 +298,53 @@ def msg():
         if request["command"] == "check":
             dealer_socket.send_multipart([b"", "ONLINE".encode()])
         elif request["command"] == "detect_color":
+            # every package still to pick in the aisle, or a single color
+            setTargetColor(request["colors"] if "colors" in request else [request["color"]])
+            logging.info(f"Looking for {sorted(target_colors)}...")
             if __isRunning:
+                # already turned towards the shelves: only the colors looked for change
                 dealer_socket.send_multipart([b"", "NEW COLOR RCVD".encode()]) # informing that the old request has been overridden
-            setTargetColor(str.lower(request["color"]))
-            logging.info(f"Looking for {target_color}...")
-            start()
+            else:
+                start()
         elif request["command"] == "stop":
             stop()
             logging.info(f"Stopped color detection")
             dealer_socket.send_multipart([b"", "STOPPED".encode()]) # informing controller that we successfully stopped
         elif request["command"] == "resume":
-            if target_color == None:
+            if not target_colors:
                 logging.debug(f"Did not resume color detection. Send detect_color command first.")
             else:
-                logging.info(f"Resuming color detection for {target_color}")
+                logging.info(f"Resuming color detection for {sorted(target_colors)}")
                 start()
 
 
-
-# 运行子线程(run a sub-thread)
-move_thread = threading.Thread(target=move)
-move_thread.daemon = True
-move_thread.start()
-
-msg_thread = threading.Thread(target=msg)
-msg_thread.daemon = True
-msg_thread.start()
-
 # 机器人图像处理(robot images processing)
+# Finds the packages of every color in one pass over the frame (candidates); a package of a target color has to be
+# seen centered in VOTES frames before it is detected.
 def run(img):
-    global __isRunning
     global start_pick_up
-    global detect_color, draw_color, color_list
+    global detect_color, draw_color, votes
+    global candidates, detected_package
     
     if not __isRunning:  # 检测是否开启玩法，没有开启则返回原图像(check if the program is enabled, return the original image if not enabled)
         return img
     
-    img_copy = img.copy()
-    img_h, img_w = img.shape[:2]
-    
-    frame_resize = cv2.resize(img_copy, size, interpolation=cv2.INTER_NEAREST)
-    frame_gb = cv2.GaussianBlur(frame_resize, (3, 3), 3)
-    
-    frame_lab = cv2.cvtColor(frame_gb, cv2.COLOR_BGR2LAB)  # 将图像转换到LAB空间(convert the image to the LAB space)
-
-    color_area_max = None
-    max_area = 0
-    areaMaxContour_max = 0
     if not start_pick_up:
-        if target_color in lab_data:
-            frame_mask = cv2.inRange(frame_lab,
-                                            (lab_data[target_color]['min'][0],
-                                            lab_data[target_color]['min'][1],
-                                            lab_data[target_color]['min'][2]),
-                                            (lab_data[target_color]['max'][0],
-                                            lab_data[target_color]['max'][1],
-                                            lab_data[target_color]['max'][2]))  #对原图像和掩模进行位运算(perform bitwise operation on the original image and mask)
-            opened = cv2.morphologyEx(frame_mask, cv2.MORPH_OPEN, np.ones((3, 3), np.uint8))  # 开运算(opening operation)
-            closed = cv2.morphologyEx(opened, cv2.MORPH_CLOSE, np.ones((3, 3), np.uint8))  # 闭运算(closing operation)
-            contours = cv2.findContours(closed, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)[-2]  # 找出轮廓(find contours)
-            areaMaxContour, area_max = getAreaMaxContour(contours)  # 找出最大轮廓(find the maximal contour)
-            if areaMaxContour is not None:
-                if area_max > max_area:  # 找最大面积(find the maximal area)
-                    max_area = area_max
-                    color_area_max = target_color
-                    areaMaxContour_max = areaMaxContour
-    if max_area > 2500 and max_area < 15000:  # 有找到最大面积(the maximal area is found)
-        rect = cv2.minAreaRect(areaMaxContour_max)
-        box = np.intp(cv2.boxPoints(rect))
-        center_x, center_y = rect[0]  # rect[0] gives the (x, y) center
-        img_center_x = img.shape[1] / 2
-        img_center_y = img.shape[0] / 2
-        
-        tolerance_x = img.shape[1] * 0.2  # 30% of image width
-        tolerance_y = img.shape[0] * 0.2  # 30% of image height
-
-        is_centered = (abs(center_x - img_center_x) < tolerance_x) and (abs(center_y - img_center_y) < tolerance_y)
-        
-        if is_centered:
-            cv2.drawContours(img, [box], -1, range_rgb[color_area_max], 2)
-            if not start_pick_up:
-                if color_area_max == 'red':  # 红色最大(maximum red)
-                    color = 1
-                elif color_area_max == 'green':  # 绿色最大(maximum green)
-                    color = 2
-                elif color_area_max == 'blue':  # 蓝色最大(maximum blue)
-                    color = 3
-                else:
-                    color = 0
-                color_list.append(color)
-                if len(color_list) == 3:  # 多次判断(multiple detection)
-                    # 取平均值(get average value)
-                    color = np.mean(np.array(color_list))
-                    color_list = []
+        candidates = find_packages_fast(img) if FAST_PATH else find_packages(img)
+        img_h, img_w = img.shape[:2]
+        centered = [c for c in candidates if c.color in target_colors and is_centered(c, img_w, img_h)]
+        for c in centered:
+            cv2.drawContours(img, [c.box], -1, range_rgb[c.color], 2)
+        if centered:
+            for color in {c.color for c in centered}:
+                votes[color] = votes.get(color, 0) + 1
+                if votes[color] >= VOTES and not start_pick_up:  # 多次判断(multiple detection)
+                    votes = {}
                     start_pick_up = True
-                    if color == 1:
-                        detect_color = 'red'
-                        draw_color = range_rgb["red"]
-                    elif color == 2:
-                        detect_color = 'green'
-                        draw_color = range_rgb["green"]
-                    elif color == 3:
-                        detect_color = 'blue'
-                        draw_color = range_rgb["blue"]
-                    else:
-                        start_pick_up = False
-                        detect_color = 'None'
-                        draw_color = range_rgb["black"]
-    else:
-        if not start_pick_up:
+                    detected_package = max((c for c in centered if c.color == color), key=lambda c: c.area)
+                    detect_color = color
+                    draw_color = range_rgb[color]
+        else:
             detect_color = 'None'
             draw_color = range_rgb["black"]
         
@@ -316,30 +360,39 @@ def manual_stop(signum, frame):
     __isRunning = False
     initMove()  # 舵机回到初始位置(servo returns to the initial position)
     exit()
+    pipeline.stop()
     camera.camera_close()
-    cv2.destroyAllWindows()
+
+
+def report_pipeline(pipeline):
+    """Send the pipeline's histograms to the controller, which publishes them for the hub"""
+    dealer_socket.send_multipart([b"", json.dumps({"loops": pipeline.export()}).encode()])
 
 
 if __name__ == '__main__':
-    import HiwonderSDK.ros_robot_controller_sdk as rrc
-    board = rrc.Board()
+    # zmq setup for sending responses
+    context = zmq.Context()
+    dealer_socket = context.socket(zmq.DEALER)
+    dealer_socket.identity = b"camera"
+    dealer_socket.connect("tcp://localhost:5575")
+
+    # 运行子线程(run a sub-thread)
+    move_thread = threading.Thread(target=move)
+    move_thread.daemon = True
+    move_thread.start()
+
+    msg_thread = threading.Thread(target=msg)
+    msg_thread.daemon = True
+    msg_thread.start()
+
+    board = hal.board()
     init()
     reset()
-    camera = Camera.Camera()
+    camera = hal.camera()
     camera.camera_open(correction=True) # 开启畸变矫正,默认不开启(enable distortion correction, disabled by default)
+    # frames are captured, processed and previewed on threads of their own, the newest frame first
+    pipeline = FramePipeline(camera, run, lambda: __isRunning, preview=not HEADLESS, report=report_pipeline)
     signal.signal(signal.SIGINT, manual_stop)
-    while True:
-        if __isRunning:
-            img = camera.frame
-            if img is not None:
-                frame = img.copy()
-                Frame = run(frame)  
-                frame_resize = cv2.resize(Frame, (320, 240)) # 画面缩放到320*240(resize the image to 320*240)
-                cv2.imshow('frame', frame_resize)
-                key = cv2.waitKey(1)
-                if key == 27:
-                    break
-            else:
-                time.sleep(0.01)
-        elif __exit:
-            sys.exit()
+    pipeline.start()
+    pipeline.show_preview()
+    sys.exit()
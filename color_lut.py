@@ -0,0 +1,46 @@
+"""
+Lookup table classifying BGR pixels by package color
+
+color_detect thresholds frames in LAB space: a color conversion of every pixel, then inRange per color. Whether a
+pixel falls in a color's LAB range only depends on its BGR value, so the test can be done once for every BGR
+value, quantized to a few bits per channel, and stored. Classifying a pixel is then a single lookup giving a bit
+mask with a bit set for every color whose range holds the pixel.
+"""
+
+import cv2
+import numpy as np
+
+
+class ColorTable:
+    """Color bit mask of every quantized BGR value, for the LAB thresholds of the colors given"""
+
+    def __init__(self, lab_data: dict, colors: tuple[str, ...] = ("red", "green", "blue"), bits: int = 6):
+        """
+        :param lab_data: LAB thresholds of the colors, as {color: {"min": [l, a, b], "max": [l, a, b]}}
+        :param colors: colors to classify, at most 8; those without thresholds are left out
+        :param bits: bits kept of every channel, the table has 2 ** (3 * bits) entries
+        """
+        self.lab_data = lab_data
+        self.colors = [color for color in colors if color in lab_data]
+        self.bits = bits
+        self._shift = 8 - bits
+        levels = 1 << bits
+        # the value in the middle of every quantization step stands for the whole step
+        values = (np.arange(levels, dtype=np.uint16) << self._shift) + ((1 << self._shift) >> 1)
+        b, g, r = np.meshgrid(values, values, values, indexing="ij")
+        bgr = np.stack([b, g, r], axis=-1).astype(np.uint8).reshape(-1, 1, 3)
+        lab = cv2.cvtColor(bgr, cv2.COLOR_BGR2LAB)
+        self.table = np.zeros(levels**3, dtype=np.uint8)
+        for i, color in enumerate(self.colors):
+            inside = cv2.inRange(lab, tuple(lab_data[color]["min"]), tuple(lab_data[color]["max"]))
+            self.table[inside.reshape(-1) > 0] |= 1 << i
+
+    def bit(self, color: str) -> int:
+        """Bit of a color in the masks, 0 for a color the table does not know"""
+        return 1 << self.colors.index(color) if color in self.colors else 0
+
+    def classify(self, bgr: np.ndarray) -> np.ndarray:
+        """Color bit mask of every pixel of a BGR image"""
+        quantized = (bgr >> self._shift).astype(np.int32)
+        index = (quantized[..., 0] << (2 * self.bits)) | (quantized[..., 1] << self.bits) | quantized[..., 2]
+        return self.table[index]
@@ -2,14 +2,19 @@
 Common module for the server, hub and robot applications
 """
 
+import math
 from enum import StrEnum
-from typing import TypedDict, TypeGuard
+from typing import Callable, NotRequired, TypedDict, TypeGuard
 
 # ports used for networking between the applications
 SERVER_PORT = 8000
 HUB_PORT = 8001
 CONTROLLER_PORT = 8002
 
+# constants for service time estimation specific to the setup geometry (seconds)
+TIME_PER_ORDER = 10
+TIME_PER_PACKAGE = 10
+
 
 class PackageColor(StrEnum):
     """Enum representing the possible package colors"""
@@ -24,32 +29,267 @@ class PackageData(TypedDict):
 
     color: PackageColor
     aisle: int
+    order_id: NotRequired[str]  # order the package belongs to when several orders are batched into one trip
 
 
 class OrderData(TypedDict):
     """Struct representing the data for a single order"""
 
+    id: NotRequired[str]  # stable identifier, assigned by the hub if the server does not provide one
     deadline: int
     packages: list[PackageData]
+    orders: NotRequired[list[str]]  # ids of the orders merged into this one by the hub
+
+
+class OrderCommand(TypedDict):
+    """Struct representing a request from the server to amend an already published order"""
+
+    command: str  # "cancel" or "update_deadline"
+    id: str
+    deadline: NotRequired[int]
+
+
+class StatusEventType(StrEnum):
+    """Enum representing the kinds of status updates a robot publishes"""
+
+    ORDER_ACCEPTED = "order_accepted"
+    PACKAGE_PICKED = "package_picked"
+    PACKAGE_FAILED = "package_failed"
+    DROPOFF = "dropoff"
+    STATE_TRANSITION = "state_transition"
+    STATE_DWELL = "state_dwell"
+
+
+class StatusEvent(TypedDict):
+    """Struct representing a single status update published by a robot"""
+
+    type: StatusEventType
+    robot: str
+    timestamp: float  # unix time on the robot
+    order_id: NotRequired[str]  # trip the event belongs to
+    orders: NotRequired[list[str]]  # ORDER_ACCEPTED: ids of the orders on the trip
+    package: NotRequired[PackageData]  # PACKAGE_PICKED, PACKAGE_FAILED
+    reason: NotRequired[str]  # PACKAGE_FAILED
+    packages: NotRequired[list[PackageData]]  # DROPOFF: packages delivered
+    failed: NotRequired[list[PackageData]]  # DROPOFF: packages that could not be picked
+    from_state: NotRequired[str]  # STATE_TRANSITION
+    to_state: NotRequired[str]  # STATE_TRANSITION
+    event: NotRequired[str]  # STATE_TRANSITION: event that caused it
+    time_in_state: NotRequired[dict[str, float]]  # DROPOFF: seconds spent in each state since the previous dropoff
+    dwell: NotRequired[dict[str, dict]]  # STATE_DWELL: time-in-state histogram of each state (Histogram.export)
+    latency: NotRequired[dict[str, dict]]  # STATE_DWELL: event-to-actuation histogram of each event priority
+    loops: NotRequired[dict[str, dict]]  # STATE_DWELL: work time, jitter and period histograms of the control loops
+
+
+# fields each status event type must carry besides type, robot and timestamp
+STATUS_EVENT_FIELDS: dict[StatusEventType, set[str]] = {
+    StatusEventType.ORDER_ACCEPTED: {"order_id", "orders"},
+    StatusEventType.PACKAGE_PICKED: {"order_id", "package"},
+    StatusEventType.PACKAGE_FAILED: {"order_id", "package", "reason"},
+    StatusEventType.DROPOFF: {"order_id", "packages", "failed"},
+    StatusEventType.STATE_TRANSITION: {"from_state", "to_state", "event"},
+    StatusEventType.STATE_DWELL: {"dwell"},
+}
+
+
+class ValidationError(TypedDict):
+    """Struct describing why a value is not a valid order"""
+
+    index: NotRequired[int]  # position of the order in the batch it was validated with
+    path: str  # location of the offending field, e.g. "packages[1].color"
+    message: str
+
+
+class OrderValidator:
+    """
+    Validator for OrderData within the warehouse geometry
+
+    Besides the structure, checks that every color is a PackageColor and, if num_aisles is given, that every
+    aisle exists. is_valid is a single pass of exact type checks meant for the hot path of order ingest; errors
+    walks the value again only when it is invalid, to describe what is wrong. Booleans are not accepted where
+    integers are expected.
+    """
+
+    _REQUIRED = frozenset(("deadline", "packages"))
+    _ALLOWED = _REQUIRED | {"id", "orders"}
+    _PACKAGE_REQUIRED = frozenset(("color", "aisle"))
+    _PACKAGE_ALLOWED = _PACKAGE_REQUIRED | {"order_id"}
+
+    def __init__(self, num_aisles: int | None = None):
+        self.num_aisles = num_aisles
+        self.colors = frozenset(color.value for color in PackageColor)
+        # first aisle past the end of the warehouse
+        self._aisle_end = num_aisles if num_aisles is not None else math.inf
+
+    def is_valid(self, data) -> TypeGuard[OrderData]:
+        """Whether the value is a valid instance of OrderData"""
+        if type(data) is not dict:
+            return False
+        colors = self.colors
+        aisle_end = self._aisle_end
+        try:
+            packages = data["packages"]
+            if type(data["deadline"]) is not int or type(packages) is not list or not packages:
+                return False
+            for package in packages:
+                size = len(package) if type(package) is dict else 0
+                if size != 2 and (size != 3 or type(package["order_id"]) is not str):
+                    return False
+                aisle = package["aisle"]
+                if type(aisle) is not int or not 0 <= aisle < aisle_end or package["color"] not in colors:
+                    return False
+        except (KeyError, TypeError):
+            # missing field or unhashable color
+            return False
+        # only the optional fields can account for more than two keys
+        size = len(data)
+        if size == 2:
+            return True
+        has_id = type(data.get("id")) is str
+        has_orders = type(data.get("orders")) is list
+        return size == 3 and (has_id or has_orders) or size == 4 and has_id and has_orders
+
+    def errors(self, data) -> list[ValidationError]:
+        """Everything that is wrong with the value, empty if it is a valid instance of OrderData"""
+        if self.is_valid(data):
+            return []
+        if not isinstance(data, dict):
+            return [{"path": "", "message": f"expected an object, got {type(data).__name__}"}]
+        errors = list[ValidationError]()
+        for key in sorted(self._REQUIRED - data.keys()):
+            errors.append({"path": key, "message": "missing"})
+        for key in sorted(data.keys() - self._ALLOWED):
+            errors.append({"path": key, "message": "unexpected field"})
+        if "deadline" in data and type(data["deadline"]) is not int:
+            errors.append({"path": "deadline", "message": "expected an integer"})
+        if "id" in data and type(data["id"]) is not str:
+            errors.append({"path": "id", "message": "expected a string"})
+        if "orders" in data and type(data["orders"]) is not list:
+            errors.append({"path": "orders", "message": "expected a list"})
+        packages = data.get("packages")
+        if "packages" not in data:
+            pass
+        elif type(packages) is not list:
+            errors.append({"path": "packages", "message": "expected a list"})
+        elif not packages:
+            errors.append({"path": "packages", "message": "empty"})
+        else:
+            for i, package in enumerate(packages):
+                errors.extend(self._package_errors(package, f"packages[{i}]"))
+        return errors
+
+    def _package_errors(self, package, path: str) -> list[ValidationError]:
+        if not isinstance(package, dict):
+            return [{"path": path, "message": f"expected an object, got {type(package).__name__}"}]
+        errors = list[ValidationError]()
+        for key in sorted(self._PACKAGE_REQUIRED - package.keys()):
+            errors.append({"path": f"{path}.{key}", "message": "missing"})
+        for key in sorted(package.keys() - self._PACKAGE_ALLOWED):
+            errors.append({"path": f"{path}.{key}", "message": "unexpected field"})
+        if "color" in package and (not isinstance(package["color"], str) or package["color"] not in self.colors):
+            errors.append({"path": f"{path}.color", "message": f"not a package color: {package['color']!r}"})
+        if "aisle" in package:
+            aisle = package["aisle"]
+            if type(aisle) is not int:
+                errors.append({"path": f"{path}.aisle", "message": "expected an integer"})
+            elif aisle < 0 or (self.num_aisles is not None and aisle >= self.num_aisles):
+                errors.append({"path": f"{path}.aisle", "message": f"no such aisle: {aisle}"})
+        if "order_id" in package and type(package["order_id"]) is not str:
+            errors.append({"path": f"{path}.order_id", "message": "expected a string"})
+        return errors
+
+    def validate_batch(self, batch: list) -> tuple[list[OrderData], list[ValidationError]]:
+        """Split a batch of decoded values into the valid orders and the errors of the others
+
+        Errors carry the index of the value they belong to within the batch.
+        """
+        is_valid = self.is_valid
+        valid = [data for data in batch if is_valid(data)]
+        if len(valid) == len(batch):
+            return valid, []
+        errors = list[ValidationError]()
+        for i, data in enumerate(batch):
+            for error in self.errors(data):
+                error["index"] = i
+                errors.append(error)
+        return valid, errors
+
+
+# validator used when the number of aisles is not known
+ORDER_VALIDATOR = OrderValidator()
 
 
 def validate_order_data(data) -> TypeGuard[OrderData]:
     """Validate an object to be a valid instance of OrderData"""
+    return ORDER_VALIDATOR.is_valid(data)
+
+
+def validate_order_command(data) -> TypeGuard[OrderCommand]:
+    """Validate an object to be a valid instance of OrderCommand"""
     if not isinstance(data, dict):
         return False
-    if len(data) != 2:
+    if not isinstance(data.get("id"), str):
         return False
-    if "deadline" not in data or not isinstance(data["deadline"], int):
+    match data.get("command"):
+        case "cancel":
+            return len(data) == 2
+        case "update_deadline":
+            return len(data) == 3 and isinstance(data.get("deadline"), int)
+    return False
+
+
+def validate_status_event(data) -> TypeGuard[StatusEvent]:
+    """Validate an object to be a valid instance of StatusEvent"""
+    if not isinstance(data, dict):
         return False
-    if "packages" not in data or not isinstance(data["packages"], list):
+    if not isinstance(data.get("robot"), str) or not isinstance(data.get("timestamp"), (int, float)):
         return False
-    if len(data["packages"]) == 0:
+    try:
+        fields = STATUS_EVENT_FIELDS[StatusEventType(data.get("type"))]
+    except ValueError:
         return False
-    for package in data["packages"]:
-        if len(package) != 2:
-            return False
-        if "color" not in package or not isinstance(package["color"], str):
-            return False
-        if "aisle" not in package or not isinstance(package["aisle"], int):
-            return False
-    return True
+    if not fields.issubset(data):
+        return False
+    return all(check(data[field]) for field, check in _STATUS_FIELD_CHECKS.items() if field in data)
+
+
+def _is_package(value) -> bool:
+    return (
+        isinstance(value, dict)
+        and isinstance(value.get("color"), str)
+        and type(value.get("aisle")) is int
+        and isinstance(value.get("order_id", ""), str)
+    )
+
+
+def _is_dict_of(check: Callable[[object], bool]) -> Callable[[object], bool]:
+    return lambda value: isinstance(value, dict) and all(
+        isinstance(key, str) and check(item) for key, item in value.items()
+    )
+
+
+def _is_list_of(check: Callable[[object], bool]) -> Callable[[object], bool]:
+    return lambda value: isinstance(value, list) and all(check(item) for item in value)
+
+
+def _is_str(value) -> bool:
+    return isinstance(value, str)
+
+
+# type checks of the optional fields of a status event; histogram exports are only checked to be objects, the hub
+# skips those it cannot merge
+_STATUS_FIELD_CHECKS: dict[str, Callable[[object], bool]] = {
+    "order_id": _is_str,
+    "orders": _is_list_of(_is_str),
+    "package": _is_package,
+    "reason": _is_str,
+    "packages": _is_list_of(_is_package),
+    "failed": _is_list_of(_is_package),
+    "from_state": _is_str,
+    "to_state": _is_str,
+    "event": _is_str,
+    "time_in_state": _is_dict_of(lambda seconds: type(seconds) in (int, float)),
+    "dwell": _is_dict_of(lambda export: isinstance(export, dict)),
+    "latency": _is_dict_of(lambda export: isinstance(export, dict)),
+    "loops": _is_dict_of(lambda export: isinstance(export, dict)),
+}
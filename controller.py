@@ -1,25 +1,37 @@
+import asyncio
+import itertools
 import json
 import os
+import platform
 import signal
 import subprocess
 import sys
+from enum import IntEnum
 from typing import Tuple, cast
 import zmq
+import zmq.asyncio
 import time
 import threading
 import logging
+from collections import deque
 from states import ControllerStateMachine, ControllerStates
-from common import CONTROLLER_PORT, HUB_PORT, OrderData, validate_order_data
-import HiwonderSDK.ros_robot_controller_sdk as rrc
-import HiwonderSDK.mecanum as mecanum
-
-
-sys.path.append('/home/pi/TurboPi/')
+from common import CONTROLLER_PORT, HUB_PORT, OrderData, OrderValidator, StatusEvent, StatusEventType, validate_order_data
+from metrics import Histogram
+from route_planner import AisleLayout, pick_sequence, plan_route
+import wire
+import hal
 
 
 logging.basicConfig(filename="logs.txt", level=logging.DEBUG, format=f'[CONTROLLER] %(asctime)s - %(levelname)s - %(message)s')
 logging.info("Initializing controller program")
 
+# get car and board objects (simulated ones with DELIVERPI_HAL=sim)
+car = hal.chassis()
+board = hal.board()
+if hal.SIMULATED:
+    # start every run from the hub
+    hal.reset_simulator()
+
 # instantiate all subprocesses
 active_subprocesses = []
 camera_process = subprocess.Popen(["python", os.path.join(os.getcwd(), "color_detect.py")])
@@ -29,14 +41,36 @@ active_subprocesses.append(ultrasonic_process)
 linefollower_process = subprocess.Popen(["python", os.path.join(os.getcwd(), "linefollower.py")])
 active_subprocesses.append(linefollower_process)
 
-# get car and board objects
-car = mecanum.MecanumChassis()
-board = rrc.Board()
-
 # global var to keep track of what aisle we are at/in
 aisle_num = 0
 
-HUB_HOST = "192.168.149.67"
+HUB_HOST = os.environ.get("DELIVERPI_HUB_HOST", "192.168.149.67")
+# geometry of the track: the aisles are dead ends, so every aisle is left with a 180 degree turn
+LAYOUT = AisleLayout(num_aisles=3)
+# rejects orders for aisles the robot does not know about
+ORDER_VALIDATOR = OrderValidator(LAYOUT.num_aisles)
+
+# identity the hub uses to tell the robots of the fleet apart
+ROBOT_ID = os.environ.get("DELIVERPI_ROBOT_ID", platform.node())
+
+
+class EventPriority(IntEnum):
+    """Order in which queued events are handled, lowest first"""
+
+    SAFETY = 0
+    CONTROL = 1
+
+
+# events handled ahead of everything else that is queued
+SAFETY_EVENTS = {"path_blocked", "path_unblocked", "blocked_timeout"}
+# time given to the robot to enter an aisle before looking for the package (seconds)
+ENTER_AISLE_TIME = 1
+# time the robot keeps driving onto the drop-off spot once it reached the hub (seconds)
+DROPOFF_APPROACH_TIME = 3
+# event-to-actuation latencies are logged every this many events
+LATENCY_REPORT_EVENTS = 100
+# how often the time-in-state, latency and control loop histograms are published for the hub (seconds)
+DWELL_EXPORT_INTERVAL = 30
 
 class Controller():
     """ Singleton class that controls robot execution. 
@@ -60,17 +94,45 @@ class Controller():
             self.router_socket.bind("tcp://*:5575")
             
             self.req_socket = context.socket(zmq.REQ)
+            self.req_socket.identity = ROBOT_ID.encode()
             self.req_socket.connect(f"tcp://{HUB_HOST}:{HUB_PORT}")
 
             self.pub_socket = context.socket(zmq.PUB)
             self.pub_socket.bind(f"tcp://*:{CONTROLLER_PORT}")
+            # status events are published in binary once the hub has answered an order request in binary
+            self.wire_format = wire.WireFormat.JSON
+            # wire version the hub answered with, the highest both understand
+            self.wire_version = wire.WIRE_VERSION
             
-            self.process_event_lock = threading.Lock()
+            # events waiting for the event loop, as (priority, sequence number, time received, event)
+            self.events: asyncio.PriorityQueue[tuple[EventPriority, int, float, str]] | None = None
+            self._event_sequence = itertools.count()
+            # set whenever the state machine changes state
+            self._state_changed: asyncio.Event | None = None
+            # priority and receive time of the event being handled, until it caused its first actuation
+            self._handling: tuple[EventPriority, float] | None = None
+            # time from an event being received to the first command sent because of it (seconds)
+            self.event_latency = {priority: Histogram(lowest=1e-5, highest=10) for priority in EventPriority}
+            # latest work time, jitter and period histograms of the components' fixed-rate loops, by name
+            self.loop_stats: dict[str, dict] = {}
+            # reports of the packages detected by the camera (package and every candidate in view), one per
+            # color_detected event queued
+            self.detections: deque[dict] = deque()
+            self._events_handled = 0
+            # change of aisle_num at every intersection the line follower passes on its route
+            self._route_step = 1
+            # long-running actions (delays, animations) in progress, kept referenced until they finish
+            self._tasks: set[asyncio.Task] = set()
+            # events the blocked state has no transition for, queued again once the path is clear
+            self._held_events: list[str] = []
+            # whether the robot stands on the drop-off spot, where it must not resume following the line
+            self._parked = False
             
             self.components = ["camera", "ultrasonic", "linefollower"]
             self.check_components()
             
             # keep track of all packages processed
+            self.current_order: OrderData | None = None
             self.remaining_packages = []
             self.completed_packages = []
             
@@ -88,6 +150,72 @@ class Controller():
         msg = msg.encode()
         identity = identity.encode()
         self.router_socket.send_multipart([identity, b"", msg])
+        self._actuated()
+
+    def _upload_route(self, passes: int, step: int):
+        """Have the line follower drive past the next intersections on its own
+
+        It then only stops at the intersection after them, where the controller decides what to do, and
+        reports every intersection it passed with intersection_passed.
+        :param passes: number of intersections to pass
+        :param step: change of aisle_num at every intersection, 1 driving away from the hub, -1 towards it
+        """
+        self._route_step = step
+        msg = {
+            "command": "route",
+            "actions": ["ignore"] * passes
+        }
+        self._send_msg("linefollower", json.dumps(msg))
+
+    def _actuated(self):
+        """Record the latency of the event being handled if this is the first command it caused"""
+        if self._handling is not None:
+            priority, received = self._handling
+            self.event_latency[priority].record(time.perf_counter() - received)
+            self._handling = None
+
+    def latency_report(self) -> dict:
+        """Event-to-actuation latency percentiles per event priority (milliseconds)"""
+        return {
+            priority.name.lower(): {
+                "count": latencies.count,
+                "p50": latencies.percentile(50) * 1000 if latencies.count else None,
+                "p99": latencies.percentile(99) * 1000 if latencies.count else None,
+                "p100": latencies.percentile(100) * 1000 if latencies.count else None,
+            }
+            for priority, latencies in self.event_latency.items()
+        }
+
+    def _publish_dwell(self):
+        """Publish the time-in-state, event-to-actuation and control loop histograms for the hub to aggregate"""
+        self._publish_status(
+            StatusEventType.STATE_DWELL,
+            dwell={state: histogram.export() for state, histogram in self.state_machine.dwell.items() if histogram.count},
+            latency={priority.name.lower(): histogram.export() for priority, histogram in self.event_latency.items()},
+            loops=self.loop_stats,
+        )
+
+    async def export_dwell(self):
+        """Task publishing the histograms periodically"""
+        while True:
+            await asyncio.sleep(DWELL_EXPORT_INTERVAL)
+            self._publish_dwell()
+
+    def _publish_status(self, event_type: StatusEventType, **fields):
+        """Publish a status event for the hub
+
+        :param event_type: kind of event
+        :param fields: event specific fields, see common.StatusEvent
+        """
+        event: StatusEvent = {"type": event_type, "robot": ROBOT_ID, "timestamp": time.time(), **fields}
+        if self.current_order is not None and "order_id" not in fields and event_type not in (StatusEventType.STATE_TRANSITION, StatusEventType.STATE_DWELL):
+            event["order_id"] = self.current_order.get("id", "")
+        self.pub_socket.send_multipart(wire.encode(event, wire.MessageKind.STATUS, self.wire_format, self.wire_version), copy=False)
+
+    @staticmethod
+    def _package_data(package: dict) -> dict:
+        """Package as received from the hub, without the controller's bookkeeping"""
+        return {key: value for key, value in package.items() if key != "picked"}
 
     def _recv_msg(self) -> Tuple[str, str]:
         """Receive a message on the router socket
@@ -101,20 +229,71 @@ class Controller():
         print(f"Message received from from {identity}: {message}")
         return (identity, message)
         
-    def listen_for_messages(self):
-        """Thread that will listen for messages on the router socket
+    async def listen_for_messages(self):
+        """Task that will listen for messages on the router socket
         """
+        router_socket = zmq.asyncio.Socket.from_socket(self.router_socket)
         while True:
             # Receive identity and message
-            identity, message = self._recv_msg()
-            self.process_message(identity, message)
+            identity, empty, message = await router_socket.recv_multipart()
+            try:
+                self.process_message(identity.decode(), message.decode())
+            except Exception:
+                logging.exception(f"Failed to process message {message!r}")
                         
     def process_message(self, identity: str, message: str):
         """ Process a message received on the router socket
-            Not useful right now but could be helpful if pre-processing needs to be done.
+            Every message from a component is an event, queued for the event loop, except for the JSON
+            statistics of its control loop. JSON messages with an event carry its data along.
         :param message: message to process
         """
-        self.process_event(message)
+        logging.debug(f"Message received from {identity}: {message}")
+        if message.startswith("{"):
+            data = json.loads(message)
+            if "event" not in data:
+                self.loop_stats.update(data["loops"])
+                return
+            if data["event"] == "color_detected":
+                self.detections.append(data)
+            message = data["event"]
+        self.post_event(message)
+
+    def post_event(self, event: str):
+        """Queue an event for the event loop, safety events ahead of any other queued event
+
+        :param event: event to queue
+        """
+        priority = EventPriority.SAFETY if event in SAFETY_EVENTS else EventPriority.CONTROL
+        self.events.put_nowait((priority, next(self._event_sequence), time.perf_counter(), event))
+
+    async def dispatch_events(self):
+        """Task handling the queued events one at a time, highest priority first
+
+        Handling an event never waits: anything that takes time is started as a separate task, so a safety
+        event is acted upon as soon as it is received.
+        """
+        while True:
+            priority, _, received, event = await self.events.get()
+            self._handling = (priority, received)
+            try:
+                self.process_event(event)
+            except Exception:
+                logging.exception(f"Failed to process event {event}")
+            self._handling = None
+            self._events_handled += 1
+            if self._events_handled % LATENCY_REPORT_EVENTS == 0:
+                logging.info(f"Event-to-actuation latency: {self.latency_report()}")
+
+    def _spawn(self, coro):
+        """Run a long action as a task of the event loop"""
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+
+    def _task_done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logging.error(f"Action failed: {task.exception()!r}")
                     
     
     def check_components(self):
@@ -155,249 +334,357 @@ class Controller():
         """ This function will process an event passed to it. The basic operational idea is that
             we are in some state, and as we transition, there are things we need to take care of. 
             For example, when we reach an aisle, we have to take care of entering that aisle/picking init
-            before we complete the transition into the picking state. Note that this function needs to
-            run fairly quickly to avoid major slowdown.
+            before we complete the transition into the picking state. This runs on the event loop and must
+            never block: actions that take time are started as tasks with _spawn.
         :param event: event to be processed
         """
         global aisle_num
-        with self.process_event_lock:
-            current_state = self.state_machine.state
-            next_state = self.state_machine.get_next_state(event)
-            match event:
-                case "order_received":
-                    # start line tracking thread to correct aisle
-                    aisle_num = 0
-                    msg = {
-                        "command": "start"
-                    }
-                    for component in self.components:
-                        if component == "camera":
-                            continue
-                        self._send_msg(component, json.dumps(msg))
-                case "order_grabbed":
-                    self.remaining_packages[0]["picked"] = True
-                    self.completed_packages.append(self.remaining_packages.pop(0))
-                    logging.info(f"Successfully grabbed package {self.completed_packages[-1]}")
-                    
-                    # no more packages,
-                    if len(self.remaining_packages) > 0:
-                        if self.remaining_packages[0]["aisle"] == self.completed_packages[-1]["aisle"]:
-                            """ special case if the new package is in the same aisle. back up and keep picking but with new color.
-                                this should probably be caught in the exit aisle state with "aisle_reached" instead. that
-                                way would be easier and could use linefollowing instead of this crude approach
-                            """
-                            line_msg = {"command": "stop"}
-                            self._send_msg("linefollower", json.dumps(msg))
-                            # wait for msg received
-                            time.sleep(0.4)
-                            
-                            car.set_velocity(-25,90,0)
-                            time.sleep(1.5)
-                            
-                            color = self.remaining_packages[0]["color"]
-                            msg = {
-                                "command": "detect_color",
-                                "color": color
-                            }
-                            line_msg = {"command": "start"}
-                            self._send_msg("camera", json.dumps(msg))
-                            self._send_msg("linefollower", json.dumps(msg))
-                        else:
-                            msg = {
-                                "command": "start",
-                                "param": 180
-                            }
-                            event = "exiting"
-                            self._send_msg("linefollower", json.dumps(msg))
+        current_state = self.state_machine.state
+        next_state = self.state_machine.get_next_state(event)
+        match event:
+            case "order_received":
+                # start line tracking thread to correct aisle
+                aisle_num = 0
+                msg = {
+                    "command": "start"
+                }
+                for component in self.components:
+                    if component == "camera":
+                        continue
+                    self._send_msg(component, json.dumps(msg))
+                self._upload_route(self.remaining_packages[0]["aisle"] - aisle_num, 1)
+            case "order_grabbed":
+                self.remaining_packages[0]["picked"] = True
+                self.completed_packages.append(self.remaining_packages.pop(0))
+                logging.info(f"Successfully grabbed package {self.completed_packages[-1]}")
+                self._publish_status(StatusEventType.PACKAGE_PICKED, package=self._package_data(self.completed_packages[-1]))
+
+                # no more packages,
+                if len(self.remaining_packages) > 0:
+                    if self.remaining_packages[0]["aisle"] == self.completed_packages[-1]["aisle"]:
+                        # the route planner orders the picks in an aisle by depth, so the next package is
+                        # further down the aisle: keep following the line while looking for the new color
+                        # the camera is still turned towards the shelves, only the colors looked for change
+                        msg = {
+                            "command": "detect_color",
+                            "colors": self._aisle_colors()
+                        }
+                        line_msg = {"command": "start"}
+                        self._send_msg("camera", json.dumps(msg))
+                        self._send_msg("linefollower", json.dumps(line_msg))
                     else:
-                        print("All packages collected. Returning to hub")
-                        event = "exiting"
                         msg = {
                             "command": "start",
                             "param": 180
                         }
+                        event = "exiting"
                         self._send_msg("linefollower", json.dumps(msg))
-                case "movement_complete":
+                else:
+                    print("All packages collected. Returning to hub")
+                    event = "exiting"
+                    msg = {
+                        "command": "start",
+                        "param": 180
+                    }
+                    self._send_msg("linefollower", json.dumps(msg))
+            case "movement_complete":
+                if current_state == ControllerStates.PathBlockedState:
+                    # the drop-off finished while the path was blocked: complete it once unblocked
+                    self._held_events.append(event)
+                else:
+                    self._parked = False
                     # occasionaly commands get lost for some reason likely due some funky settings on the robot
                     # might have to send this message multiple times
                     msg = {
                         "command": "stop"
                     }
                     self._send_msg("linefollower", json.dumps(msg))
-                case "picking_init":
-                    time.sleep(1) #give time to enter aisle
-                    color = self.remaining_packages[0]["color"]
-                    msg = {
-                        "command": "detect_color",
-                        "color": color
-                    }
-                    self._send_msg("camera", json.dumps(msg))
-                case "color_detected":
+            case "picking_init":
+                self._spawn(self._detect_color_in_aisle(self._aisle_colors()))
+            case "color_detected":
+                detection = self.detections.popleft() if self.detections else None
+                if current_state == ControllerStates.PickingState and self._confirm_target(detection):
                     msg = {
                         "command": "stop"
                     }
                     self._send_msg("linefollower", json.dumps(msg))
-                case "path_blocked":
-                    msg = {
+                else:
+                    # override event: not a package to pick now, keep going
+                    event = "color_ignored"
+            case "path_blocked":
+                car.set_velocity(0,90,0)
+                self._actuated()
+                msg = {
+                    "command": "stop"
+                }
+                for component in self.components:
+                    if component == "ultrasonic":
+                        continue
+                    self._send_msg(component, json.dumps(msg))
+            case "path_unblocked":
+                msg = {
+                    "command": "resume"
+                }
+                for component in self.components:
+                    if component == "linefollower" and self._parked:
+                        continue
+                    self._send_msg(component, json.dumps(msg))
+                for held in self._held_events:
+                    self.post_event(held)
+                self._held_events.clear()
+            case "blocked_timeout":
+                if current_state == ControllerStates.PickingState:
+                    # notifying hub
+                    self._publish_status(
+                        StatusEventType.PACKAGE_FAILED,
+                        package=self._package_data(self.remaining_packages[0]),
+                        reason="unreachable",
+                    )
+
+                    self.remaining_packages[0]["picked"] = False
+                    self.completed_packages.append(self.remaining_packages.pop(0))
+                    # override event
+                    event = "not_detected"
+                    line_msg = {
+                        "command": "start",
+                        "param": 180
+                    }
+                    cam_msg = {
                         "command": "stop"
                     }
-                    for component in self.components:
-                        if component == "ultrasonic":
-                            continue
-                        self._send_msg(component, json.dumps(msg))
-                case "path_unblocked":
-                    msg = {
-                        "command": "resume"
+                    self._send_msg("camera", json.dumps(cam_msg))
+                    self._send_msg("linefollower", json.dumps(line_msg))
+            case "intersection_reached":
+                # here, should check what aisle/lane we need to be in and react accordingly.
+                if current_state == ControllerStates.ExitAisleState:
+                    if len(self.remaining_packages) == 0:
+                        # moving past current aisle so subtract
+                        aisle_num -= 1
+                        event = "to_hub"
+                        self._send_msg("linefollower", '{"command": "enter", "direction": "right"}')
+                        # every aisle left between here and the hub
+                        self._upload_route(aisle_num, -1)
+                    else:
+                        event = "to_aisle" #override event to transition to movingtoaislestate
+                        self._send_msg("linefollower", '{"command": "enter"}')
+                        self._upload_route(self.remaining_packages[0]["aisle"] - aisle_num, 1)
+                elif current_state == ControllerStates.PickingState:
+                    # couldn't find this package. abandon it and move on
+                    # notify hub
+                    self._publish_status(
+                        StatusEventType.PACKAGE_FAILED,
+                        package=self._package_data(self.remaining_packages[0]),
+                        reason="not_found",
+                    )
+
+                    self.remaining_packages[0]["picked"] = False
+                    self.completed_packages.append(self.remaining_packages.pop(0))
+                    event = "not_detected"
+                    line_msg = {
+                        "command": "start",
+                        "param": 180
                     }
-                    for component in self.components:
-                        self._send_msg(component, json.dumps(msg))
-                case "blocked_timeout":
-                    if current_state == ControllerStates.PickingState:
-                        # notifying hub
-                        msg = f"Failed to grab package {self.remaining_packages[0]}: Could not reach"
-                        self.pub_socket.send(msg.encode())
-                        
-                        self.remaining_packages[0]["picked"] = False
-                        self.completed_packages.append(self.remaining_packages.pop(0))
-                        # override event
-                        event = "not_detected"
-                        line_msg = {
-                            "command": "start",
-                            "param": 180
-                        }
-                        cam_msg = {
-                            "command": "stop"
-                        }
-                        self._send_msg("camera", json.dumps(cam_msg))
-                        self._send_msg("linefollower", json.dumps(line_msg))
-                case "intersection_reached":
-                    # here, should check what aisle/lane we need to be in and react accordingly.
-                    if current_state == ControllerStates.ExitAisleState:
-                        if len(self.remaining_packages) == 0:
-                            # moving past current aisle so subtract
-                            aisle_num -= 1
-                            event = "to_hub"
-                            self._send_msg("linefollower", '{"command": "enter", "direction": "right"}')
-                        else:
-                            event = "to_aisle" #override event to transition to movingtoaislestate
+                    cam_msg = {
+                        "command": "stop"
+                    }
+                    self._send_msg("camera", json.dumps(cam_msg))
+                    line_msg = { "command": "end"}
+                    self._send_msg("linefollower", json.dumps(line_msg))
+                elif current_state == ControllerStates.MovingToAisleState:
+                    if len(self.remaining_packages) > 0:
+                        if aisle_num == self.remaining_packages[0]["aisle"]:
                             self._send_msg("linefollower", '{"command": "enter"}')
-                    elif current_state == ControllerStates.PickingState:
-                        # couldn't find this package. abandon it and move on
-                        # notify hub
-                        msg = f"Failed to grab package {self.remaining_packages[0]}: Not found in aisle"
-                        self.pub_socket.send(msg.encode())
-                        
-                        self.remaining_packages[0]["picked"] = False
-                        self.completed_packages.append(self.remaining_packages.pop(0))
-                        event = "not_detected"
-                        line_msg = {
-                            "command": "start",
-                            "param": 180
-                        }
-                        cam_msg = {
-                            "command": "stop"
-                        }
-                        self._send_msg("camera", json.dumps(cam_msg))
-                        line_msg = { "command": "end"}
-                        self._send_msg("linefollower", json.dumps(line_msg))
-                    elif current_state == ControllerStates.MovingToAisleState:
-                        if len(self.remaining_packages) > 0:
-                            if aisle_num == self.remaining_packages[0]["aisle"]:
-                                self._send_msg("linefollower", '{"command": "enter"}')
-                                self.process_event_lock.release()
-                                self.process_event("picking_init") #override event
-                                self.process_event_lock.acquire()
-                                aisle_num += 1
-                                return
-                            else:
-                                self._send_msg("linefollower", '{"command": "ignore"}')
+                            self.process_event("picking_init") #override event
                             aisle_num += 1
-                    elif current_state == ControllerStates.MovingToHubState:
-                        aisle_num -= 1
-                        if aisle_num == -1:
-                            print("Made it back to hub!")
-                            event = "movement_complete"
-                            msg = {
-                                "command": "end"
-                            }
-                            self._send_msg("linefollower", json.dumps(msg))
-                            time.sleep(3)
-                            line_msg = { "command": "stop"}
-                            self._send_msg("linefollower", json.dumps(line_msg))
-                            
-                            msg = f"Dropping off packages {self.completed_packages}"
-                            self.pub_socket.send(msg.encode())
-                            
-                            # simulate dropoff
-                            r = 255
-                            g = 255
-                            b = 255
-                            for i in range(0,10):
-                                board.set_buzzer(1500, 0.1, 0.9, 1)
-                                board.set_rgb([[1, r, g, b], [2, r, g, b]])
-                                r -= 10
-                                g -= 20
-                                b -= 5
-                                time.sleep(0.3)
+                            return
                         else:
                             self._send_msg("linefollower", '{"command": "ignore"}')
-                case "no_line":
-                    if current_state == ControllerStates.PickingState:
-                        pass
-            self.state_machine.transition(event)
-            
+                        aisle_num += 1
+                elif current_state == ControllerStates.MovingToHubState:
+                    aisle_num -= 1
+                    if aisle_num == -1:
+                        print("Made it back to hub!")
+                        msg = {
+                            "command": "end"
+                        }
+                        self._send_msg("linefollower", json.dumps(msg))
+                        # the transition to idle happens once the drop-off is done
+                        self._spawn(self._drop_off())
+                    else:
+                        self._send_msg("linefollower", '{"command": "ignore"}')
+            case "intersection_passed":
+                # the line follower drove past an aisle on its route without stopping
+                aisle_num += self._route_step
+            case "no_line":
+                if current_state == ControllerStates.PickingState:
+                    pass
+        new_state = self.state_machine.transition(event)
+        if new_state != current_state:
+            self._state_changed.set()
+            self._publish_status(
+                StatusEventType.STATE_TRANSITION,
+                from_state=current_state.name(),
+                to_state=new_state.name(),
+                event=event,
+            )
+
+    def _aisle_colors(self) -> list[str]:
+        """Colors of the packages left to pick in the aisle of the next package"""
+        aisle = self.remaining_packages[0]["aisle"]
+        return [p["color"] for p in itertools.takewhile(lambda p: p["aisle"] == aisle, self.remaining_packages)]
+
+    def _confirm_target(self, detection: dict | None) -> bool:
+        """Whether a package detected by the camera is one to pick in this aisle. The camera looks for all of them
+        at once, so the package found is moved to the front of the remaining packages to be the one grabbed.
+
+        :param detection: report of the camera, None if it only sent the event
+        """
+        if detection is None:
+            return True
+        package = detection["package"]
+        aisle = self.remaining_packages[0]["aisle"]
+        for i, remaining in enumerate(itertools.takewhile(lambda p: p["aisle"] == aisle, self.remaining_packages)):
+            if remaining["color"].lower() == package["color"]:
+                self.remaining_packages.insert(0, self.remaining_packages.pop(i))
+                logging.info(
+                    f"Detected {package['color']} package at {package['centroid']}, area {package['area']:.0f}, "
+                    f"confidence {package['confidence']:.2f}, {len(detection['candidates'])} candidates in view"
+                )
+                return True
+        logging.warning(f"Ignoring detected {package['color']} package: none left to pick in aisle {aisle}")
+        return False
+
+    async def _detect_color_in_aisle(self, colors: list[str]):
+        """Start looking for the packages once the robot had time to enter the aisle"""
+        await asyncio.sleep(ENTER_AISLE_TIME)
+        msg = {
+            "command": "detect_color",
+            "colors": colors
+        }
+        self._send_msg("camera", json.dumps(msg))
+
+    async def _drop_off(self):
+        """Drive onto the drop-off spot, report the delivery and play the drop-off animation"""
+        await asyncio.sleep(DROPOFF_APPROACH_TIME)
+        line_msg = { "command": "stop"}
+        self._send_msg("linefollower", json.dumps(line_msg))
+        self._parked = True
+
+        logging.info(f"Dropping off packages {self.completed_packages}")
+        self._publish_status(
+            StatusEventType.DROPOFF,
+            packages=[self._package_data(p) for p in self.completed_packages if p["picked"]],
+            failed=[self._package_data(p) for p in self.completed_packages if not p["picked"]],
+            time_in_state=self.state_machine.breakdown(),
+        )
+        # the next breakdown includes the wait for the next order
+        self.state_machine.reset_breakdown()
+        self._publish_dwell()
+
+        # simulate dropoff
+        r = 255
+        g = 255
+        b = 255
+        for i in range(0,10):
+            board.set_buzzer(1500, 0.1, 0.9, 1)
+            board.set_rgb([[1, r, g, b], [2, r, g, b]])
+            r -= 10
+            g -= 20
+            b -= 5
+            await asyncio.sleep(0.3)
+        # through the queue, after any safety event received meanwhile
+        self.post_event("movement_complete")
+
+    async def _grab(self):
+        """Simulate grabbing the item"""
+        r,g,b = 255, 255, 255
+        for i in range (0,5):
+            board.set_buzzer(1900, 0.1, 0.9, 1)
+            board.set_rgb([[1, r, g, b], [2, r, g, b]])
+            r -= 10
+            g -= 55
+            b -= 30
+            await asyncio.sleep(0.5)
+
+    async def _request_order(self, req_socket: zmq.asyncio.Socket) -> OrderData:
+        """Ask the hub for orders until a valid one arrives"""
+        while True:
+            # announce that binary replies are understood
+            await req_socket.send(wire.HELLO)
+            frames = await req_socket.recv_multipart(copy=False)
+            if len(frames) == 1 and not frames[0].bytes:
+                logging.debug("no orders available")
+                await asyncio.sleep(1)
+                continue
+            data = frames[0].bytes
+            try:
+                order = wire.decode(frames)
+            except ValueError:
+                order = None
+            else:
+                if wire.is_binary(data):
+                    self.wire_format = wire.WireFormat.BINARY
+                    self.wire_version = wire.peer_version(data)
+            if ORDER_VALIDATOR.is_valid(order):
+                return order
+            logging.error(f"invalid order received: {data}: {ORDER_VALIDATOR.errors(order)}")
+            if validate_order_data(order):
+                self._reject_order(order)
+
+    def _reject_order(self, order: OrderData):
+        """Report a well-formed trip this robot cannot serve, e.g. with an aisle it does not have, as failed so the
+        hub accounts for its orders instead of waiting for them
+        """
+        order_id = order.get("id", "")
+        for package in order["packages"]:
+            reason = "no_such_aisle" if package["aisle"] >= LAYOUT.num_aisles else "rejected"
+            self._publish_status(StatusEventType.PACKAGE_FAILED, order_id=order_id, package=package, reason=reason)
+        self._publish_status(StatusEventType.DROPOFF, order_id=order_id, packages=[], failed=order["packages"])
+
     def execution_thread(self):
-        """ Main thread of execution for the controller. This doesn't contain much but
-            can be useful when more complicated controller functionality is needed within
-            certain states.
+        """ Main thread of execution for the controller. Runs the event loop that handles the
+            events of the components and drives the controller through its states.
         """
         # small delay to ensure sockets are connected
         time.sleep(1)
-        
-        listener = threading.Thread(target=controller.listen_for_messages, daemon=True)
-        listener.start()
+        asyncio.run(self._run())
+
+    async def _run(self):
+        self.events = asyncio.PriorityQueue()
+        self._state_changed = asyncio.Event()
+        listener = asyncio.create_task(self.listen_for_messages())
+        dispatcher = asyncio.create_task(self.dispatch_events())
+        exporter = asyncio.create_task(self.export_dwell())
+        req_socket = zmq.asyncio.Socket.from_socket(self.req_socket)
         self.__executing = True
         
         while self.__executing:
-            match controller.state_machine.state:
+            self._state_changed.clear()
+            match self.state_machine.state:
                 case ControllerStates.IdleState:
-                    # block and wait for a msg from server here. server: router
+                    # wait for an order from the hub here. hub: router
                     logging.info("requesting a new order")
-                    while True:
-                        self.req_socket.send(b"")
-                        data = self.req_socket.recv()
-                        if not data:
-                            logging.debug("no orders available")
-                            time.sleep(1)
-                            continue
-                        order = json.loads(data)
-                        if validate_order_data(order):
-                            break
-                        logging.error(f"invalid order received: {data}")
-                    self.remaining_packages = sorted(order["packages"], key=lambda x: x["aisle"])
+                    order = await self._request_order(req_socket)
+                    route = plan_route(order["packages"], LAYOUT)
+                    self.current_order = order
+                    self.remaining_packages = pick_sequence(route)
+                    self.completed_packages = []
                     logging.info(f"order received: {order}")
+                    self._publish_status(StatusEventType.ORDER_ACCEPTED, orders=order.get("orders", [order.get("id", "")]))
                     self.process_event("order_received")
-                case ControllerStates.MovingToAisleState:
-                    pass
                 case ControllerStates.PathBlockedState:
                     car.set_velocity(0,90,0)
-                    time.sleep(0.1)
-                case ControllerStates.PickingState:
-                    # real meat and potatoes
-                    pass                    
+                    await asyncio.sleep(0.1)
                 case ControllerStates.GrabbingState:
-                    # simulate grabbing the item
-                    r,g,b = 255, 255, 255
-                    for i in range (0,5):
-                        board.set_buzzer(1900, 0.1, 0.9, 1)
-                        board.set_rgb([[1, r, g, b], [2, r, g, b]])
-                        r -= 10
-                        g -= 55
-                        b -= 30
-                        time.sleep(0.5)
+                    await self._grab()
                     self.process_event("order_grabbed")
-                    
-                    # order_grabbed
+                case _:
+                    # nothing to do but react to events until the state changes
+                    await self._state_changed.wait()
+        listener.cancel()
+        dispatcher.cancel()
+        exporter.cancel()
+        logging.info(f"Event-to-actuation latency: {self.latency_report()}")
 
     def exit(self, code: int = 0, msg: str = None):
         """ Clean up remaining resources and safely exit the program. This will kill
@@ -411,6 +698,8 @@ class Controller():
         
         # clean any running processes/threads
         logging.info("Attempting to cleanly exit controller program")
+        if self.state_machine.trace is not None:
+            logging.info(f"Last state machine events: {self.state_machine.trace.entries()}")
         
         for process in active_subprocesses:
             os.kill(process.pid, signal.SIGINT)
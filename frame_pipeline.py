@@ -0,0 +1,238 @@
+"""
+Capture and processing pipeline of the camera process
+
+A capture thread reads the camera and a worker thread processes the frames, handed over through a LatestFrame
+holding a single frame: a frame captured while the previous one is still waiting replaces it, so the worker
+always processes the newest frame and never falls behind the camera. The preview window shows the latest
+processed frame through another LatestFrame, at a lower rate of its own, so displaying never delays processing;
+headless, no window is ever opened. While the pipeline is inactive (nothing to look for) the camera is not read.
+The pipeline records histograms of the wait between capture and processing, of the processing and of the whole
+way from capture to processed frame, counts the frames dropped on the way, and logs and reports them at regular
+intervals like a PeriodicLoop.
+"""
+
+import logging
+import threading
+import time
+from typing import Callable, NamedTuple
+
+import cv2
+import numpy as np
+
+from hal import Camera
+from metrics import Histogram
+from periodic import REPORT_INTERVAL
+
+# how often the camera is checked for a new frame while active, and whether to become active while not (s)
+POLL_PERIOD = 0.005
+IDLE_PERIOD = 0.05
+# rate and size of the preview window
+PREVIEW_FPS = 10
+PREVIEW_SIZE = (320, 240)
+# key closing the preview window (Esc)
+QUIT_KEY = 27
+
+
+class Frame(NamedTuple):
+    image: np.ndarray
+    # sequence number and time (time.monotonic) of the capture
+    number: int
+    captured: float
+
+
+class LatestFrame:
+    """Handoff of frames between two threads, a new frame replacing the one still waiting"""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._frame: Frame | None = None
+        self._closed = False
+        # frames replaced before being taken
+        self.dropped = 0
+
+    def put(self, frame: Frame):
+        with self._condition:
+            if self._frame is not None:
+                self.dropped += 1
+            self._frame = frame
+            self._condition.notify()
+
+    def get(self, timeout: float | None = None) -> Frame | None:
+        """Take the waiting frame, waiting up to timeout (s) for one; None if there was none or once closed"""
+        with self._condition:
+            self._condition.wait_for(lambda: self._frame is not None or self._closed, timeout)
+            frame, self._frame = self._frame, None
+            return frame
+
+    def close(self):
+        """Wake up the threads waiting for a frame"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+
+class FramePipeline:
+    """Camera frames processed on a worker thread, newest first
+
+        pipeline = FramePipeline(camera, process, active)
+        pipeline.start()
+        pipeline.show_preview()  # until stop() or Esc
+    """
+
+    def __init__(
+        self,
+        camera: Camera,
+        process: Callable[[np.ndarray], np.ndarray],
+        active: Callable[[], bool],
+        name: str = "camera",
+        preview: bool = True,
+        preview_fps: float = PREVIEW_FPS,
+        report: Callable[["FramePipeline"], None] | None = None,
+        report_interval: float = REPORT_INTERVAL,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """
+        :param camera: camera to read, opened
+        :param process: processes a frame (which it owns), returning the image to preview
+        :param active: whether frames are wanted
+        :param name: name of the pipeline, prefixed to its histograms and used as the window title
+        :param preview: whether to show the processed frames in a window, False to run headless
+        :param preview_fps: most times a second the preview is updated
+        :param report: called with the pipeline every report_interval, e.g. to send export() on
+        :param report_interval: time between two reports (s)
+        :param clock: time source
+        """
+        self.camera = camera
+        self.process = process
+        self.active = active
+        self.name = name
+        self.preview = preview
+        self.preview_fps = preview_fps
+        self.report = report
+        self.report_interval = report_interval
+        self.clock = clock
+        self.captured = LatestFrame()
+        self.processed = LatestFrame()
+        self.wait = Histogram(lowest=1e-5, highest=10)
+        self.processing = Histogram(lowest=1e-5, highest=10)
+        self.latency = Histogram(lowest=1e-5, highest=10)
+        self.display = Histogram(lowest=1e-5, highest=10)
+        self.frames_captured = 0
+        self.frames_processed = 0
+        self.frames_failed = 0
+        self.frames_shown = 0
+        self._stopped = threading.Event()
+        self._last_report = self.clock()
+        self._threads = [
+            threading.Thread(target=self._capture, name=f"{name}-capture", daemon=True),
+            threading.Thread(target=self._work, name=f"{name}-worker", daemon=True),
+        ]
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self.captured.close()
+        self.processed.close()
+
+    def _capture(self):
+        last = None
+        while not self._stopped.is_set():
+            if not self.active():
+                last = None
+                self._stopped.wait(IDLE_PERIOD)
+                continue
+            image = self.camera.frame
+            # the camera hands out the same image until it has a new one
+            if image is None or image is last:
+                self._stopped.wait(POLL_PERIOD)
+                continue
+            last = image
+            self.frames_captured += 1
+            self.captured.put(Frame(image.copy(), self.frames_captured, self.clock()))
+
+    def _work(self):
+        while not self._stopped.is_set():
+            frame = self.captured.get(IDLE_PERIOD)
+            if frame is not None:
+                start = self.clock()
+                try:
+                    image = self.process(frame.image)
+                except Exception:
+                    # a bad frame must not stop the pipeline, the next one is processed as usual
+                    logging.exception(f"{self.name} pipeline: failed to process frame {frame.number}")
+                    self.frames_failed += 1
+                else:
+                    done = self.clock()
+                    self.wait.record(start - frame.captured)
+                    self.processing.record(done - start)
+                    self.latency.record(done - frame.captured)
+                    self.frames_processed += 1
+                    if self.preview:
+                        self.processed.put(frame._replace(image=image))
+            now = self.clock()
+            if now - self._last_report >= self.report_interval:
+                self._report(now)
+
+    def show_preview(self):
+        """Show the processed frames until the pipeline is stopped or Esc is pressed, which stops it; headless,
+        only wait for the pipeline to stop. Runs on the calling thread, the main thread for most GUI backends.
+        """
+        if not self.preview:
+            self._stopped.wait()
+            return
+        period = 1 / self.preview_fps
+        while not self._stopped.is_set():
+            start = self.clock()
+            frame = self.processed.get(period)
+            if frame is None:
+                continue
+            cv2.imshow(self.name, cv2.resize(frame.image, PREVIEW_SIZE))
+            key = cv2.waitKey(1)
+            self.display.record(self.clock() - start)
+            self.frames_shown += 1
+            if key == QUIT_KEY:
+                self.stop()
+                break
+            # frames processed meanwhile are dropped for the newest
+            self._stopped.wait(max(start + period - self.clock(), 0.0))
+        cv2.destroyAllWindows()
+
+    def _report(self, now: float):
+        self._last_report = now
+        summary = self.summary()
+        logging.info(
+            f"{self.name} pipeline: {summary['captured']} frames captured, {summary['processed']} processed, "
+            f"{summary['failed']} failed, "
+            f"{summary['dropped']} dropped before processing, {summary['preview_dropped']} not previewed, "
+            f"latency p99 {summary['latency_p99'] * 1000:.1f} ms (wait {summary['wait_p99'] * 1000:.1f} ms, "
+            f"processing {summary['processing_p99'] * 1000:.1f} ms)"
+        )
+        if self.report is not None:
+            self.report(self)
+
+    def summary(self) -> dict:
+        return {
+            "captured": self.frames_captured,
+            "processed": self.frames_processed,
+            "failed": self.frames_failed,
+            "dropped": self.captured.dropped,
+            "shown": self.frames_shown,
+            "preview_dropped": self.processed.dropped if self.preview else 0,
+            "wait_p99": self.wait.percentile(99) or 0.0,
+            "processing_p99": self.processing.percentile(99) or 0.0,
+            "latency_p99": self.latency.percentile(99) or 0.0,
+        }
+
+    def export(self) -> dict[str, dict]:
+        """Histograms of the pipeline's stages (Histogram.export), by name"""
+        stages = {
+            f"{self.name}.wait": self.wait.export(),
+            f"{self.name}.processing": self.processing.export(),
+            f"{self.name}.latency": self.latency.export(),
+        }
+        if self.preview:
+            stages[f"{self.name}.display"] = self.display.export()
+        return stages
@@ -1,77 +1,150 @@
-from common import PackageColor, PackageData
+"""
+Generator of test order traces for the server
+
+Every aisle holds one package of each color, and every package ends up in exactly one order.
+"""
+
+import argparse
+import json
+import random
+import sys
+from typing import Iterator, TextIO
+
+from common import TIME_PER_ORDER, TIME_PER_PACKAGE, PackageColor, PackageData
 from server import TestOrderData
-import random, json
 
-# constants for deadline estimation specific to the setup geometry
-TIME_PER_ORDER = 10
-TIME_PER_PACKAGE = 10
+COLORS = list(PackageColor)
 
-if __name__ == "__main__":
-    min_orders = int(input("Minimum number of orders: "))
-    max_orders = int(input("Maximum number of orders: "))
-    min_packages = int(input("Minimum number of packages: "))
-    max_packages = int(input("Maximum number of packages: "))
-    num_aisles = int(input("Number of aisles: "))
-
-    # number of packages is too small/big
-    if (
-        min_orders * min_packages > num_aisles * 3
-        or max_orders * max_packages < num_aisles * 3
-    ):
-        print("Unsatisfiable constraints")
-        exit(1)
 
-    # each aisle has one package of each color
-    packages = [
-        {PackageColor.RED, PackageColor.GREEN, PackageColor.BLUE}
-        for _ in range(num_aisles)
-    ]
-    min_spacing = int(input("Minimum spacing between packages (seconds): "))
-    max_spacing = int(input("Maximum spacing between packages (seconds): "))
-    orders = list[TestOrderData]()
+def generate_orders(
+    min_orders: int,
+    max_orders: int,
+    min_packages: int,
+    max_packages: int,
+    num_aisles: int,
+    min_spacing: int,
+    max_spacing: int,
+    seed: int | None = None,
+) -> Iterator[TestOrderData]:
+    """Generate the orders of a trace one at a time
 
-    while any(packages):
-        packages_left = sum([len(aisle_packages) for aisle_packages in packages])
+    Packages are drawn uniformly from the remaining inventory by swapping the chosen one with the last and
+    popping it, so each pick costs O(1) however large the warehouse is.
+
+    :param seed: seed of the random generator, for reproducible traces
+    :raises ValueError: if the order and package limits cannot cover the inventory
+    """
+    # number of packages is too small/big (checked before the first order is asked for)
+    inventory_size = num_aisles * len(COLORS)
+    if min_orders * min_packages > inventory_size or max_orders * max_packages < inventory_size:
+        raise ValueError("Unsatisfiable constraints")
+    return _generate(
+        min_orders, max_orders, min_packages, max_packages, inventory_size, min_spacing, max_spacing, seed
+    )
+
+
+def _generate(
+    min_orders: int,
+    max_orders: int,
+    min_packages: int,
+    max_packages: int,
+    inventory_size: int,
+    min_spacing: int,
+    max_spacing: int,
+    seed: int | None,
+) -> Iterator[TestOrderData]:
+    rng = random.Random(seed)
+    # package i is the color i % 3 of aisle i // 3
+    inventory = list(range(inventory_size))
+    num_orders = 0
+    timestamp = 0
+
+    while inventory:
+        packages_left = len(inventory)
 
         # package number limits for this order taking into account the constraints on the next orders
-        actual_min_packages = max(
-            min_packages, packages_left - (max_orders - len(orders) - 1) * max_packages
-        )
+        actual_min_packages = max(min_packages, packages_left - (max_orders - num_orders - 1) * max_packages)
         actual_max_packages = min(
             max_packages,
             packages_left,
-            packages_left - (min_orders - len(orders) - 1) * min_packages,
+            packages_left - (min_orders - num_orders - 1) * min_packages,
         )
-        num_packages = random.randint(actual_min_packages, actual_max_packages)
+        num_packages = rng.randint(actual_min_packages, actual_max_packages)
         order_packages = list[PackageData]()
 
         # randomly choose from among the remaining packages
         for _ in range(num_packages):
-            available_packages = [
-                (i, color)
-                for i, aisle_packages in enumerate(packages)
-                for color in aisle_packages
-            ]
-            chosen_package = random.choice(available_packages)
-            order_packages.append(
-                {"aisle": chosen_package[0], "color": chosen_package[1]}
-            )
-            packages[chosen_package[0]].remove(chosen_package[1])
+            index = rng.randrange(len(inventory))
+            inventory[index], inventory[-1] = inventory[-1], inventory[index]
+            aisle, color = divmod(inventory.pop(), len(COLORS))
+            order_packages.append({"aisle": aisle, "color": COLORS[color]})
 
         # randomly choose the timestamp
-        timestamp = (
-            random.randint(min_spacing, max_spacing) + orders[-1]["time"]
-            if orders
-            else 0
-        )
+        if num_orders:
+            timestamp += rng.randint(min_spacing, max_spacing)
 
         # rough estimation for the appropriate deadline
         difficulty = TIME_PER_ORDER + TIME_PER_PACKAGE * num_packages
-        deadline = random.randint(timestamp + difficulty, timestamp + difficulty * 3)
+        deadline = rng.randint(timestamp + difficulty, timestamp + difficulty * 3)
+
+        num_orders += 1
+        yield {"time": timestamp, "deadline": deadline, "packages": order_packages}
+
+
+def write_orders(orders: Iterator[TestOrderData], f: TextIO, lines: bool = False) -> int:
+    """Write orders as they are generated, as JSON lines or as a JSON array
+
+    :return: number of orders written
+    """
+    count = 0
+    if lines:
+        for order in orders:
+            f.write(json.dumps(order))
+            f.write("\n")
+            count += 1
+        return count
+    f.write("[")
+    for order in orders:
+        f.write(",\n  " if count else "\n  ")
+        f.write(json.dumps(order))
+        count += 1
+    f.write("\n]\n")
+    return count
 
-        orders.append(
-            {"time": timestamp, "deadline": deadline, "packages": order_packages}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a test order trace for the server")
+    parser.add_argument("--min-orders", type=int, required=True, help="minimum number of orders")
+    parser.add_argument("--max-orders", type=int, required=True, help="maximum number of orders")
+    parser.add_argument("--min-packages", type=int, default=1, help="minimum number of packages per order")
+    parser.add_argument("--max-packages", type=int, default=3, help="maximum number of packages per order")
+    parser.add_argument("--aisles", type=int, default=3, help="number of aisles")
+    parser.add_argument("--min-spacing", type=int, default=0, help="minimum spacing between orders (seconds)")
+    parser.add_argument("--max-spacing", type=int, default=30, help="maximum spacing between orders (seconds)")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument(
+        "-o", "--output", default="-", help="output file, JSON lines if it ends in .jsonl, - for stdout"
+    )
+    parser.add_argument("--jsonl", action="store_true", help="write JSON lines whatever the output name")
+    args = parser.parse_args()
+
+    try:
+        orders = generate_orders(
+            args.min_orders,
+            args.max_orders,
+            args.min_packages,
+            args.max_packages,
+            args.aisles,
+            args.min_spacing,
+            args.max_spacing,
+            args.seed,
         )
-    filename = input("Output filename: ")
-    with open(filename, "w") as f:
-        json.dump(orders, f, indent=2)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        exit(1)
+    lines = args.jsonl or args.output.endswith(".jsonl")
+    if args.output == "-":
+        write_orders(orders, sys.stdout, lines)
+    else:
+        with open(args.output, "w") as f:
+            write_orders(orders, f, lines)
@@ -0,0 +1,558 @@
+"""
+Hardware abstraction layer for the TurboPi drivers
+
+The robot processes get their chassis, expansion board, IR line sensor, sonar and camera from here instead of
+importing the HiwonderSDK directly. DELIVERPI_HAL selects the backend:
+    hiwonder  the drivers of the robot (default), imported only when asked for
+    sim       simulated drivers, so the whole stack runs on a plain Linux box
+
+The simulated drivers share a single world between the processes of a robot: the pose of the chassis, the last
+velocity command, the camera servos and the obstacles live in a small memory-mapped file (DELIVERPI_SIM_STATE)
+guarded by a file lock. Nothing steps the world in the background; whoever touches it first advances the pose
+to the current time under the last command. The chassis does not reach a commanded velocity instantly but
+approaches it with a time constant, so like the real robot it coasts a little past where it was told to stop.
+
+The track is built from an AisleLayout: the main line runs from the hub along +x with the aisles branching off
+to its left (+y), a bar across the line marks the hub and another the dead end of every aisle. Packages are
+colored blocks standing beside their slot, on the left of the aisle when entering it.
+"""
+
+import fcntl
+import logging
+import math
+import mmap
+import os
+import sys
+import tempfile
+import threading
+import time
+from enum import StrEnum
+from typing import Callable, Protocol
+
+import numpy as np
+
+from common import PackageColor
+from route_planner import AisleLayout
+
+
+class Backend(StrEnum):
+    """Driver implementations selectable with DELIVERPI_HAL"""
+
+    HIWONDER = "hiwonder"
+    SIM = "sim"
+
+
+BACKEND = Backend(os.environ.get("DELIVERPI_HAL", Backend.HIWONDER))
+SIMULATED = BACKEND == Backend.SIM
+SDK_PATH = "/home/pi/TurboPi/"
+
+
+class Chassis(Protocol):
+    def set_velocity(self, velocity: float, direction: float, angular_rate: float):
+        """Drive at velocity (mm/s) towards direction (degrees, 90 is forward), turning at angular_rate
+        (positive turns right)"""
+
+
+class Board(Protocol):
+    def set_buzzer(self, freq: int, on_time: float, off_time: float, repeat: int = 1): ...
+
+    def set_rgb(self, pixels: list[list[int]]):
+        """Set the LEDs, pixels is a list of [index, r, g, b]"""
+
+    def pwm_servo_set_position(self, duration: float, positions: list[list[int]]):
+        """Move servos, positions is a list of [servo id, pulse width]"""
+
+
+class LineSensor(Protocol):
+    def readData(self) -> list[bool]:
+        """Whether each of the four sensors, from left to right, is over the line"""
+
+
+class Sonar(Protocol):
+    def getDistance(self) -> float:
+        """Distance to the nearest obstacle ahead (mm)"""
+
+
+class Camera(Protocol):
+    # latest frame (BGR), None until the camera is open
+    frame: np.ndarray | None
+
+    def camera_open(self, correction: bool = False): ...
+
+    def camera_close(self): ...
+
+
+def _sdk():
+    if SDK_PATH not in sys.path:
+        sys.path.append(SDK_PATH)
+
+
+def chassis() -> Chassis:
+    if SIMULATED:
+        return SimChassis()
+    _sdk()
+    import HiwonderSDK.mecanum as mecanum
+
+    return mecanum.MecanumChassis()
+
+
+def board() -> Board:
+    if SIMULATED:
+        return SimBoard()
+    _sdk()
+    import HiwonderSDK.ros_robot_controller_sdk as rrc
+
+    return rrc.Board()
+
+
+def line_sensor() -> LineSensor:
+    if SIMULATED:
+        return SimLineSensor()
+    _sdk()
+    import HiwonderSDK.FourInfrared as infrared
+
+    return infrared.FourInfrared()
+
+
+def sonar() -> Sonar:
+    if SIMULATED:
+        return SimSonar()
+    _sdk()
+    import HiwonderSDK.Sonar as HWSonar
+
+    return HWSonar.Sonar()
+
+
+def camera() -> Camera:
+    if SIMULATED:
+        return SimCamera()
+    _sdk()
+    import Camera as HWCamera
+
+    return HWCamera.Camera()
+
+
+def load_config() -> tuple[dict, dict]:
+    """LAB color thresholds and servo positions of the camera"""
+    if SIMULATED:
+        return SIM_LAB_DATA, {"servo1": CENTER_PULSE, "servo2": CENTER_PULSE}
+    _sdk()
+    import yaml_handle
+
+    return (
+        yaml_handle.get_yaml_data(yaml_handle.lab_file_path),
+        yaml_handle.get_yaml_data(yaml_handle.servo_file_path),
+    )
+
+
+# --- simulator ---
+
+# file holding the shared state of the simulated robot
+SIM_STATE_PATH = os.environ.get(
+    "DELIVERPI_SIM_STATE",
+    os.path.join("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), "deliverpi_sim"),
+)
+# number of aisles of the simulated track
+SIM_AISLES = int(os.environ.get("DELIVERPI_SIM_AISLES", "3"))
+# packages missing from the simulated shelves, as aisle:color pairs separated by commas (e.g. "1:RED,2:BLUE")
+SIM_MISSING = os.environ.get("DELIVERPI_SIM_MISSING", "")
+
+# length of a layout distance unit on the simulated track (cm)
+TRACK_SCALE = 50.0
+LINE_HALF_WIDTH = 1.25
+# half the length of the bars marking the hub and the aisle ends (cm)
+BAR_HALF_LENGTH = 8.0
+# chassis speed per unit of commanded velocity (cm/s) and turn rate per unit of angular rate (rad/s)
+SPEED_SCALE = 1.0
+TURN_SCALE = 2.8
+# time constants of the chassis reaching a commanded speed and turn rate, and the step the motion is
+# integrated with (s)
+CHASSIS_LAG = 0.15
+TURN_LAG = 0.03
+SIM_STEP = 0.005
+# sensor positions relative to the center of the robot (cm, forward and left)
+IR_FORWARD = 8.0
+IR_OFFSETS = (3.0, 1.0, -1.0, -3.0)
+SONAR_FORWARD = 9.0
+SONAR_HALF_ANGLE = math.radians(15)
+SONAR_MAX_RANGE = 500.0
+MAX_OBSTACLES = 8
+# packages are cubes of this side standing this far to the side of the aisle line (cm)
+BLOCK_SIZE = 5.0
+BLOCK_OFFSET = 15.0
+# camera geometry: frame size, focal length (px) and how far it sees (cm)
+FRAME_SIZE = (640, 480)
+FOCAL_LENGTH = 300.0
+CAMERA_NEAR = 3.0
+CAMERA_RANGE = 80.0
+CAMERA_FPS = 30
+# servo pulse widths: centered, and the swing that pans the camera by 90 degrees
+CENTER_PULSE = 1500
+PAN_PULSE_PER_QUARTER_TURN = 1000
+PAN_SERVO = 2
+FLOOR_BGR = (170, 170, 170)
+BLOCK_BGR = {
+    PackageColor.RED: (30, 30, 200),
+    PackageColor.GREEN: (40, 180, 40),
+    PackageColor.BLUE: (200, 60, 30),
+}
+# slack of the LAB thresholds around the block colors
+LAB_MARGIN = 25
+
+
+def _lab_thresholds() -> dict:
+    import cv2
+
+    thresholds = {}
+    for color, bgr in BLOCK_BGR.items():
+        lab = cv2.cvtColor(np.uint8([[bgr]]), cv2.COLOR_BGR2LAB)[0, 0].astype(int)
+        # color_detect looks colors up in lower case, like the thresholds file of the robot
+        thresholds[color.value.lower()] = {
+            "min": [max(0, int(v) - LAB_MARGIN) for v in lab],
+            "max": [min(255, int(v) + LAB_MARGIN) for v in lab],
+        }
+    return thresholds
+
+
+SIM_LAB_DATA = _lab_thresholds() if SIMULATED else {}
+
+
+class SimTrack:
+    """Line segments and package blocks of the simulated warehouse"""
+
+    def __init__(self, layout: AisleLayout, missing: set[tuple[int, str]] = frozenset()):
+        self.layout = layout
+        self.start = (layout.hub_distance * TRACK_SCALE / 5, 0.0, 0.0)
+        length = layout.aisle_length * TRACK_SCALE
+        end = (layout.position(layout.num_aisles - 1) + layout.aisle_spacing / 2) * TRACK_SCALE
+        # segments as rows of x0, y0, x1, y1
+        segments = [(0.0, 0.0, end, 0.0), (0.0, -BAR_HALF_LENGTH, 0.0, BAR_HALF_LENGTH)]
+        blocks = []
+        for aisle in range(layout.num_aisles):
+            x = layout.position(aisle) * TRACK_SCALE
+            segments.append((x, 0.0, x, length))
+            segments.append((x - BAR_HALF_LENGTH, length, x + BAR_HALF_LENGTH, length))
+            for color in PackageColor:
+                if (aisle, color.value) not in missing:
+                    depth = layout.slot_depths[color] * TRACK_SCALE
+                    blocks.append((x - BLOCK_OFFSET, depth, color))
+        self.segments = np.array(segments)
+        self.blocks = blocks
+
+    def on_line(self, points: np.ndarray) -> np.ndarray:
+        """Whether each of the points (rows of x, y) is over the line"""
+        start = self.segments[:, :2]
+        direction = self.segments[:, 2:] - start
+        length2 = (direction**2).sum(axis=1)
+        relative = points[:, None, :] - start[None, :, :]
+        t = np.clip((relative * direction).sum(axis=2) / length2, 0.0, 1.0)
+        nearest = start + t[:, :, None] * direction
+        distance2 = ((points[:, None, :] - nearest) ** 2).sum(axis=2)
+        return (distance2 <= LINE_HALF_WIDTH**2).any(axis=1)
+
+
+def _parse_missing(spec: str) -> set[tuple[int, str]]:
+    missing = set()
+    for item in filter(None, spec.split(",")):
+        aisle, color = item.split(":")
+        missing.add((int(aisle), PackageColor(color.strip().upper()).value))
+    return missing
+
+
+TRACK = SimTrack(AisleLayout(SIM_AISLES), _parse_missing(SIM_MISSING)) if SIMULATED else None
+
+# layout of the shared state, in float64 slots
+_INITIALIZED, _TIME, _X, _Y, _HEADING, _VELOCITY, _DIRECTION, _ANGULAR_RATE, _PAN = range(9)
+# velocities the chassis actually moves at: forward, to the right (cm/s) and turn rate (rad/s, counterclockwise)
+_FORWARD, _RIGHT, _OMEGA = range(9, 12)
+_OBSTACLES = 12
+_STATE_SLOTS = _OBSTACLES + 3 * MAX_OBSTACLES
+
+
+class SimWorld:
+    """Shared state of the simulated robot, one per process"""
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(
+        self,
+        path: str = SIM_STATE_PATH,
+        track: SimTrack | None = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """
+        :param path: file holding the state shared by the robot processes
+        :param track: track driven on, defaults to the warehouse of DELIVERPI_SIM_AISLES aisles
+        :param clock: time source, replaceable to run the simulation faster than real time
+        """
+        self.track = track or TRACK or SimTrack(AisleLayout(SIM_AISLES))
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._file = open(path, "a+b")
+        size = _STATE_SLOTS * 8
+        with self:
+            if os.fstat(self._file.fileno()).st_size < size:
+                self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), size)
+        self.state = np.ndarray(_STATE_SLOTS, dtype=np.float64, buffer=self._map)
+        with self:
+            if not self.state[_INITIALIZED]:
+                self._reset()
+
+    @classmethod
+    def get(cls) -> "SimWorld":
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = SimWorld()
+            return cls._instance
+
+    def __enter__(self):
+        self._lock.acquire()
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        self._lock.release()
+
+    def _reset(self):
+        self.state[:] = 0.0
+        self.state[_X], self.state[_Y], self.state[_HEADING] = self.track.start
+        self.state[_DIRECTION] = 90.0
+        self.state[_PAN] = CENTER_PULSE
+        self.state[_TIME] = self.clock()
+        self.state[_INITIALIZED] = 1.0
+
+    def reset(self):
+        """Put the robot back at the hub, stopped, and remove the obstacles"""
+        with self:
+            self._reset()
+
+    def _advance(self):
+        """Move the robot to where the last command took it by now (lock held)"""
+        s = self.state
+        now = self.clock()
+        dt = now - s[_TIME]
+        s[_TIME] = now
+        direction = math.radians(s[_DIRECTION])
+        target = (
+            s[_VELOCITY] * SPEED_SCALE * math.sin(direction),
+            s[_VELOCITY] * SPEED_SCALE * math.cos(direction),
+            -s[_ANGULAR_RATE] * TURN_SCALE,
+        )
+        forward, right, omega = s[_FORWARD], s[_RIGHT], s[_OMEGA]
+        x, y, heading = s[_X], s[_Y], s[_HEADING]
+        while dt > 0 and (forward or right or omega or any(target)):
+            step = min(dt, SIM_STEP)
+            dt -= step
+            blend = 1 - math.exp(-step / CHASSIS_LAG)
+            forward += (target[0] - forward) * blend
+            right += (target[1] - right) * blend
+            omega += (target[2] - omega) * (1 - math.exp(-step / TURN_LAG))
+            if not any(target) and abs(forward) + abs(right) < 1e-3 and abs(omega) < 1e-4:
+                forward = right = omega = 0.0
+            # exact motion along the arc driven during the step
+            if abs(omega) < 1e-9:
+                x += (forward * math.cos(heading) + right * math.sin(heading)) * step
+                y += (forward * math.sin(heading) - right * math.cos(heading)) * step
+            else:
+                end = heading + omega * step
+                dsin = math.sin(end) - math.sin(heading)
+                dcos = math.cos(end) - math.cos(heading)
+                x += (forward * dsin - right * dcos) / omega
+                y += (-forward * dcos - right * dsin) / omega
+                heading = end
+        s[_FORWARD], s[_RIGHT], s[_OMEGA] = forward, right, omega
+        s[_X], s[_Y], s[_HEADING] = x, y, math.remainder(heading, math.tau)
+
+    def command(self, velocity: float, direction: float, angular_rate: float):
+        with self:
+            self._advance()
+            self.state[_VELOCITY] = velocity
+            self.state[_DIRECTION] = direction
+            self.state[_ANGULAR_RATE] = angular_rate
+
+    def place(self, x: float, y: float, heading: float):
+        """Put the robot at a pose, stopped"""
+        with self:
+            self._advance()
+            self.state[_X], self.state[_Y], self.state[_HEADING] = x, y, heading
+            self.state[_VELOCITY] = self.state[_ANGULAR_RATE] = 0.0
+            self.state[_FORWARD] = self.state[_RIGHT] = self.state[_OMEGA] = 0.0
+
+    def pose(self) -> tuple[float, float, float]:
+        """x, y (cm) and heading (radians, counterclockwise from +x) of the robot"""
+        with self:
+            self._advance()
+            return self.state[_X], self.state[_Y], self.state[_HEADING]
+
+    def set_pan(self, pulse: float):
+        with self:
+            self.state[_PAN] = pulse
+
+    def pan(self) -> float:
+        """Angle of the camera from straight ahead (radians, positive to the left)"""
+        pulse = min(max(self.state[_PAN], CENTER_PULSE - PAN_PULSE_PER_QUARTER_TURN), CENTER_PULSE + PAN_PULSE_PER_QUARTER_TURN)
+        return (pulse - CENTER_PULSE) / PAN_PULSE_PER_QUARTER_TURN * math.pi / 2
+
+    def add_obstacle(self, x: float, y: float, radius: float):
+        """Place a round obstacle on the track (cm)
+
+        :raises ValueError: if there are already MAX_OBSTACLES obstacles
+        """
+        with self:
+            for i in range(_OBSTACLES, _STATE_SLOTS, 3):
+                if not self.state[i + 2]:
+                    self.state[i : i + 3] = (x, y, radius)
+                    return
+        raise ValueError("too many obstacles")
+
+    def clear_obstacles(self):
+        with self:
+            self.state[_OBSTACLES:] = 0.0
+
+    def obstacles(self) -> np.ndarray:
+        """Rows of x, y, radius of the obstacles on the track"""
+        obstacles = self.state[_OBSTACLES:].reshape(-1, 3)
+        return obstacles[obstacles[:, 2] > 0].copy()
+
+
+def reset_simulator():
+    """Put the simulated robot back at the hub"""
+    SimWorld.get().reset()
+
+
+class SimChassis:
+    def __init__(self, world: SimWorld | None = None):
+        self.world = world or SimWorld.get()
+
+    def set_velocity(self, velocity: float, direction: float, angular_rate: float):
+        self.world.command(velocity, direction, angular_rate)
+
+
+class SimBoard:
+    def __init__(self):
+        self.world = SimWorld.get()
+
+    def set_buzzer(self, freq: int, on_time: float, off_time: float, repeat: int = 1):
+        logging.debug(f"buzzer {freq} Hz for {on_time} s")
+
+    def set_rgb(self, pixels: list[list[int]]):
+        logging.debug(f"leds {pixels}")
+
+    def pwm_servo_set_position(self, duration: float, positions: list[list[int]]):
+        for servo, pulse in positions:
+            if servo == PAN_SERVO:
+                self.world.set_pan(pulse)
+
+
+class SimLineSensor:
+    def __init__(self, world: SimWorld | None = None):
+        self.world = world or SimWorld.get()
+        self.offsets = np.array([(IR_FORWARD, offset) for offset in IR_OFFSETS])
+
+    def readData(self) -> list[bool]:
+        x, y, heading = self.world.pose()
+        c, s = math.cos(heading), math.sin(heading)
+        rotation = np.array([[c, s], [-s, c]])
+        points = self.offsets @ rotation + (x, y)
+        return self.world.track.on_line(points).tolist()
+
+
+class SimSonar:
+    def __init__(self):
+        self.world = SimWorld.get()
+
+    def getDistance(self) -> float:
+        x, y, heading = self.world.pose()
+        x += SONAR_FORWARD * math.cos(heading)
+        y += SONAR_FORWARD * math.sin(heading)
+        nearest = SONAR_MAX_RANGE
+        for ox, oy, radius in self.world.obstacles():
+            dx, dy = ox - x, oy - y
+            bearing = abs(math.remainder(math.atan2(dy, dx) - heading, math.tau))
+            if bearing <= SONAR_HALF_ANGLE:
+                nearest = min(nearest, max(0.0, math.hypot(dx, dy) - radius))
+        return nearest * 10
+
+
+class SimCamera:
+    """Renders the package blocks in view, at most CAMERA_FPS times a second"""
+
+    def __init__(self):
+        self.world = SimWorld.get()
+        self._open = False
+        self._frame = None
+        self._rendered = 0.0
+
+    def camera_open(self, correction: bool = False):
+        self._open = True
+
+    def camera_close(self):
+        self._open = False
+
+    @property
+    def frame(self) -> np.ndarray | None:
+        if not self._open:
+            return None
+        now = time.monotonic()
+        if self._frame is None or now - self._rendered >= 1 / CAMERA_FPS:
+            self._frame = self.render()
+            self._rendered = now
+        return self._frame
+
+    def render(self) -> np.ndarray:
+        import cv2
+
+        width, height = FRAME_SIZE
+        frame = np.empty((height, width, 3), dtype=np.uint8)
+        frame[:] = FLOOR_BGR
+        x, y, heading = self.world.pose()
+        view = heading + self.world.pan()
+        c, s = math.cos(view), math.sin(view)
+        # farthest first, so nearer blocks are drawn over them
+        visible = []
+        for bx, by, color in self.world.track.blocks:
+            forward = (bx - x) * c + (by - y) * s
+            left = -(bx - x) * s + (by - y) * c
+            if CAMERA_NEAR < forward < CAMERA_RANGE:
+                visible.append((forward, left, color))
+        for forward, left, color in sorted(visible, reverse=True):
+            u = width / 2 - FOCAL_LENGTH * left / forward
+            half = FOCAL_LENGTH * BLOCK_SIZE / forward / 2
+            top_left = (int(u - half), int(height / 2 - half))
+            bottom_right = (int(u + half), int(height / 2 + half))
+            cv2.rectangle(frame, top_left, bottom_right, BLOCK_BGR[color], -1)
+        return frame
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Inspect and control the simulated robot")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("pose", help="print the pose and sensor readings of the robot")
+    subparsers.add_parser("reset", help="put the robot back at the hub and remove the obstacles")
+    obstacle = subparsers.add_parser("obstacle", help="place an obstacle on the track")
+    obstacle.add_argument("x", type=float)
+    obstacle.add_argument("y", type=float)
+    obstacle.add_argument("radius", type=float, nargs="?", default=5.0)
+    subparsers.add_parser("clear", help="remove the obstacles")
+    args = parser.parse_args()
+
+    if not SIMULATED:
+        print("set DELIVERPI_HAL=sim to use the simulator", file=sys.stderr)
+        exit(1)
+    world = SimWorld.get()
+    match args.command:
+        case "pose":
+            x, y, heading = world.pose()
+            print(f"x={x:.1f} cm y={y:.1f} cm heading={math.degrees(heading):.0f} deg")
+            print(f"line sensors: {SimLineSensor().readData()}, sonar: {SimSonar().getDistance():.0f} mm")
+        case "reset":
+            world.reset()
+        case "obstacle":
+            world.add_obstacle(args.x, args.y, args.radius)
+        case "clear":
+            world.clear_obstacles()
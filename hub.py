@@ -1,6 +1,8 @@
-import heapq
+import json
 import logging
 import threading
+import time
+from collections import deque
 # from typing import override # can cause problems due to missing package
 import zmq
 from common import (
@@ -8,85 +10,303 @@ from common import (
     HUB_PORT,
     SERVER_PORT,
     OrderData,
-    validate_order_data,
+    OrderValidator,
+    StatusEventType,
+    validate_order_command,
+    validate_status_event,
 )
+from aggregator import StatusAggregator
+from batching import build_trip
+from scheduler import HopelessPolicy, Scheduler, SchedulingPolicy
+from wal import WriteAheadLog
+import wire
 
 # server and robot hostnames to connect to
 SERVER_HOST = "localhost"
 CONTROLLER_HOST = "localhost"
 
+# directory for the hub's write-ahead log and snapshots
+WAL_DIR = "hub_wal"
+
+# how long a single poll may block before the stop flag is checked again (ms)
+POLL_TIMEOUT = 100
+
+
+def robot_name(identity: bytes) -> str:
+    """Printable name for a robot's socket identity (ROUTER generated identities are binary)"""
+    return identity.hex() if identity[:1] == b"\x00" else identity.decode(errors="replace")
+
 
 class HubThread(threading.Thread):
     """
     Delivery hub thread
 
     Responsible for keeping track of the orders received from the central server,
-    scheduling the orders requested by the robot, and receiving status updates from it.
+    dispatching the orders requested by the robots of the fleet, and receiving status updates from them.
+
+    Robots request orders over a ROUTER socket, so any number of them can have a request outstanding at once.
+    A request that cannot be served immediately is parked until an order arrives instead of being answered
+    with an empty reply. The scheduler picks the order each trip is built around, compatible queued orders are
+    batched into the same trip (see batching.build_trip), and the hub remembers which robot holds which orders
+    until that robot asks for its next trip.
+
+    Order deadlines are interpreted as seconds since the hub started, the same clock the server uses for them.
+
+    Robots publish typed status events (see common.StatusEvent) which are aggregated into rolling fleet metrics.
+    Besides an order request (empty, or wire.HELLO from a robot that wants its trips in the binary format), a
+    client may send {"command": "stats"} on the hub socket to get the current metrics and scheduling report back.
+    Orders and status events are accepted both in JSON and in the binary format, see wire.py.
+
+    If a write-ahead log directory is given, the order state is persisted there and recovered on startup.
     """
 
-    def __init__(self, server_host: str, server_port: int, hub_port: int):
+    def __init__(
+        self,
+        server_host: str,
+        server_port: int,
+        hub_port: int,
+        controller_hosts: list[str] | None = None,
+        policy: SchedulingPolicy = SchedulingPolicy.EDF,
+        hopeless: HopelessPolicy = HopelessPolicy.KEEP,
+        wal_dir: str | None = None,
+    ):
         super().__init__(name="HUB")
         self.server_host: str = server_host
         self.server_port: int = server_port
         self.hub_port: int = hub_port
-        self.orders: list[tuple[int, OrderData]] = []
+        self.scheduler = Scheduler(policy, hopeless)
+        self.aggregator = StatusAggregator()
+        self.validator = OrderValidator()
+        self.orders = self.scheduler.orders
+
+        # robots waiting for an order, in the order they asked
+        self.waiting_robots: deque[bytes] = deque()
+        # the trip each robot is currently working on
+        self.assignments: dict[bytes, OrderData] = {}
+        # format each robot asked for its trips in
+        self.wire_formats: dict[bytes, wire.WireFormat] = {}
+        # wire version negotiated with every robot that announced binary support
+        self.wire_versions: dict[bytes, int] = {}
+        self.epoch: float = time.time()
+        self._stop_event = threading.Event()
+
+        self.wal: WriteAheadLog | None = None
+        if wal_dir is not None:
+            self.wal = WriteAheadLog(wal_dir)
+            self.wal.recover(self.scheduler, self.assignments)
+            # keep the clock of the hub before the restart, the recovered deadlines and trips are on it
+            if self.wal.epoch is not None:
+                self.epoch = self.wal.epoch
+            self.wal.log_epoch(self.epoch)
 
         self.ctx = zmq.Context()
         self.server_sock = self.ctx.socket(zmq.SUB)
         self.server_sock.connect(f"tcp://{self.server_host}:{self.server_port}")
         self.server_sock.setsockopt_string(zmq.SUBSCRIBE, "")
-        self.hub_sock = self.ctx.socket(zmq.REP)
+        self.hub_sock = self.ctx.socket(zmq.ROUTER)
+        # fail loudly when a robot has disconnected instead of silently dropping its order
+        self.hub_sock.setsockopt(zmq.ROUTER_MANDATORY, 1)
         self.hub_sock.bind(f"tcp://*:{self.hub_port}")
         self.controller_sock = self.ctx.socket(zmq.SUB)
-        self.controller_sock.connect(f"tcp://{CONTROLLER_HOST}:{CONTROLLER_PORT}")
+        for host in controller_hosts or [CONTROLLER_HOST]:
+            self.controller_sock.connect(f"tcp://{host}:{CONTROLLER_PORT}")
         self.controller_sock.setsockopt_string(zmq.SUBSCRIBE, "")
 
+    def clock(self) -> float:
+        """Current time on the clock the order deadlines are expressed in"""
+        return time.time() - self.epoch
+
+    def stop(self):
+        """Ask the hub loop to exit after its current poll"""
+        self._stop_event.set()
+
+    def handle_server_message(self, data):
+        """Queue a new order or apply a cancellation/deadline update sent by the server"""
+        if self.validator.is_valid(data):
+            if self.scheduler.push(data) is None:
+                logging.debug(f"duplicate order ignored: {data['id']}")
+                return
+            if self.wal is not None:
+                self.wal.log_arrival(data)
+            logging.info(f"order received: {data}")
+        elif validate_order_command(data):
+            if data["command"] == "cancel":
+                if self.scheduler.cancel(data["id"]) is not None:
+                    if self.wal is not None:
+                        self.wal.log_cancel(data["id"])
+                    logging.info(f"order cancelled: {data['id']}")
+                else:
+                    logging.warning(f"cannot cancel order {data['id']}: not queued")
+            elif self.scheduler.update_deadline(data["id"], data["deadline"]):
+                if self.wal is not None:
+                    self.wal.log_update(self.orders.get(data["id"]))
+                logging.info(f"order {data['id']} deadline updated to {data['deadline']}")
+            else:
+                logging.warning(f"cannot update order {data['id']}: not queued")
+        else:
+            logging.error(f"invalid order received: {data}: {self.validator.errors(data)}")
+
+    def _recv_orders(self):
+        """Drain every order the server has published since the last poll"""
+        while True:
+            try:
+                frames = self.server_sock.recv_multipart(zmq.NOBLOCK, copy=False)
+            except zmq.Again:
+                return
+            try:
+                data = wire.decode(frames)
+            except ValueError:
+                logging.error("invalid order received")
+                continue
+            self.handle_server_message(data)
+
+    def stats(self) -> dict:
+        """Current fleet metrics and scheduling report"""
+        return {
+            "fleet": self.aggregator.snapshot(self.clock()),
+            "scheduling": self.scheduler.report(),
+            "waiting_robots": len(self.waiting_robots),
+        }
+
+    def _recv_requests(self):
+        """Drain every pending order request from the robots"""
+        while True:
+            try:
+                robot, empty, payload = self.hub_sock.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            if wire.is_binary(payload):
+                try:
+                    self.wire_versions[robot] = wire.peer_version(payload)
+                    self.wire_formats[robot] = wire.WireFormat.BINARY
+                except ValueError:
+                    self.wire_formats[robot] = wire.WireFormat.JSON
+            elif payload:
+                self._handle_query(robot, payload)
+                continue
+            else:
+                self.wire_formats[robot] = wire.WireFormat.JSON
+            # a robot only asks for a new order once it has finished its previous one
+            # (a no-op for the scheduler if the robot already reported the dropoff)
+            finished = self.assignments.pop(robot, None)
+            if finished is not None:
+                self.scheduler.completed(finished["id"], self.clock())
+                if self.wal is not None:
+                    self.wal.log_complete(robot)
+                logging.info(f"robot {robot_name(robot)} finished order: {finished}")
+            logging.debug(f"request from car {robot_name(robot)}")
+            self.waiting_robots.append(robot)
+
+    def _handle_query(self, client: bytes, payload: bytes):
+        """Answer a command sent on the hub socket instead of an order request"""
+        try:
+            command = json.loads(payload)["command"]
+        except (ValueError, KeyError, TypeError):
+            command = None
+        if command == "stats":
+            reply = self.stats()
+        else:
+            logging.error(f"invalid request from {robot_name(client)}: {payload}")
+            reply = {"error": "unknown command"}
+        try:
+            self.hub_sock.send_multipart([client, b"", json.dumps(reply).encode()])
+        except zmq.ZMQError:
+            logging.warning(f"client {robot_name(client)} unreachable")
+
+    def _recv_status(self):
+        """Drain every status update published by the robots"""
+        while True:
+            try:
+                frames = self.controller_sock.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            logging.debug("status update from car")
+            msg = b"".join(frames)
+            if self.wal is not None:
+                self.wal.log_status(msg)
+            try:
+                event = wire.decode(frames)
+            except ValueError:
+                event = None
+            if not validate_status_event(event):
+                logging.error(f"invalid status update: {msg}")
+                continue
+            logging.info(f"status update: {event}")
+            now = self.clock()
+            self.aggregator.record(event, now)
+            if event["type"] == StatusEventType.DROPOFF:
+                self.scheduler.completed(event["order_id"], now)
+
+    def _dispatch(self):
+        """Hand out trips to waiting robots, built around the order chosen by the scheduler"""
+        while self.waiting_robots and self.scheduler:
+            now = self.clock()
+            primary = self.scheduler.next_order(now)
+            if primary is None:
+                break
+            robot = self.waiting_robots.popleft()
+            data, members = build_trip(primary, self.orders, now, estimate=self.scheduler.service_time)
+            frames = wire.encode(
+                data,
+                wire.MessageKind.ORDER,
+                self.wire_formats.get(robot, wire.WireFormat.JSON),
+                self.wire_versions.get(robot, wire.WIRE_VERSION),
+            )
+            try:
+                self.hub_sock.send_multipart([robot, b"", *frames], copy=False)
+            except zmq.ZMQError:
+                # the robot went away while waiting, keep the orders for someone else
+                logging.warning(f"robot {robot_name(robot)} unreachable, requeueing orders")
+                for order in members:
+                    self.scheduler.requeue(order)
+                continue
+            self.assignments[robot] = data
+            self.scheduler.dispatched(data, members, now)
+            for order in members:
+                self.aggregator.expect(order["id"], order["deadline"])
+            if self.wal is not None:
+                self.wal.log_dispatch(robot, data, now)
+            logging.info(f"order sent to {robot_name(robot)}: {data}")
+
     # @override
     def run(self):
         logging.info("starting")
         poller = zmq.Poller()
-        poller.register(self.server_sock)
-        poller.register(self.hub_sock)
-        poller.register(self.controller_sock)
+        poller.register(self.server_sock, zmq.POLLIN)
+        poller.register(self.hub_sock, zmq.POLLIN)
+        poller.register(self.controller_sock, zmq.POLLIN)
 
-        while True:
+        # orders recovered from a snapshot but not loaded yet are loaded between polls
+        loading = True
+        while not self._stop_event.is_set():
             try:
-                socks = dict(poller.poll())
+                socks = dict(poller.poll(0 if loading else POLL_TIMEOUT))
             except KeyboardInterrupt:
                 logging.debug("keyboard interrupt")
                 break
 
-            # receiving an order from the server
+            # receiving orders from the server
             if self.server_sock in socks:
                 logging.debug("data from server")
-                try:
-                    data = self.server_sock.recv_json()
-                    if validate_order_data(data):
-                        # add the order to the internal min-heap based on its deadline
-                        heapq.heappush(self.orders, (data["deadline"], data))
-                        logging.info(f"order received: {data}")
-                    else:
-                        logging.error(f"invalid order received: {data}")
-                except:
-                    logging.error("invalid order received")
-
-            # receiving an order request from the robot
+                self._recv_orders()
+
+            # receiving order requests from the robots
             if self.hub_sock in socks:
-                logging.debug("request from car")
-                try:
-                    self.hub_sock.recv()
-                    # pop the next order and send it to the robot
-                    data = heapq.heappop(self.orders)[1]
-                    self.hub_sock.send_json(data)
-                    logging.info(f"order sent: {data}")
-                except IndexError:
-                    self.hub_sock.send(b"")
-                    logging.info("no orders available")
-
-            # receiving a status update from the robot
+                self._recv_requests()
+
+            self._dispatch()
+
+            # receiving status updates from the robots
             if self.controller_sock in socks:
-                logging.debug("status update from car")
-                logging.info(f"status update: {self.controller_sock.recv_string()}")
+                self._recv_status()
+
+            if loading:
+                loading = self.orders.load_cold() | self.scheduler.deferred.load_cold()
+            if self.wal is not None:
+                self.wal.maybe_snapshot(self.scheduler, self.assignments)
+        if self.wal is not None:
+            self.wal.close()
+        logging.info(f"scheduling report: {self.scheduler.report()}")
         logging.info("shutting down")
 
 
@@ -94,5 +314,5 @@ if __name__ == "__main__":
     logging.basicConfig(
         level=logging.DEBUG, format="[{threadName}]: {message}", style="{"
     )
-    t = HubThread(SERVER_HOST, SERVER_PORT, HUB_PORT)
+    t = HubThread(SERVER_HOST, SERVER_PORT, HUB_PORT, wal_dir=WAL_DIR)
     t.start()
@@ -0,0 +1,126 @@
+"""
+Filtering of the line sensor readings
+
+The IR array occasionally sees black where there is none, for a sample or two; next to the line that makes a
+phantom intersection. LineFilter keeps the last samples of every sensor in a ring buffer (the bits of an int)
+and switches the sensor's filtered state with hysteresis: on once most of the samples are black, off only once
+nearly all of them are white. The line follower steers by and detects intersections on the filtered reading.
+The line is lost as soon as every filtered sensor is off, a few samples after the line really left the array,
+instead of after a second of driving blind.
+"""
+
+import time
+from typing import Callable, NamedTuple, Sequence
+
+from line_tracking import SEARCH_YAW, SENSOR_POSITIONS, at_intersection
+from metrics import Histogram
+
+
+class FilteredReading(NamedTuple):
+    sensors: tuple[bool, ...]
+    # fraction of each sensor's recent samples agreeing with its filtered state
+    confidence: tuple[float, ...]
+    line_lost: bool
+
+
+class LineFilter:
+    """Majority filter with hysteresis over the recent samples of each sensor
+
+    Also counts what it filtered out: samples disagreeing with the filtered state (glitches), raw intersections
+    that never showed in the filtered reading (phantom intersections) and the time from the last raw sample
+    seeing the line to the line being declared lost.
+    """
+
+    def __init__(self, window: int = 5, on_count: int = 3, off_count: int = 1, clock: Callable[[], float] = time.monotonic):
+        """
+        :param window: number of samples of each sensor considered
+        :param on_count: black samples in the window turning a sensor on
+        :param off_count: black samples in the window at or under which a sensor turns off
+        :param clock: time source
+        """
+        self.window = window
+        self.on_count = on_count
+        self.off_count = off_count
+        self.clock = clock
+        self._mask = (1 << window) - 1
+        self.history = [0] * len(SENSOR_POSITIONS)
+        self.state = [False] * len(SENSOR_POSITIONS)
+        # side the line was last seen on: -1 left, 1 right, 0 center
+        self.side = 0
+        self.lost = False
+        self._seed = True
+        self._unseen_since: float | None = None
+        self._raw_intersection = False
+        self._confirmed = False
+        self.samples = 0
+        self.glitches = [0] * len(SENSOR_POSITIONS)
+        self.phantom_intersections = 0
+        self.losses = 0
+        self.loss_latency = Histogram(lowest=1e-4, highest=10)
+
+    def reset(self):
+        """Start over from the next sample, e.g. after a turn made the history meaningless"""
+        self._seed = True
+
+    def update(self, raw: Sequence[bool]) -> FilteredReading:
+        now = self.clock()
+        self.samples += 1
+        if self._seed:
+            self._seed = False
+            self.history = [self._mask if black else 0 for black in raw]
+            self.state = list(raw)
+            self.lost = False
+        confidence = []
+        for i, black in enumerate(raw):
+            history = ((self.history[i] << 1) | black) & self._mask
+            self.history[i] = history
+            count = history.bit_count()
+            if count >= self.on_count:
+                self.state[i] = True
+            elif count <= self.off_count:
+                self.state[i] = False
+            if black != self.state[i]:
+                self.glitches[i] += 1
+            confidence.append((count if self.state[i] else self.window - count) / self.window)
+        sensors = tuple(self.state)
+
+        if at_intersection(raw):
+            self._raw_intersection = True
+        elif self._raw_intersection:
+            if not self._confirmed:
+                self.phantom_intersections += 1
+            self._raw_intersection = self._confirmed = False
+        if at_intersection(sensors):
+            self._confirmed = True
+
+        if any(raw):
+            self._unseen_since = None
+        elif self._unseen_since is None:
+            self._unseen_since = now
+        if any(sensors):
+            self.lost = False
+            position = sum(p for p, on in zip(SENSOR_POSITIONS, sensors) if on)
+            if position:
+                self.side = 1 if position > 0 else -1
+        elif not self.lost:
+            self.lost = True
+            self.losses += 1
+            self.loss_latency.record(now - (self._unseen_since or now))
+        return FilteredReading(sensors, tuple(confidence), self.lost)
+
+    def search_yaw(self) -> float:
+        """Yaw of the spin looking for a lost line, towards the side it was last seen on"""
+        return abs(SEARCH_YAW) * self.side if self.side else SEARCH_YAW
+
+    def summary(self) -> dict:
+        return {
+            "samples": self.samples,
+            "glitches": list(self.glitches),
+            "phantom_intersections": self.phantom_intersections,
+            "losses": self.losses,
+            "loss_latency_p99": self.loss_latency.percentile(99),
+        }
+
+    def export(self, name: str) -> dict[str, dict]:
+        """Histogram of the line loss detection latency (Histogram.export), by name"""
+        return {f"{name}.loss_latency": self.loss_latency.export()}
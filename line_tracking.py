@@ -0,0 +1,162 @@
+"""
+Steering of the line follower
+
+The IR array has four sensors, sensor1 on the left and sensor4 on the right. Three or more of them seeing black
+is an intersection, which the line follower handles itself; a tracker turns every other reading into a chassis
+command, once per control period:
+    TableTracker: the original fixed command per sensor pattern
+    PidTracker: a continuous line position error fed through a PID controller steering the yaw
+Whether the line is lost is not up to the trackers: line_filter.LineFilter decides it on the filtered readings,
+and the line follower then spins looking for the line and notifies the controller.
+"""
+
+import math
+from enum import StrEnum
+from typing import NamedTuple, Protocol, Sequence
+
+# lateral position of each sensor (sensor1 to sensor4), in sensor spacings; positive is to the right
+SENSOR_POSITIONS = (-1.5, -0.5, 0.5, 1.5)
+# error used when the line has slipped past the outermost sensor
+EDGE_ERROR = 2.0
+# spin looking for a lost line
+SEARCH_YAW = -0.1
+
+
+class Tracking(StrEnum):
+    TABLE = "table"
+    PID = "pid"
+
+
+class Steering(NamedTuple):
+    """Chassis command: speed (as given to set_velocity) and yaw rate, positive turning right"""
+
+    speed: float
+    yaw: float
+
+
+def at_intersection(sensors: Sequence[bool]) -> bool:
+    """Whether the reading is a cross line: three adjacent sensors or all four on black"""
+    s1, s2, s3, s4 = sensors
+    return s2 and s3 and (s1 or s4)
+
+
+class Tracker(Protocol):
+    # control period (s)
+    period: float
+
+    def update(self, sensors: Sequence[bool]) -> Steering | None:
+        """Steering for a reading (not at an intersection, and with the line not lost), None to keep the last one"""
+        ...
+
+    def reset(self) -> None:
+        """Forget the line's history, after the robot was stopped or turned"""
+        ...
+
+
+# speed (None for the line follower's speed) and yaw for each valid reading; the robot stops on the others
+_TABLE: dict[tuple[bool, bool, bool, bool], tuple[float | None, float]] = {
+    (False, False, False, True): (10, 0.2),
+    (False, False, True, False): (None, 0.03),
+    (False, False, True, True): (None, 0.1),
+    (False, True, False, False): (None, -0.03),
+    (False, True, True, False): (None, 0),
+    (True, False, False, False): (10, -0.2),
+    (True, True, False, False): (None, -0.2),
+}
+
+
+class TableTracker:
+    """The original line follower: a fixed command for each sensor pattern
+
+    While the line is not seen the robot keeps driving as it was.
+    """
+
+    period = 0.01
+
+    def __init__(self, speed: float = 30):
+        self.speed = speed
+
+    def reset(self):
+        pass
+
+    def update(self, sensors: Sequence[bool]) -> Steering | None:
+        if not any(sensors):
+            return None
+        command = _TABLE.get(tuple(sensors))
+        if command is None:
+            return Steering(0, 0)
+        speed, yaw = command
+        return Steering(self.speed if speed is None else speed, yaw)
+
+
+class PidTracker:
+    """Yaw from a PID controller on the line's lateral position
+
+    The position is the mean position of the sensors seeing the line. Once the line slips past the outermost
+    sensor it is taken to be beyond the side it was last seen on, so the robot keeps turning back towards it.
+    The robot slows down as the error grows, so it can take bends at speeds the table cannot.
+    """
+
+    def __init__(
+        self,
+        speed: float = 45,
+        kp: float = 0.3,
+        ki: float = 0.05,
+        kd: float = 0.01,
+        period: float = 0.01,
+        max_yaw: float = 0.5,
+        min_speed: float = 10,
+        slowdown: float = 0.6,
+        derivative_smoothing: float = 0.5,
+    ):
+        """
+        :param speed: speed on a straight line
+        :param kp: yaw per unit of error (sensor spacings)
+        :param ki: yaw per unit of error integrated over a second
+        :param kd: yaw per unit of error change per second
+        :param period: control period (s)
+        :param max_yaw: limit of the yaw command
+        :param min_speed: speed with the line at the edge of the array
+        :param slowdown: fraction of the speed shed with the line at the edge of the array
+        :param derivative_smoothing: weight of the previous derivative in the low-pass filtered one
+        """
+        self.speed = speed
+        self.kp, self.ki, self.kd = kp, ki, kd
+        self.period = period
+        self.max_yaw = max_yaw
+        self.min_speed = min_speed
+        self.slowdown = slowdown
+        self.derivative_smoothing = derivative_smoothing
+        self.reset()
+
+    def reset(self):
+        self.error = 0.0
+        self.integral = 0.0
+        self.derivative = 0.0
+
+    def position(self, sensors: Sequence[bool]) -> float | None:
+        active = [position for position, seen in zip(SENSOR_POSITIONS, sensors) if seen]
+        if not active:
+            return None
+        return sum(active) / len(active)
+
+    def update(self, sensors: Sequence[bool]) -> Steering | None:
+        error = self.position(sensors)
+        if error is None:
+            error = math.copysign(EDGE_ERROR, self.error) if self.error else 0.0
+        derivative = (error - self.error) / self.period
+        self.derivative += (1 - self.derivative_smoothing) * (derivative - self.derivative)
+        self.error = error
+        yaw = self.kp * error + self.ki * self.integral + self.kd * self.derivative
+        # anti-windup: only integrate while the output is not saturated
+        if abs(yaw) < self.max_yaw:
+            self.integral += error * self.period
+        yaw = max(-self.max_yaw, min(self.max_yaw, yaw))
+        speed = self.speed * (1 - self.slowdown * min(abs(error) / EDGE_ERROR, 1.0))
+        return Steering(max(speed, self.min_speed), yaw)
+
+
+def make_tracker(tracking: Tracking, speed: float) -> Tracker:
+    if tracking == Tracking.PID:
+        return PidTracker(speed)
+    return TableTracker(speed)
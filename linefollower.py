@@ -1,20 +1,22 @@
 import json
 import logging
-import sys
+import os
+from collections import deque
 
 import zmq
-sys.path.append('/home/pi/TurboPi/')
 import time
 import threading
 import numpy as np
-import HiwonderSDK.mecanum as mecanum
-import HiwonderSDK.FourInfrared as infrared
+import hal
+from line_filter import LineFilter
+from line_tracking import Tracking, at_intersection, make_tracker
+from periodic import PeriodicLoop
 
 logging.basicConfig(filename="logs.txt", level=logging.DEBUG, format=f'[LINE FOLLOWER] %(asctime)s - %(levelname)s - %(message)s')
 
 
-car = mecanum.MecanumChassis()
-line = infrared.FourInfrared()
+car = hal.chassis()
+line = hal.line_sensor()
 _is_running = False
 
 context = zmq.Context()
@@ -24,6 +26,8 @@ dealer_socket.connect("tcp://localhost:5575")
 
 aisle_var = None
 turn_direction = 0
+# actions for the next intersections, uploaded by the controller; past them the controller is asked again
+route = deque()
 
 aisle_condition = threading.Condition()
 
@@ -56,6 +60,7 @@ def msg():
     global aisle_var
     global _is_running
     global turn_direction
+    global route
     while True:
         empty, request = dealer_socket.recv_multipart() # removing the prepended filter
         request = json.loads(request)
@@ -64,6 +69,7 @@ def msg():
         if request["command"] == "check":
             dealer_socket.send_multipart([b"", "ONLINE".encode()])
         elif request["command"] == "start":
+            route = deque()
             _is_running = True
             logging.info("At start. Initiating turn")
             if "param" in request:
@@ -102,130 +108,105 @@ def msg():
                 aisle_var = "ignore"
                 aisle_condition.notify()
             # ignore aisle
+        elif request["command"] == "route":
+            route = deque(request["actions"])
+            logging.info(f"Route uploaded: {request['actions']}")
 
 msg_thread = threading.Thread(target=msg)
 msg_thread.daemon = True
 msg_thread.start()
 
-car_speed = 30
+# steering of the line following: the original table or the PID controller (see line_tracking.py)
+TRACKING = Tracking(os.environ.get("DELIVERPI_TRACKING", Tracking.TABLE))
+car_speed = float(os.environ.get("DELIVERPI_LINE_SPEED", "30"))
+tracker = make_tracker(TRACKING, car_speed)
+
+
+line_filter = LineFilter()
+
+
+def report_loop(loop: PeriodicLoop):
+    """Send the loop's and the line filter's histograms to the controller, which publishes them for the hub"""
+    logging.info(f"line filter: {line_filter.summary()}")
+    loops = loop.export() | line_filter.export(loop.name)
+    dealer_socket.send_multipart([b"", json.dumps({"loops": loops}).encode()])
+
+
+loop = PeriodicLoop("linefollower", tracker.period, report_loop)
 
 car.set_velocity(0,90,0)
 
-no_line_count = 0
 
+# least time driven straight over an intersection passed at speed (s); driving straight goes on until its cross
+# line has left the sensors, so that every intersection is counted once however long it takes to pass
+PASS_TIME = 0.25
 
-""" To be honest, I wouldn't touch the below code unless modifying values for some reason as it's confusing.
-    It works pretty well most of the time except the line sensor can occasionally hallucinate
-    black when there is none.
+
+def intersection():
+    """ Stop at an intersection and do what the controller says: drive past it, enter the aisle or turn around
+    """
+    global aisle_var
+    car.set_velocity(0,90,0)
+    aisle_var = None
+    dealer_socket.send_multipart([b"", "intersection_reached".encode()])
+    with aisle_condition:
+        while aisle_var == None:
+            aisle_condition.wait()
+        if aisle_var == "ignore":
+            logging.debug("Ignoring aisle")
+            car.set_velocity(car_speed,90,0)
+            # give enough time to clear the aisle
+            time.sleep(0.8)
+        elif aisle_var == "enter":
+            logging.debug("Entering aisle")
+            turn(turn_direction, 0.5, 4)
+            dealer_socket.send_multipart([b"", "aisle_entered".encode()])
+        elif aisle_var == "end":
+            turn(0, 1.5)
+
+
+""" The tracker steers along the line, once per control period. The line sensor can occasionally hallucinate
+    black when there is none, so steering and intersections go by the filtered readings.
 """
 while True:
+    loop.restart()
+    line_filter.reset()
+    searching = False
+    passing_until = 0.0
+    # whether the cross line of the intersection being passed is still under the sensors
+    crossing = False
     while _is_running:
-        sensor1, sensor2, sensor3, sensor4 = line.readData()
-        match sensor1, sensor2, sensor3, sensor4:
-            case False, False, False, False:
-                # no_line_count += 1
-                looping = True
-                count = 0
-                while looping:
-                    count += 1
-                    sensor1, sensor2, sensor3, sensor4 = line.readData()
-                    if sensor1 == False and sensor2 == False and sensor3 == False and sensor4 == False:
-                        no_line_count += 1
-                        time.sleep(0.1)
-                    if no_line_count == 10:
-                        # lost the line! try to spin and find it again, but notify controller in case
-                        # action needs to be taken
-                        no_line_count = 0
-                        car.set_velocity(0,90,-.1)
-                        dealer_socket.send_multipart([b"", "no_line".encode()])
-                    if count == 10:
-                        looping = False
-                no_line_count = 0
-            case False, False, False, True:
-                car.set_velocity(10, 90, 0.2)
-            case False, False, True, False:
-                car.set_velocity(car_speed, 90, 0.03)
-            case False, False, True, True:
-                car.set_velocity(car_speed, 90, 0.1)
-            case False, True, False, False:
-                car.set_velocity(car_speed, 90, -0.03)
-            case False, True, False, True:
-                #invalid state
-                car.set_velocity(0,90,0)
-            case False, True, True, False:
-                car.set_velocity(car_speed,90,0)
-            case False, True, True, True:
-                car.set_velocity(0,90,0)
-                aisle_var = None
-                dealer_socket.send_multipart([b"", "intersection_reached".encode()])
-                with aisle_condition:
-                    while aisle_var == None:
-                        aisle_condition.wait()
-                    if aisle_var == "ignore":
-                        logging.debug("Ignoring aisle")
-                        car.set_velocity(car_speed,90,0)
-                        # give enough time to clear the aisle
-                        time.sleep(0.8)
-                    elif aisle_var == "enter":
-                        logging.debug("Entering aisle")
-                        turn(turn_direction, 0.5, 4)
-                        dealer_socket.send_multipart([b"", "aisle_entered".encode()])
-                    elif aisle_var == "end":
-                        turn(0, 1.5)
-            case True, False, False, False:
-                car.set_velocity(10, 90, -0.2)
-            case True, False, False, True:
-                #invalid state
-                car.set_velocity(0,90,0)
-            case True, False, True, False:
-                #invalid state
-                car.set_velocity(0,90,0)
-            case True, False, True, True:
-                #invalid state
-                car.set_velocity(0,90,0)
-            case True, True, False, False:
-                car.set_velocity(car_speed, 90, -0.2)
-            case True, True, False, True:
-                #invalid state
-                car.set_velocity(0,90,0)
-            case True, True, True, False:
-                # NOTE: Special case because this means we've reached an aisle. Check if we should continue.
-                car.set_velocity(0,90,0)
-                aisle_var = None
-                dealer_socket.send_multipart([b"", "intersection_reached".encode()])
-                with aisle_condition:
-                    while aisle_var == None:
-                        aisle_condition.wait()
-                    if aisle_var == "ignore":
-                        logging.debug("Ignoring aisle")
-                        car.set_velocity(car_speed,90,0)
-                        # give enough time to clear the aisle
-                        time.sleep(0.8)
-                    elif aisle_var == "enter":
-                        logging.debug("Entering aisle")
-                        turn(turn_direction, 0.5, 4)
-                        dealer_socket.send_multipart([b"", "aisle_entered".encode()])
-                    elif aisle_var == "end":
-                        turn(0, 1.5)
-                
-            case True, True, True, True:
-                car.set_velocity(0,90,0)
-                aisle_var = None
-                dealer_socket.send_multipart([b"", "intersection_reached".encode()])
-                with aisle_condition:
-                    while aisle_var == None:
-                        aisle_condition.wait()
-                    if aisle_var == "ignore":
-                        logging.debug("Ignoring aisle")
-                        car.set_velocity(car_speed,90,0)
-                        # give enough time to clear the aisle
-                        time.sleep(0.8)
-                    elif aisle_var == "enter":
-                        logging.debug("Entering aisle")
-                        turn(turn_direction, 0.5, 4)
-                        dealer_socket.send_multipart([b"", "aisle_entered".encode()])
-                    elif aisle_var == "end":
-                        turn(0, 1.5)
-            case _:
-                car.set_velocity(0,90,0)
-        time.sleep(0.02)
+        reading = line_filter.update(line.readData())
+        on_cross = at_intersection(reading.sensors)
+        crossing = crossing and on_cross
+        if time.monotonic() < passing_until or crossing:
+            # driving straight over an intersection on the route
+            pass
+        elif reading.line_lost:
+            if not searching:
+                # lost the line! spin to find it again, but notify controller in case action needs to be taken
+                searching = True
+                car.set_velocity(0, 90, line_filter.search_yaw())
+                tracker.reset()
+                dealer_socket.send_multipart([b"", "no_line".encode()])
+        elif on_cross and route and route[0] == "ignore":
+            # on the route: no need to stop and ask the controller
+            route.popleft()
+            dealer_socket.send_multipart([b"", "intersection_passed".encode()])
+            car.set_velocity(car_speed, 90, 0)
+            passing_until = time.monotonic() + PASS_TIME
+            crossing = True
+        elif on_cross:
+            searching = False
+            intersection()
+            tracker.reset()
+            line_filter.reset()
+            # waiting for the controller is not an overrun
+            loop.restart()
+        else:
+            searching = False
+            steering = tracker.update(reading.sensors)
+            if steering is not None:
+                car.set_velocity(steering.speed, 90, steering.yaw)
+        loop.wait()
+    time.sleep(loop.period)
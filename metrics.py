@@ -0,0 +1,164 @@
+"""
+Fixed-memory metric containers shared by the hub and the robot applications
+"""
+
+import math
+from array import array
+
+
+class RingBuffer:
+    """
+    Fixed-capacity buffer of the most recent float samples
+
+    Backed by a preallocated array, so memory use does not depend on how many samples were ever recorded.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._data = array("d", bytes(8 * capacity))
+        self._next = 0
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def append(self, value: float):
+        self._data[self._next] = value
+        self._next = (self._next + 1) % self.capacity
+        if self._count < self.capacity:
+            self._count += 1
+
+    def clear(self):
+        self._next = 0
+        self._count = 0
+
+    def values(self) -> list[float]:
+        """Samples in the order they were recorded, oldest first"""
+        if self._count < self.capacity:
+            return self._data[: self._count].tolist()
+        return self._data[self._next :].tolist() + self._data[: self._next].tolist()
+
+    def mean(self) -> float | None:
+        if not self._count:
+            return None
+        return sum(self._data[: self._count]) / self._count
+
+    def percentile(self, q: float) -> float | None:
+        """Nearest-rank percentile of the buffered samples, q between 0 and 100"""
+        if not self._count:
+            return None
+        ordered = sorted(self._data[: self._count])
+        return ordered[min(self._count - 1, max(0, round(q / 100 * self._count) - 1))]
+
+    def count_since(self, threshold: float) -> int:
+        """Number of samples at least as large as threshold, e.g. timestamps within a time window"""
+        return sum(1 for value in self._data[: self._count] if value >= threshold)
+
+
+# most sub-buckets accepted from an exported histogram, which keeps a malformed export from allocating without bound
+MAX_SUB_BUCKETS = 1024
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram of durations in the style of an HDR histogram
+
+    Every power of two between lowest and highest is split into sub_buckets equal buckets, so any recorded
+    value is known to within 1/sub_buckets of itself while memory use and the cost of recording stay constant.
+    Values outside the range are counted in the first or last bucket.
+    """
+
+    def __init__(self, lowest: float = 1e-3, highest: float = 1e5, sub_buckets: int = 16):
+        self.lowest = lowest
+        self.highest = highest
+        self.sub_buckets = sub_buckets
+        self._min_exponent = math.frexp(lowest)[1]
+        self._size = (math.frexp(highest)[1] - self._min_exponent + 1) * sub_buckets
+        self._counts = array("Q", bytes(8 * self._size))
+        self.count = 0
+        self.total = 0.0
+
+    def _index(self, value: float) -> int:
+        if value < self.lowest:
+            return 0
+        mantissa, exponent = math.frexp(value)
+        index = (exponent - self._min_exponent) * self.sub_buckets + int((mantissa - 0.5) * 2 * self.sub_buckets)
+        return min(index, self._size - 1)
+
+    def bucket_limit(self, index: int) -> float:
+        """Upper limit of the values counted in a bucket"""
+        exponent, sub_bucket = divmod(index, self.sub_buckets)
+        return math.ldexp(0.5 + (sub_bucket + 1) / (2 * self.sub_buckets), exponent + self._min_exponent)
+
+    def record(self, value: float):
+        self._counts[self._index(value)] += 1
+        self.count += 1
+        self.total += value
+
+    def mean(self) -> float | None:
+        return self.total / self.count if self.count else None
+
+    def percentile(self, q: float) -> float | None:
+        """Upper limit of the bucket holding the nearest-rank percentile, q between 0 and 100"""
+        if not self.count:
+            return None
+        rank = max(1, math.ceil(q / 100 * self.count))
+        seen = 0
+        for index, count in enumerate(self._counts):
+            seen += count
+            if seen >= rank:
+                return self.bucket_limit(index)
+        return self.bucket_limit(self._size - 1)
+
+    def merge(self, other: "Histogram"):
+        """Add the counts of a histogram with the same buckets"""
+        if (other.lowest, other.highest, other.sub_buckets) != (self.lowest, self.highest, self.sub_buckets):
+            raise ValueError("histograms have different buckets")
+        for index, count in enumerate(other._counts):
+            if count:
+                self._counts[index] += count
+        self.count += other.count
+        self.total += other.total
+
+    def export(self) -> dict:
+        """Sparse representation for sending the histogram as part of a message"""
+        return {
+            "lowest": self.lowest,
+            "highest": self.highest,
+            "sub_buckets": self.sub_buckets,
+            "buckets": [[index, count] for index, count in enumerate(self._counts) if count],
+            "count": self.count,
+            "sum": self.total,
+        }
+
+    @classmethod
+    def from_export(cls, data: dict) -> "Histogram":
+        """Rebuild a histogram from export()
+
+        :raises ValueError: if the data is not an export of a histogram
+        """
+        try:
+            lowest, highest, sub_buckets = data["lowest"], data["highest"], data["sub_buckets"]
+            valid_range = 0 < lowest < highest < math.inf
+            if not valid_range or type(sub_buckets) is not int or not 0 < sub_buckets <= MAX_SUB_BUCKETS:
+                raise ValueError(f"invalid buckets {lowest}, {highest}, {sub_buckets}")
+            histogram = cls(lowest, highest, sub_buckets)
+            for index, count in data["buckets"]:
+                if type(index) is not int or not 0 <= index < histogram._size:
+                    raise ValueError(f"invalid bucket index {index}")
+                histogram._counts[index] += count
+            histogram.count = int(data["count"])
+            histogram.total = float(data["sum"])
+        except (KeyError, TypeError, OverflowError) as e:
+            raise ValueError(f"invalid histogram export: {e!r}") from None
+        return histogram
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.mean(),
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+        }
@@ -0,0 +1,283 @@
+"""
+Indexed order book used by the hub to queue orders by deadline
+"""
+
+import heapq
+import itertools
+import math
+import time
+from typing import Callable, Iterable, Iterator, NamedTuple
+
+from common import OrderData
+
+# heap entry (priority, sequence number, order id, order); entries are never modified, so a copy of the heap
+# stays valid while the book changes
+Entry = tuple[float, int, str | None, OrderData | None]
+
+
+def by_deadline(order: OrderData) -> float:
+    """Default priority of an order: its deadline"""
+    return order["deadline"]
+
+
+class ColdEntries(NamedTuple):
+    """Heap entries restored from a snapshot but not loaded yet, see OrderBook.restore"""
+
+    # lowest priority among the entries
+    lowest: float
+    # number of entries of queued orders
+    live: int
+    # highest sequence number among the entries
+    last_sequence: int
+    # returns the entries
+    load: Callable[[], list[Entry]]
+    # returns the ids of the queued orders among the entries, cheaper than loading them
+    ids: Callable[[], set[str]]
+
+
+class OrderBook:
+    """
+    Min-heap of orders keyed by a priority (the deadline by default), with an index from order id to heap entry
+
+    An entry is live as long as the index points to it: cancelling or changing the deadline of an order only
+    drops or replaces its index entry (lazy deletion), so every operation is O(log n). Stale entries are
+    discarded when they reach the top of the heap, and the heap is rebuilt once they make up more than half of
+    it so memory stays proportional to the live orders. Order ids that were ever accepted are remembered so
+    orders re-published by the server are ignored.
+
+    A book restored from a snapshot may hold part of its entries cold, not loaded yet: they are merged into the
+    heap a batch at a time by load_cold, as soon as they could come before the order served next, or when the
+    order looked up by id is among them.
+    """
+
+    def __init__(self, priority: Callable[[OrderData], float] = by_deadline):
+        """
+        :param priority: key of an order in the heap, lower is served first
+        """
+        self.priority = priority
+        self._heap: list[Entry] = []
+        self._index: dict[str, Entry] = {}
+        self._seen: set[str] = set()
+        self._counter = itertools.count()
+        self._ids = itertools.count()
+        # assigned ids stay unique across restarts of the hub
+        self._id_prefix = f"hub-{time.time_ns():x}-"
+        # cold entries as a heap of (lowest priority, number, ColdEntries), and how many live orders they hold
+        self._cold: list[tuple[float, int, ColdEntries]] = []
+        self._cold_live = 0
+
+    def __len__(self) -> int:
+        return len(self._index) + self._cold_live
+
+    def __contains__(self, order_id: str) -> bool:
+        self._load_for(order_id)
+        return order_id in self._index
+
+    def __iter__(self) -> Iterator[OrderData]:
+        """Iterate over the queued orders in no particular order"""
+        self.load_cold(len(self._cold))
+        return (entry[3] for entry in self._index.values())
+
+    def push(self, order: OrderData) -> str | None:
+        """Queue an order, assigning it an id if it does not carry one
+
+        :param order: order to queue
+        :return: id of the order, or None if an order with the same id was already accepted
+        """
+        order_id = order.get("id")
+        if order_id is None:
+            order_id = order["id"] = f"{self._id_prefix}{next(self._ids)}"
+        elif order_id in self._seen:
+            return None
+        self._seen.add(order_id)
+        self._insert(order)
+        return order_id
+
+    def requeue(self, order: OrderData):
+        """Put back an order that was popped earlier, bypassing the duplicate check"""
+        self._seen.add(order["id"])
+        self._insert(order)
+
+    def pop(self) -> OrderData | None:
+        """Remove and return the order with the lowest priority, or None if the book is empty"""
+        entry = self._top()
+        if entry is None:
+            return None
+        heapq.heappop(self._heap)
+        del self._index[entry[2]]
+        return entry[3]
+
+    def peek(self) -> OrderData | None:
+        """Return the order with the lowest priority without removing it"""
+        entry = self._top()
+        return entry[3] if entry is not None else None
+
+    def _top(self) -> Entry | None:
+        """Live heap entry with the lowest priority, merging the cold entries that could come before it"""
+        heap = self._heap
+        index = self._index
+        while True:
+            while heap and index.get(heap[0][2]) is not heap[0]:
+                heapq.heappop(heap)
+            if not self._cold or (heap and heap[0][0] < self._cold[0][0]):
+                return heap[0] if heap else None
+            self._merge_cold()
+
+    def most_urgent(self, count: int) -> list[OrderData]:
+        """Return up to count queued orders with the lowest priorities, in priority order, without removing them
+
+        Walks the heap from its root, so the cost depends on count rather than on the size of the book.
+        """
+        while True:
+            heap = self._heap
+            result = []
+            frontier = [(heap[0][0], heap[0][1], 0)] if heap else []
+            while frontier and len(result) < count:
+                i = heapq.heappop(frontier)[2]
+                entry = heap[i]
+                if self._index.get(entry[2]) is entry:
+                    result.append(entry)
+                for child in (2 * i + 1, 2 * i + 2):
+                    if child < len(heap):
+                        heapq.heappush(frontier, (heap[child][0], heap[child][1], child))
+            bound = result[-1][0] if len(result) == count else math.inf
+            if not self._cold or bound < self._cold[0][0]:
+                return [entry[3] for entry in result]
+            self._merge_cold()
+
+    def get(self, order_id: str) -> OrderData | None:
+        """Look up a queued order by id"""
+        self._load_for(order_id)
+        entry = self._index.get(order_id)
+        return entry[3] if entry is not None else None
+
+    def cancel(self, order_id: str) -> OrderData | None:
+        """Remove a queued order
+
+        :param order_id: id of the order to cancel
+        :return: the cancelled order, or None if it is not queued
+        """
+        self._load_for(order_id)
+        entry = self._index.pop(order_id, None)
+        if entry is None:
+            return None
+        self._compact()
+        return entry[3]
+
+    def update_deadline(self, order_id: str, deadline: int) -> bool:
+        """Change the deadline of a queued order and reprioritise it
+
+        The order is replaced by an amended copy, the one given out earlier keeps its deadline.
+
+        :param order_id: id of the order to amend
+        :param deadline: new deadline
+        :return: whether the order was queued
+        """
+        self._load_for(order_id)
+        entry = self._index.get(order_id)
+        if entry is None:
+            return False
+        self._insert({**entry[3], "deadline": deadline})
+        self._compact()
+        return True
+
+    def reprioritise(self):
+        """Recompute the priority of every queued order, after the priority function changed"""
+        self.load_cold(len(self._cold))
+        self._heap = [(self.priority(entry[3]), *entry[1:]) for entry in self._index.values()]
+        heapq.heapify(self._heap)
+        self._index = {entry[2]: entry for entry in self._heap}
+
+    def export(self) -> tuple[list[Entry], dict[str, Entry]]:
+        """Copy of the heap in heap order, stale entries included, and of the index, for snapshots
+
+        Entries are never modified, so the copies stay consistent while the book keeps changing: an entry is
+        live if the index copy points to it. Cold entries are loaded first.
+        """
+        self.load_cold(len(self._cold))
+        return list(self._heap), dict(self._index)
+
+    def seen(self) -> set[str]:
+        """Copy of the ids of every order ever accepted, for snapshots"""
+        return set(self._seen)
+
+    def remember(self, order_ids: Iterable[str]):
+        """Count order ids as accepted already, e.g. those of orders dispatched before a restart"""
+        self._seen.update(order_ids)
+
+    def restore(self, entries: list[Entry], reprioritise: bool = False, cold: Iterable[ColdEntries] = ()):
+        """Replace the contents of the book with entries exported earlier
+
+        Entries without an order id are placeholders for stale entries, kept so that the entries stay in heap
+        order.
+
+        :param entries: heap entries, already in heap order unless reprioritise is set
+        :param reprioritise: recompute the priorities, for entries exported by a book with a different priority
+        :param cold: further entries, in any order, to load only when needed so a large book is usable right away
+        """
+        cold = list(cold)
+        if reprioritise:
+            entries = list(entries)
+            for chunk in cold:
+                entries += chunk.load()
+            cold = []
+            entries = [
+                (self.priority(order), sequence, order_id, order)
+                for _, sequence, order_id, order in entries
+                if order_id is not None
+            ]
+            heapq.heapify(entries)
+        self._heap = entries
+        self._index = {entry[2]: entry for entry in entries if entry[2] is not None}
+        self._seen.update(self._index)
+        self._cold = [(chunk.lowest, i, chunk) for i, chunk in enumerate(cold)]
+        heapq.heapify(self._cold)
+        self._cold_live = sum(chunk.live for chunk in cold)
+        last = max([*(entry[1] for entry in entries), *(chunk.last_sequence for chunk in cold)], default=-1)
+        self._counter = itertools.count(last + 1)
+
+    def load_cold(self, batches: int = 1) -> bool:
+        """Merge up to the given number of batches of cold entries into the heap
+
+        :return: whether cold entries are left
+        """
+        for _ in range(batches):
+            if not self._cold:
+                break
+            self._merge_cold()
+        return bool(self._cold)
+
+    def _merge_cold(self):
+        self._merge(heapq.heappop(self._cold)[2])
+
+    def _merge(self, chunk: ColdEntries):
+        self._cold_live -= chunk.live
+        for entry in chunk.load():
+            if entry[2] is not None:
+                self._index[entry[2]] = entry
+                self._seen.add(entry[2])
+                heapq.heappush(self._heap, entry)
+
+    def _load_for(self, order_id: str):
+        """Merge the cold entries holding the order, if it is among them"""
+        if not self._cold or order_id in self._index:
+            return
+        for i, (_, _, chunk) in enumerate(self._cold):
+            if order_id in chunk.ids():
+                self._cold[i] = self._cold[-1]
+                self._cold.pop()
+                heapq.heapify(self._cold)
+                self._merge(chunk)
+                return
+
+    def _insert(self, order: OrderData):
+        entry = (self.priority(order), next(self._counter), order["id"], order)
+        self._index[order["id"]] = entry
+        heapq.heappush(self._heap, entry)
+
+    def _compact(self):
+        """Rebuild the heap without its stale entries once they make up more than half of it"""
+        if len(self._heap) > 2 * len(self._index):
+            index = self._index
+            self._heap = [entry for entry in self._heap if index.get(entry[2]) is entry]
+            heapq.heapify(self._heap)
@@ -0,0 +1,115 @@
+"""
+Fixed-rate loops of the robot processes
+
+A PeriodicLoop wakes its loop up on absolute deadlines, start + n * period, instead of sleeping a fixed time
+after the work, so the rate does not drift with the time the work takes. A tick whose work runs past its
+deadline is an overrun: the deadlines missed are skipped rather than run back to back, keeping the loop in phase.
+Every loop records histograms of its work time, of the period actually achieved and of its wake-up jitter (how
+late it woke up after a deadline), logs a summary at regular intervals and hands its histograms to a reporter,
+which the components use to send them to the controller.
+"""
+
+import logging
+import math
+import time
+from typing import Callable
+
+from metrics import Histogram
+
+# how often a loop logs and reports its statistics (seconds)
+REPORT_INTERVAL = 30
+
+
+class PeriodicLoop:
+    """Pacing of a loop running at a fixed rate
+
+    The loop calls wait() at the end of every tick, and restart() whenever it resumes after being paused (stopped
+    by the controller, waiting for a command...) so the pause does not count as an overrun:
+        loop.restart()
+        while running:
+            work()
+            loop.wait()
+    """
+
+    def __init__(
+        self,
+        name: str,
+        period: float,
+        report: Callable[["PeriodicLoop"], None] | None = None,
+        report_interval: float = REPORT_INTERVAL,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        """
+        :param name: name of the loop, prefixed to its histograms
+        :param period: time between the starts of two ticks (s)
+        :param report: called with the loop every report_interval, e.g. to send export() on
+        :param report_interval: time between two reports (s)
+        :param clock: time source
+        :param sleep: sleeps for a time
+        """
+        self.name = name
+        self.period = period
+        self.report = report
+        self.report_interval = report_interval
+        self.clock = clock
+        self.sleep = sleep
+        self.work = Histogram(lowest=1e-5, highest=10)
+        self.jitter = Histogram(lowest=1e-5, highest=10)
+        self.periods = Histogram(lowest=1e-5, highest=10)
+        self.ticks = 0
+        self.overruns = 0
+        self._last_report = self.clock()
+        self.restart()
+
+    def restart(self):
+        """Start the schedule over with a tick starting now"""
+        self._tick_start = self.clock()
+        self._deadline = self._tick_start + self.period
+
+    def wait(self):
+        """End a tick: sleep until the next deadline, or the first one not missed yet after an overrun"""
+        now = self.clock()
+        self.ticks += 1
+        self.work.record(now - self._tick_start)
+        if now > self._deadline:
+            self.overruns += 1
+            self._deadline += math.ceil((now - self._deadline) / self.period) * self.period
+        if now - self._last_report >= self.report_interval:
+            self._report(now)
+        delay = self._deadline - self.clock()
+        if delay > 0:
+            self.sleep(delay)
+        woke = self.clock()
+        self.jitter.record(max(woke - self._deadline, 0.0))
+        self.periods.record(woke - self._tick_start)
+        self._tick_start = woke
+        self._deadline += self.period
+
+    def _report(self, now: float):
+        self._last_report = now
+        summary = self.summary()
+        logging.info(
+            f"{self.name} loop: {summary['ticks']} ticks, {summary['overruns']} overruns, "
+            f"work p99 {summary['work_p99'] * 1000:.2f} ms, jitter p99 {summary['jitter_p99'] * 1000:.2f} ms"
+        )
+        if self.report is not None:
+            self.report(self)
+
+    def summary(self) -> dict:
+        return {
+            "period": self.period,
+            "ticks": self.ticks,
+            "overruns": self.overruns,
+            "work_p99": self.work.percentile(99) or 0.0,
+            "jitter_p99": self.jitter.percentile(99) or 0.0,
+            "period_p99": self.periods.percentile(99) or 0.0,
+        }
+
+    def export(self) -> dict[str, dict]:
+        """Histograms of the loop (Histogram.export), by name"""
+        return {
+            f"{self.name}.work": self.work.export(),
+            f"{self.name}.jitter": self.jitter.export(),
+            f"{self.name}.period": self.periods.export(),
+        }
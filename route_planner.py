@@ -0,0 +1,241 @@
+"""
+Pick-path planning over the aisle layout
+
+The warehouse is a main line (the front cross-aisle) with the hub at one end and the aisles branching off it
+at regular intervals. Optionally the far ends of the aisles are joined by a back cross-aisle, so an aisle can
+be driven through instead of being left with a 180 degree turn. A route visits every aisle holding a package
+once; given the side an aisle is entered and left by, the order of the picks inside it follows directly, so
+planning is choosing the order of the aisles and the side used for each of them.
+"""
+
+import itertools
+from typing import Literal, TypedDict
+
+from common import PackageColor, PackageData
+
+# routes for up to this many aisles are planned exactly, larger ones heuristically
+EXACT_AISLE_LIMIT = 8
+
+# added to every move back towards the hub, so of two equally long tours the one working outwards from the hub
+# (the order the controller counts intersections in) is chosen
+BACKTRACK_PENALTY = 1e-6
+
+FRONT = "front"
+BACK = "back"
+Side = Literal["front", "back"]
+
+
+class AisleLayout:
+    """Geometry of the track, in any consistent distance unit"""
+
+    def __init__(
+        self,
+        num_aisles: int,
+        hub_distance: float = 1.0,
+        aisle_spacing: float = 1.0,
+        aisle_length: float = 1.0,
+        slot_depths: dict[PackageColor, float] | None = None,
+        double_ended: bool = False,
+        turn_cost: float = 0.5,
+    ):
+        """
+        :param num_aisles: number of aisles along the main line
+        :param hub_distance: distance from the hub to the intersection of aisle 0
+        :param aisle_spacing: distance between neighbouring aisle intersections
+        :param aisle_length: length of an aisle
+        :param slot_depths: distance from the front of an aisle to the slot holding each color,
+            defaults to the colors spread evenly along the aisle
+        :param double_ended: whether the aisles are joined at the back as well
+        :param turn_cost: travel-equivalent cost of turning around inside an aisle
+        """
+        self.num_aisles = num_aisles
+        self.hub_distance = hub_distance
+        self.aisle_spacing = aisle_spacing
+        self.aisle_length = aisle_length
+        self.slot_depths = slot_depths or {
+            color: aisle_length * (i + 1) / (len(PackageColor) + 1)
+            for i, color in enumerate(PackageColor)
+        }
+        self.double_ended = double_ended
+        self.turn_cost = turn_cost
+
+    def position(self, aisle: int) -> float:
+        """Distance from the hub to the intersection of an aisle along the main line"""
+        return self.hub_distance + aisle * self.aisle_spacing
+
+    def depth(self, package: PackageData) -> float:
+        """Distance from the front of its aisle to a package"""
+        return self.slot_depths[PackageColor(package["color"])]
+
+
+class RouteStop(TypedDict):
+    """A single visit to an aisle"""
+
+    aisle: int
+    entry: Side
+    exit: Side
+    packages: list[PackageData]  # in pick order
+
+
+class Route(TypedDict):
+    """Planned tour starting and ending at the hub"""
+
+    stops: list[RouteStop]
+    distance: float
+
+
+def plan_route(packages: list[PackageData], layout: AisleLayout) -> Route:
+    """Plan a minimal-travel tour collecting the given packages
+
+    Uses an exact dynamic program over (visited aisles, last aisle, side) when at most EXACT_AISLE_LIMIT
+    aisles are involved, otherwise 2-opt improvement of the aisle order. In both cases the sides are chosen
+    optimally for the resulting order.
+
+    :param packages: packages to collect
+    :param layout: track geometry
+    :return: the planned route
+    """
+    by_aisle: dict[int, list[PackageData]] = {}
+    for package in packages:
+        by_aisle.setdefault(package["aisle"], []).append(package)
+    aisles = sorted(by_aisle)
+    if not aisles:
+        return {"stops": [], "distance": 0.0}
+
+    # depths of the shallowest and deepest pick in every aisle
+    spans = {
+        aisle: (
+            min(layout.depth(p) for p in by_aisle[aisle]),
+            max(layout.depth(p) for p in by_aisle[aisle]),
+        )
+        for aisle in aisles
+    }
+    sides: tuple[Side, ...] = (FRONT, BACK) if layout.double_ended else (FRONT,)
+
+    if len(aisles) <= EXACT_AISLE_LIMIT:
+        distance, visits = _plan_exact(aisles, spans, sides, layout)
+    else:
+        distance, visits = _plan_heuristic(aisles, spans, sides, layout)
+
+    stops: list[RouteStop] = []
+    for aisle, entry, exit in visits:
+        picks = sorted(by_aisle[aisle], key=layout.depth, reverse=entry == BACK)
+        stops.append({"aisle": aisle, "entry": entry, "exit": exit, "packages": picks})
+    return {"stops": stops, "distance": distance}
+
+
+def pick_sequence(route: Route) -> list[PackageData]:
+    """Flatten a route into the order the packages are picked in"""
+    return [package for stop in route["stops"] for package in stop["packages"]]
+
+
+def _aisle_cost(span: tuple[float, float], entry: Side, exit: Side, layout: AisleLayout) -> float:
+    """Travel inside an aisle to collect its packages, entering and leaving by the given sides"""
+    shallowest, deepest = span
+    if entry != exit:
+        return layout.aisle_length
+    if entry == FRONT:
+        return 2 * deepest + layout.turn_cost
+    return 2 * (layout.aisle_length - shallowest) + layout.turn_cost
+
+
+def _move_cost(from_x: float, from_side: Side, to_x: float, to_side: Side, layout: AisleLayout) -> float:
+    """Travel between two aisle mouths, driving through an aisle if they are on different sides"""
+    cost = abs(from_x - to_x)
+    if to_x < from_x:
+        cost += BACKTRACK_PENALTY
+    if from_side != to_side:
+        cost += layout.aisle_length
+    return cost
+
+
+def _plan_exact(aisles, spans, sides, layout):
+    """Held-Karp over subsets of aisles, the state also tracking the side the last aisle was left by"""
+    n = len(aisles)
+    xs = [layout.position(a) for a in aisles]
+    # best[(mask, i, side)] = (cost, previous state, entry side of aisle i)
+    best: dict[tuple[int, int, str], tuple[float, tuple | None, str]] = {}
+    for i in range(n):
+        for entry in sides:
+            for exit in sides:
+                cost = _move_cost(0.0, FRONT, xs[i], entry, layout) + _aisle_cost(spans[aisles[i]], entry, exit, layout)
+                key = (1 << i, i, exit)
+                if key not in best or cost < best[key][0]:
+                    best[key] = (cost, None, entry)
+
+    for mask in range(1, 1 << n):
+        for i in range(n):
+            if not mask & (1 << i):
+                continue
+            for side in sides:
+                state = best.get((mask, i, side))
+                if state is None:
+                    continue
+                for j in range(n):
+                    if mask & (1 << j):
+                        continue
+                    for entry in sides:
+                        move = _move_cost(xs[i], side, xs[j], entry, layout)
+                        for exit in sides:
+                            cost = state[0] + move + _aisle_cost(spans[aisles[j]], entry, exit, layout)
+                            key = (mask | (1 << j), j, exit)
+                            if key not in best or cost < best[key][0]:
+                                best[key] = (cost, (mask, i, side), entry)
+
+    full = (1 << n) - 1
+    end, total = None, float("inf")
+    for i in range(n):
+        for side in sides:
+            state = best.get((full, i, side))
+            if state is not None:
+                cost = state[0] + _move_cost(xs[i], side, 0.0, FRONT, layout)
+                if cost < total:
+                    end, total = (full, i, side), cost
+
+    visits = []
+    key = end
+    while key is not None:
+        _, previous, entry = best[key]
+        visits.append((aisles[key[1]], entry, key[2]))
+        key = previous
+    visits.reverse()
+    return total, visits
+
+
+def _plan_heuristic(aisles, spans, sides, layout):
+    """2-opt over the order of the aisles, starting from ascending order"""
+    order = list(aisles)
+    total, visits = _assign_sides(order, spans, sides, layout)
+    improved = True
+    while improved:
+        improved = False
+        for i, j in itertools.combinations(range(len(order)), 2):
+            candidate = order[:i] + order[i : j + 1][::-1] + order[j + 1 :]
+            cost, candidate_visits = _assign_sides(candidate, spans, sides, layout)
+            if cost < total - 1e-9:
+                order, total, visits = candidate, cost, candidate_visits
+                improved = True
+    return total, visits
+
+
+def _assign_sides(order, spans, sides, layout):
+    """Optimal entry and exit sides for a fixed order of aisles, by dynamic programming over the order"""
+    # paths[side] = (cost, visits) of the cheapest way to have left the last aisle by that side
+    paths = {FRONT: (0.0, [])}
+    x = 0.0
+    for aisle in order:
+        next_x = layout.position(aisle)
+        next_paths = {}
+        for exit in sides:
+            options = (
+                (cost + _move_cost(x, side, next_x, entry, layout) + _aisle_cost(spans[aisle], entry, exit, layout), visits, entry)
+                for side, (cost, visits) in paths.items()
+                for entry in sides
+            )
+            cost, visits, entry = min(options, key=lambda option: option[0])
+            next_paths[exit] = (cost, visits + [(aisle, entry, exit)])
+        paths, x = next_paths, next_x
+    return min(
+        ((cost + _move_cost(x, side, 0.0, FRONT, layout), visits) for side, (cost, visits) in paths.items()),
+        key=lambda option: option[0],
+    )
@@ -0,0 +1,193 @@
+"""
+Deadline-aware order scheduling for the hub
+
+Decides which queued order a robot is sent out for next, based on an estimate of how long serving it takes,
+and keeps track of how well those estimates and the resulting deadlines hold up.
+"""
+
+import logging
+from collections import deque
+from enum import StrEnum
+
+from batching import estimate_service_time
+from common import OrderData
+from order_book import OrderBook, by_deadline
+
+# weight of the most recent trip when updating the service time correction factor
+CORRECTION_SMOOTHING = 0.2
+# relative change of the correction factor after which the least-slack queue is reordered
+REKEY_TOLERANCE = 0.1
+# number of recent orders kept for the lateness report
+LATENESS_HISTORY = 1000
+
+
+class SchedulingPolicy(StrEnum):
+    """Order in which queued orders are served"""
+
+    EDF = "edf"  # earliest deadline first
+    LEAST_SLACK = "least_slack"  # least time to spare once the estimated service time is accounted for
+
+
+class HopelessPolicy(StrEnum):
+    """What to do with an order that can no longer make its deadline"""
+
+    KEEP = "keep"  # serve it anyway in its normal turn
+    DEFER = "defer"  # serve it only once no order that can still make it is waiting
+    DROP = "drop"  # remove it from the queue
+
+
+class Scheduler:
+    """
+    Picks the next order to dispatch and measures predicted against actual lateness
+
+    Service time is estimated with the TIME_PER_ORDER/TIME_PER_PACKAGE model scaled by a correction factor
+    learned from the trips the robots complete. The slack of an order is its deadline minus the time it would
+    be delivered if it was dispatched now.
+
+    Under LEAST_SLACK the queue is keyed by the slack computed with the correction factor as of the last time
+    the queue was reordered, and reordered (O(n)) once the factor drifted by more than REKEY_TOLERANCE from it,
+    so the order of the queue never strays far from that of the current slack.
+    """
+
+    def __init__(
+        self,
+        policy: SchedulingPolicy = SchedulingPolicy.EDF,
+        hopeless: HopelessPolicy = HopelessPolicy.KEEP,
+    ):
+        self.policy = policy
+        self.hopeless = hopeless
+        self.correction: float = 1.0
+        # correction factor the least-slack keys of the queued orders were computed with
+        self.key_correction: float = 1.0
+        self.orders = OrderBook(by_deadline if policy == SchedulingPolicy.EDF else self._slack_key)
+        # hopeless orders waiting for the robots to have nothing better to do
+        self.deferred = OrderBook()
+
+        # trip id -> (dispatch time, uncorrected service time estimate, predicted completion, [(order id, deadline)])
+        self.in_flight: dict[str, tuple[float, float, float, list[tuple[str, int]]]] = {}
+        # (predicted lateness, actual lateness) of recently completed orders
+        self.lateness: deque[tuple[float, float]] = deque(maxlen=LATENESS_HISTORY)
+        self.first_dispatch: float | None = None
+        self.last_completion: float | None = None
+        self.dispatched_count = 0
+        self.on_time_count = 0
+        self.late_count = 0
+        self.dropped_count = 0
+        self.deferred_count = 0
+
+    def __len__(self) -> int:
+        return len(self.orders) + len(self.deferred)
+
+    def service_time(self, num_packages: int) -> float:
+        """Estimated time to serve a trip with the given number of packages"""
+        return estimate_service_time(num_packages) * self.correction
+
+    def slack(self, order: OrderData, now: float) -> float:
+        """Time to spare if the order was dispatched now, negative if it cannot make its deadline"""
+        return order["deadline"] - now - self.service_time(len(order["packages"]))
+
+    def _slack_key(self, order: OrderData) -> float:
+        # slack minus the current time, which is the same for every order and so does not change their order
+        return order["deadline"] - estimate_service_time(len(order["packages"])) * self.key_correction
+
+    def push(self, order: OrderData) -> str | None:
+        """Queue a new order, see OrderBook.push"""
+        return self.orders.push(order)
+
+    def requeue(self, order: OrderData):
+        """Put back an order that could not be delivered to a robot"""
+        self.orders.requeue(order)
+
+    def cancel(self, order_id: str) -> OrderData | None:
+        """Remove a queued or deferred order"""
+        order = self.orders.cancel(order_id)
+        return order if order is not None else self.deferred.cancel(order_id)
+
+    def update_deadline(self, order_id: str, deadline: int) -> bool:
+        """Change the deadline of a queued order, giving deferred orders another chance"""
+        if self.orders.update_deadline(order_id, deadline):
+            return True
+        order = self.deferred.cancel(order_id)
+        if order is None:
+            return False
+        self.orders.requeue({**order, "deadline": deadline})
+        return True
+
+    def next_order(self, now: float) -> OrderData | None:
+        """Remove and return the order a robot should be sent out for next
+
+        :param now: current time on the same clock as the order deadlines
+        :return: the order, or None if nothing is left to serve
+        """
+        while True:
+            order = self.orders.pop()
+            if order is None:
+                return self.deferred.pop()
+            if self.hopeless == HopelessPolicy.KEEP or self.slack(order, now) >= 0:
+                return order
+            if self.hopeless == HopelessPolicy.DEFER:
+                logging.info(f"deferring order {order['id']}: cannot make its deadline")
+                self.deferred.requeue(order)
+                self.deferred_count += 1
+            else:
+                logging.warning(f"dropping order {order['id']}: cannot make its deadline")
+                self.dropped_count += 1
+
+    def dispatched(self, trip: OrderData, members: list[OrderData], now: float):
+        """Record that a trip was handed to a robot"""
+        base = estimate_service_time(len(trip["packages"]))
+        predicted = now + base * self.correction
+        self.in_flight[trip["id"]] = (now, base, predicted, [(order["id"], order["deadline"]) for order in members])
+        if self.first_dispatch is None:
+            self.first_dispatch = now
+        self.dispatched_count += len(members)
+
+    def completed(self, trip_id: str, now: float):
+        """Record that a robot delivered a trip, and learn from how long it took"""
+        record = self.in_flight.pop(trip_id, None)
+        if record is None:
+            return
+        start, base, predicted, members = record
+        self.correction += CORRECTION_SMOOTHING * ((now - start) / base - self.correction)
+        if (
+            self.policy == SchedulingPolicy.LEAST_SLACK
+            and abs(self.correction - self.key_correction) > REKEY_TOLERANCE * self.key_correction
+        ):
+            logging.info(f"reordering the queue for a service time correction of {self.correction:.2f}")
+            self.key_correction = self.correction
+            self.orders.reprioritise()
+        for order_id, deadline in members:
+            self.lateness.append((predicted - deadline, now - deadline))
+            if now <= deadline:
+                self.on_time_count += 1
+            else:
+                self.late_count += 1
+        self.last_completion = now
+
+    def report(self) -> dict:
+        """Summary of the scheduling performance so far"""
+        completed = self.on_time_count + self.late_count
+        hours = (
+            (self.last_completion - self.first_dispatch) / 3600
+            if self.first_dispatch is not None and self.last_completion is not None
+            else 0
+        )
+        history = len(self.lateness)
+        return {
+            "policy": str(self.policy),
+            "hopeless": str(self.hopeless),
+            "queued": len(self.orders),
+            "deferred_queued": len(self.deferred),
+            "dispatched": self.dispatched_count,
+            "completed": completed,
+            "on_time": self.on_time_count,
+            "late": self.late_count,
+            "dropped": self.dropped_count,
+            "deferred": self.deferred_count,
+            "on_time_rate": self.on_time_count / completed if completed else None,
+            "on_time_per_hour": self.on_time_count / hours if hours else None,
+            "service_time_correction": self.correction,
+            "mean_predicted_lateness": sum(p for p, _ in self.lateness) / history if history else None,
+            "mean_actual_lateness": sum(a for _, a in self.lateness) / history if history else None,
+            "mean_prediction_error": sum(abs(a - p) for p, a in self.lateness) / history if history else None,
+        }
@@ -1,15 +1,60 @@
+import argparse
+import itertools
+import json
 import logging
+import math
+import os
+import random
 import threading
 import time
+from enum import StrEnum
+from typing import Iterable, Iterator
 # from typing import override # can cause problems due to missing package
 import zmq
-import json
 
-from common import SERVER_PORT, OrderData
+from common import (
+    CONTROLLER_PORT,
+    HUB_PORT,
+    SERVER_PORT,
+    TIME_PER_ORDER,
+    TIME_PER_PACKAGE,
+    OrderData,
+    PackageColor,
+    StatusEventType,
+)
+from metrics import RingBuffer
+import wire
 
 # json file to use for test orders
 TEST_ORDERS_FILE = "orders.json"
 
+# bytes read from the trace at a time when streaming it
+READ_CHUNK = 64 * 1024
+# how often replay progress is logged (seconds)
+REPORT_INTERVAL = 5.0
+
+# host of the delivery hub and the robots, queried for metrics when generating load
+HUB_HOST = "localhost"
+CONTROLLER_HOST = "localhost"
+
+# bursty profile: mean length of a burst/quiet cycle (seconds) and fraction of it spent bursting
+BURST_PERIOD = 60.0
+BURST_DUTY = 0.2
+# diurnal profile: length of a "day" (seconds) and relative amplitude of the arrival rate swing
+DIURNAL_PERIOD = 86400.0
+DIURNAL_AMPLITUDE = 0.8
+# deadlines are drawn between these multiples of the estimated service time after arrival
+DEADLINE_FACTOR = (1.0, 3.0)
+# how often the load monitor asks the hub for its stats (seconds)
+MONITOR_INTERVAL = 1.0
+# how long the load monitor waits for status events at a time (milliseconds)
+POLL_INTERVAL_MS = 100
+# how long the load monitor waits for the hub to answer a stats request before reconnecting (milliseconds)
+HUB_TIMEOUT_MS = 5000
+# orders the load monitor stops waiting for: published this long ago (seconds), or the oldest beyond this many
+PENDING_TIMEOUT = 3600.0
+MAX_PENDING = 100000
+
 
 class TestOrderData(OrderData):
     """Struct representing the data of a single test order"""
@@ -17,43 +62,400 @@ class TestOrderData(OrderData):
     time: int  # the time from the thread start for the order to "arrive"
 
 
+def iter_orders(filename: str) -> Iterator[TestOrderData]:
+    """Stream the orders of a trace file without loading the whole file
+
+    Supports a JSON array of orders (as written by generate_orders.py) and JSON lines, one order per line.
+    """
+    with open(filename) as f:
+        first = f.read(1)
+        while first.isspace():
+            first = f.read(1)
+        if first == "[":
+            yield from _iter_json_array(f)
+        elif first:
+            yield json.loads(first + f.readline())
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def _iter_json_array(f) -> Iterator[TestOrderData]:
+    """Incrementally decode the elements of a JSON array whose opening bracket was already read"""
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    eof = False
+    while True:
+        # skip whitespace and the separators between elements
+        while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+            pos += 1
+        if pos < len(buffer) and buffer[pos] == "]":
+            return
+        try:
+            if pos == len(buffer):
+                raise ValueError("need more data")
+            order, pos = decoder.raw_decode(buffer, pos)
+        except ValueError:
+            if eof:
+                raise
+            chunk = f.read(READ_CHUNK)
+            eof = not chunk
+            buffer = buffer[pos:] + chunk
+            pos = 0
+            continue
+        yield order
+
+
+class LoadProfile(StrEnum):
+    """Shape of the arrival rate of synthetic orders over time"""
+
+    POISSON = "poisson"  # constant rate, exponential inter-arrival times
+    BURSTY = "bursty"  # on/off: bursts at rate/BURST_DUTY separated by quiet periods without orders
+    DIURNAL = "diurnal"  # rate swinging sinusoidally around the mean over DIURNAL_PERIOD
+
+
+def synthetic_orders(
+    rate: float,
+    profile: LoadProfile = LoadProfile.POISSON,
+    min_packages: int = 1,
+    max_packages: int = 3,
+    num_aisles: int = 3,
+    aisle_skew: float = 0.0,
+    duration: float | None = None,
+    seed: int | None = None,
+) -> Iterator[TestOrderData]:
+    """Generate an open-loop stream of random orders
+
+    Arrival times follow the given profile with a long-run mean of rate orders per second. The package count is
+    uniform between min_packages and max_packages, the color uniform and the aisle Zipf-distributed with
+    exponent aisle_skew (0 for uniform). Deadlines are drawn like generate_orders.py does.
+
+    :param duration: stop after this many seconds of arrivals, never if None
+    :param seed: seed of the random generator, for reproducible load
+    """
+    rng = random.Random(seed)
+    colors = list(PackageColor)
+    aisle_weights = list(itertools.accumulate((aisle + 1) ** -aisle_skew for aisle in range(num_aisles)))
+    aisles = range(num_aisles)
+    # ids unique to this run, so the hub never mistakes them for orders of a previous run
+    prefix = f"load-{time.time_ns():x}"
+
+    peak = rate
+    if profile == LoadProfile.BURSTY:
+        peak = rate / BURST_DUTY
+    elif profile == LoadProfile.DIURNAL:
+        peak = rate * (1 + DIURNAL_AMPLITUDE)
+    # first burst starts right away
+    burst_end = rng.expovariate(1 / (BURST_PERIOD * BURST_DUTY))
+    quiet_end = burst_end + rng.expovariate(1 / (BURST_PERIOD * (1 - BURST_DUTY)))
+
+    t = 0.0
+    for i in itertools.count():
+        if profile == LoadProfile.BURSTY:
+            t += rng.expovariate(peak)
+            while t >= burst_end:
+                # skip the quiet period, the exponential inter-arrival time carries over into the next burst
+                t = quiet_end + (t - burst_end)
+                burst_end = quiet_end + rng.expovariate(1 / (BURST_PERIOD * BURST_DUTY))
+                quiet_end = burst_end + rng.expovariate(1 / (BURST_PERIOD * (1 - BURST_DUTY)))
+        elif profile == LoadProfile.DIURNAL:
+            # thinning of a Poisson process at the peak rate
+            while True:
+                t += rng.expovariate(peak)
+                current = rate * (1 + DIURNAL_AMPLITUDE * math.sin(2 * math.pi * t / DIURNAL_PERIOD))
+                if rng.random() * peak < current:
+                    break
+        else:
+            t += rng.expovariate(rate)
+        if duration is not None and t > duration:
+            return
+
+        num_packages = rng.randint(min_packages, max_packages)
+        difficulty = TIME_PER_ORDER + TIME_PER_PACKAGE * num_packages
+        yield {
+            "id": f"{prefix}-{i}",
+            "time": t,
+            "deadline": math.ceil(t + difficulty * rng.uniform(*DEADLINE_FACTOR)),
+            "packages": [
+                {"color": rng.choice(colors), "aisle": aisle}
+                for aisle in rng.choices(aisles, cum_weights=aisle_weights, k=num_packages)
+            ],
+        }
+
+
+class LoadMonitor(threading.Thread):
+    """
+    Measures how the hub and the fleet keep up with the orders the server publishes
+
+    Periodically asks the hub for its stats to sample the queue depth, and listens to the status events of the
+    robots to measure the end-to-end latency of every order, from being published to being dropped off. Orders
+    not delivered within PENDING_TIMEOUT, or beyond the MAX_PENDING most recent ones, are counted as expired and
+    no longer waited for.
+    """
+
+    def __init__(self, hub_host: str = HUB_HOST, hub_port: int = HUB_PORT, controller_hosts: list[str] | None = None):
+        super().__init__(name="MONITOR", daemon=True)
+        self.hub_address = f"tcp://{hub_host}:{hub_port}"
+        self.ctx = zmq.Context()
+        self.hub_sock: zmq.Socket | None = None
+        # perf_counter time the pending stats request was sent at
+        self._query_sent = 0.0
+        self.status_sock = self.ctx.socket(zmq.SUB)
+        for host in controller_hosts or [CONTROLLER_HOST]:
+            self.status_sock.connect(f"tcp://{host}:{CONTROLLER_PORT}")
+        self.status_sock.setsockopt_string(zmq.SUBSCRIBE, "")
+        self._stop_event = threading.Event()
+
+        # publish time of every order not yet delivered, oldest first, shared with the server thread
+        self.pending: dict[str, float] = {}
+        self._pending_lock = threading.Lock()
+        self.latencies = RingBuffer(10000)
+        self.queue_depth = RingBuffer(10000)
+        self.delivered = 0
+        self.expired = 0
+        self.hub_stats: dict | None = None
+
+    def published(self, order_id: str, when: float):
+        """Record that an order was published at the given perf_counter time"""
+        with self._pending_lock:
+            self.pending[order_id] = when
+            if len(self.pending) > MAX_PENDING:
+                del self.pending[next(iter(self.pending))]
+                self.expired += 1
+
+    def stop(self):
+        self._stop_event.set()
+
+    def report(self) -> dict:
+        """Queueing and end-to-end latency measured so far"""
+        return {
+            "delivered": self.delivered,
+            "undelivered": len(self.pending),
+            "expired": self.expired,
+            "queued": self.queue_depth.values()[-1] if len(self.queue_depth) else None,
+            "queued_mean": self.queue_depth.mean(),
+            "queued_max": max(self.queue_depth.values(), default=None),
+            "latency_p50": self.latencies.percentile(50),
+            "latency_p95": self.latencies.percentile(95),
+            "latency_p99": self.latencies.percentile(99),
+        }
+
+    def _query_hub(self):
+        if self.hub_sock is None:
+            self.hub_sock = self.ctx.socket(zmq.REQ)
+            self.hub_sock.setsockopt(zmq.RCVTIMEO, HUB_TIMEOUT_MS)
+            self.hub_sock.connect(self.hub_address)
+            self._send_query()
+        if not self.hub_sock.poll(0):
+            if time.perf_counter() - self._query_sent > HUB_TIMEOUT_MS / 1000:
+                # a REQ socket cannot send again before it got its reply: start over with a new one
+                logging.warning("hub did not answer the stats request, reconnecting")
+                self.hub_sock.close(linger=0)
+                self.hub_sock = None
+            return
+        self.hub_stats = self.hub_sock.recv_json()
+        report = self.hub_stats["scheduling"]
+        self.queue_depth.append(report["queued"] + report["deferred_queued"])
+        self._send_query()
+
+    def _send_query(self):
+        self.hub_sock.send_json({"command": "stats"})
+        self._query_sent = time.perf_counter()
+
+    def _expire(self, now: float):
+        with self._pending_lock:
+            while self.pending:
+                order_id, published = next(iter(self.pending.items()))
+                if now - published < PENDING_TIMEOUT:
+                    return
+                del self.pending[order_id]
+                self.expired += 1
+
+    def _recv_status(self):
+        while True:
+            try:
+                event = wire.decode(self.status_sock.recv_multipart(zmq.NOBLOCK))
+            except zmq.Again:
+                return
+            except ValueError:
+                continue
+            if not isinstance(event, dict) or event.get("type") != StatusEventType.DROPOFF:
+                continue
+            now = time.perf_counter()
+            # packages are tagged with their order when the hub batched several orders into the trip
+            orders = {package.get("order_id", event["order_id"]) for package in event["packages"] + event["failed"]}
+            for order_id in orders:
+                with self._pending_lock:
+                    published = self.pending.pop(order_id, None)
+                if published is not None:
+                    self.latencies.append(now - published)
+                    self.delivered += 1
+
+    # @override
+    def run(self) -> None:
+        next_query = time.perf_counter()
+        while not self._stop_event.is_set():
+            if self.status_sock.poll(POLL_INTERVAL_MS):
+                self._recv_status()
+            now = time.perf_counter()
+            if now >= next_query:
+                next_query += MONITOR_INTERVAL
+                self._query_hub()
+                self._expire(now)
+        if self.hub_sock is not None:
+            self.hub_sock.close(linger=0)
+        self.ctx.destroy(linger=0)
+
+
 class ServerThread(threading.Thread):
     """
     Central Server thread used for testing
-    Responsible for reading the order data from a json file and sending the orders to the delivery hub.
+    Responsible for streaming the order data from a trace file (or any other source of orders, such as
+    synthetic_orders) and sending the orders to the delivery hub.
+
+    The trace is replayed with its timestamps and deadlines divided by the speed factor, so every order keeps
+    the same share of the replay to be delivered in, or as fast as possible with the deadlines of the trace if
+    the speed is 0. The publish rate and the drift of each publish behind its scheduled time are reported as it runs,
+    along with the hub-side measurements of the monitor if one is given.
     """
 
-    def __init__(self, port: int):
+    def __init__(
+        self,
+        port: int,
+        orders_file: str = TEST_ORDERS_FILE,
+        speed: float = 1.0,
+        orders: Iterable[TestOrderData] | None = None,
+        monitor: LoadMonitor | None = None,
+        wire_format: wire.WireFormat = wire.WireFormat.BINARY,
+    ):
         super().__init__(name="SERVER")
-        with open(TEST_ORDERS_FILE) as f:
-            self.orders: list[TestOrderData] = json.load(f)
+        self.orders_file = orders_file
+        self.orders = orders
+        self.speed = speed
+        self.monitor = monitor
+        self.wire_format = wire_format
         self.ctx = zmq.Context()
         self.sock = self.ctx.socket(zmq.PUB)
+        # queue instead of dropping orders when replaying faster than the hub drains them
+        self.sock.setsockopt(zmq.SNDHWM, 0)
         self.sock.bind(f"tcp://*:{port}")
 
+        self.published = 0
+        self.elapsed = 0.0
+        # how late each publish was compared to the scaled trace time (seconds)
+        self.drift = RingBuffer(10000)
+
+    def report(self) -> dict:
+        """Publish rate and schedule drift so far"""
+        report = {
+            "published": self.published,
+            "elapsed": self.elapsed,
+            "rate": self.published / self.elapsed if self.elapsed else None,
+            "drift_mean": self.drift.mean(),
+            "drift_p99": self.drift.percentile(99),
+            "drift_max": max(self.drift.values(), default=None),
+        }
+        if self.monitor is not None:
+            report.update(self.monitor.report())
+        return report
+
     # @override
     def run(self) -> None:
         logging.info("starting")
-        start_time = time.time()
+        if self.orders is None:
+            source = os.path.basename(self.orders_file)
+            orders = iter_orders(self.orders_file)
+        else:
+            source = "orders"
+            orders = self.orders
+        start_time = time.perf_counter()
+        last_report = start_time
         logging.debug(f"start time: {start_time}")
-        for order in self.orders:
-            # wait for the next order "arrival"
-            sleep_time = order["time"] + start_time - time.time()
-            if sleep_time > 0:
-                logging.debug(f"sleeping for {sleep_time}")
-                time.sleep(sleep_time)
+        for i, order in enumerate(orders):
+            if self.speed:
+                # wait for the next order "arrival"
+                scheduled = start_time + order["time"] / self.speed
+                sleep_time = scheduled - time.perf_counter()
+                if sleep_time > 0:
+                    time.sleep(sleep_time)
             msg: OrderData = {
-                "deadline": order["deadline"],
+                # stable id so the hub can recognise the order if it is published again
+                "id": order.get("id", f"{source}:{i}"),
+                # deadlines are on the same clock as the arrival times, which starts with the hub
+                "deadline": math.ceil(order["deadline"] / self.speed) if self.speed else order["deadline"],
                 "packages": order["packages"],
             }
-            self.sock.send_json(msg)
-            logging.info(f"published order: {msg}")
+            self.sock.send_multipart(wire.encode(msg, wire.MessageKind.ORDER, self.wire_format), copy=False)
+            logging.debug("published order: %s", msg)
+            now = time.perf_counter()
+            if self.monitor is not None:
+                self.monitor.published(msg["id"], now)
+            if self.speed:
+                self.drift.append(now - scheduled)
+            self.published += 1
+            self.elapsed = now - start_time
+            if now - last_report >= REPORT_INTERVAL:
+                last_report = now
+                logging.info(f"replay progress: {self.report()}")
+        self.elapsed = time.perf_counter() - start_time
+        logging.info(f"replay finished: {self.report()}")
         logging.info("shutting down")
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay an order trace or generate load for the delivery hub")
+    parser.add_argument("--file", default=TEST_ORDERS_FILE, help="JSON or JSON lines order trace")
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="replay speed factor, dividing arrival times and deadlines alike, 0 to publish as fast as possible",
+    )
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument(
+        "--wire",
+        type=wire.WireFormat,
+        choices=list(wire.WireFormat),
+        default=wire.WireFormat.BINARY,
+        help="encoding of the published orders, json for hubs that predate the binary format",
+    )
+    load = parser.add_argument_group("synthetic load", "generate orders on the fly instead of replaying --file")
+    load.add_argument("--profile", type=LoadProfile, choices=list(LoadProfile), help="arrival rate profile")
+    load.add_argument("--rate", type=float, default=0.1, help="mean arrival rate (orders per second)")
+    load.add_argument("--duration", type=float, help="seconds of arrivals to generate, unbounded by default")
+    load.add_argument("--min-packages", type=int, default=1)
+    load.add_argument("--max-packages", type=int, default=3)
+    load.add_argument("--aisles", type=int, default=3, help="number of aisles packages are drawn from")
+    load.add_argument("--aisle-skew", type=float, default=0.0, help="Zipf exponent of the aisle popularity")
+    load.add_argument("--seed", type=int)
+    load.add_argument("--hub", default=HUB_HOST, help="hub host queried for the queue depth")
+    load.add_argument("--controllers", nargs="*", help="robot hosts listened to for the end-to-end latency")
+    args = parser.parse_args()
     logging.basicConfig(
         level=logging.DEBUG, format="[{threadName}]: {message}", style="{"
     )
-    t = ServerThread(SERVER_PORT)
+    monitor = None
+    if args.profile is None:
+        t = ServerThread(args.port, args.file, args.speed, wire_format=args.wire)
+    else:
+        monitor = LoadMonitor(args.hub, HUB_PORT, args.controllers)
+        monitor.start()
+        orders = synthetic_orders(
+            args.rate,
+            args.profile,
+            args.min_packages,
+            args.max_packages,
+            args.aisles,
+            args.aisle_skew,
+            args.duration,
+            args.seed,
+        )
+        t = ServerThread(args.port, speed=args.speed, orders=orders, monitor=monitor, wire_format=args.wire)
     t.start()
+    try:
+        t.join()
+    finally:
+        if monitor is not None:
+            monitor.stop()
+            monitor.join()
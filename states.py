@@ -1,163 +1,187 @@
 """ State and state machine Code """
 import logging
-from typing import List
+import os
+import time
+from typing import Callable, Dict, List, Optional, Tuple, Type
+
+from metrics import Histogram
 
 logging.basicConfig(filename="logs.txt", level=logging.DEBUG, format=f'[STATES] %(asctime)s - %(levelname)s - %(message)s')
 
+# number of transitions kept by the controller's trace, 0 to disable tracing
+TRACE_CAPACITY = int(os.environ.get("DELIVERPI_TRACE", "0"))
+
 class State():
     """ Generalized class for a state
     """
-    @staticmethod
-    def determine_next_state(event: str) -> "State":
-        pass
-    
-    @classmethod
-    def process_event(cls, event: str) -> "State":
-        """Process an event
-
-        :param event: event to process
-        :return: next state to move to, if any
-        """
-        logging.debug(f"State {cls.name()} processing event {event}")
-        return cls.determine_next_state(event)
-    
     @classmethod
     def name(cls):
         return cls.__name__
-    
+
+class PreviousState(State):
+    """Placeholder state to notify state machine to revert to previous state
+    """
+    pass
+
+# state -> event -> next state, events missing from a state's table leave the state unchanged
+TransitionTable = Dict[Type[State], Dict[str, Type[State]]]
+
+def validate_transitions(transitions: TransitionTable, initial: Type[State]):
+    """Check a transition table for mistakes
+
+    :param transitions: table to check
+    :param initial: state the machine starts in
+    :raises ValueError: if a transition leads to a state without a table, a state cannot be reached from the
+        initial state, or a state can never be left
+    """
+    for state, table in transitions.items():
+        for event, target in table.items():
+            if target is not PreviousState and target not in transitions:
+                raise ValueError(f"{state.name()} goes to unknown state {target.name()} on {event}")
+    reachable = {initial}
+    frontier = [initial]
+    while frontier:
+        for target in transitions[frontier.pop()].values():
+            if target not in reachable and target is not PreviousState:
+                reachable.add(target)
+                frontier.append(target)
+    unreachable = [state.name() for state in transitions if state not in reachable]
+    if unreachable:
+        raise ValueError(f"unreachable states: {unreachable}")
+    dead = [state.name() for state, table in transitions.items() if all(target is state for target in table.values())]
+    if dead:
+        raise ValueError(f"states that can never be left: {dead}")
+
+class TransitionTrace():
+    """ Fixed-size record of the most recent events handled by a state machine
+    """
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._entries: List[Optional[Tuple[float, str, str, str]]] = [None] * capacity
+        self._next = 0
+
+    def record(self, old_state: Type[State], event: str, new_state: Type[State]):
+        self._entries[self._next % self.capacity] = (time.time(), old_state.__name__, event, new_state.__name__)
+        self._next += 1
+
+    def entries(self) -> List[Tuple[float, str, str, str]]:
+        """(timestamp, from state, event, to state) of the recorded events, oldest first"""
+        if self._next <= self.capacity:
+            return self._entries[:self._next]
+        split = self._next % self.capacity
+        return self._entries[split:] + self._entries[:split]
+
 class StateMachine():
-    """ Generalized state machine class
-    """ 
-    states: List[State]
-    previous_state: State
-    state: State
-    
-    def get_next_state(self, event: str) -> State:
+    """ Generalized state machine class driven by a transition table
+
+    The table is validated when the machine is created. Tracing is off unless trace_capacity is given, in
+    which case every event handled is recorded in self.trace.
+
+    The time spent in each state is recorded in a histogram per state every time the state is left, and summed
+    per state since the last reset_breakdown (e.g. per order) for breakdown. Times are read from clock, which a
+    simulation can replace with its own.
+    """
+    previous_state: Optional[Type[State]]
+    state: Type[State]
+    trace: Optional[TransitionTrace]
+
+    def __init__(
+        self,
+        transitions: TransitionTable,
+        initial: Type[State],
+        trace_capacity: int = 0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        validate_transitions(transitions, initial)
+        self.transitions = transitions
+        self.previous_state = None
+        self.state = initial
+        self.trace = TransitionTrace(trace_capacity) if trace_capacity else None
+        self.clock = clock
+        self.entered = clock()
+        self.dwell: Dict[str, Histogram] = {state.__name__: Histogram() for state in transitions}
+        self._breakdown: Dict[str, float] = {}
+        self._breakdown_since = self.entered
+
+    def get_next_state(self, event: str) -> Type[State]:
         """Get the next state but do not move to it
 
         :param event: event to test
         :return: potential next state or current state
         """
-        return self.state.process_event(event)
-        
-    def transition(self, event: str) -> State:
+        return self.transitions[self.state].get(event, self.state)
+
+    def transition(self, event: str) -> Type[State]:
         """Handle a state transition
 
         :param event: event to handle
         :return: new state of machine
         """
         old_state = self.state
-        new_state = self.get_next_state(event)
-        
-        if new_state != old_state:
-            if new_state.name() == "PreviousState":
+        new_state = self.transitions[old_state].get(event, old_state)
+
+        if new_state is not old_state:
+            now = self.clock()
+            name = old_state.__name__
+            self.dwell[name].record(now - self.entered)
+            self._breakdown[name] = self._breakdown.get(name, 0.0) + now - max(self.entered, self._breakdown_since)
+            self.entered = now
+            if new_state is PreviousState:
                 self.state = self.previous_state
-                self.previous_state = old_state
             else:
-                self.previous_state = old_state
                 self.state = new_state
-            logging.info(f"Transitioned from {old_state.name()} to {self.state.name()}")
-        else:
-            logging.debug(f"No transition from {old_state.name()} for event {event}")
-            
+            self.previous_state = old_state
+            logging.info("Transitioned from %s to %s", old_state.__name__, self.state.__name__)
+        if self.trace is not None:
+            self.trace.record(old_state, event, self.state)
+
         return self.state
-    
+
+    def breakdown(self) -> Dict[str, float]:
+        """Seconds spent in each state since the last reset_breakdown, including the current state so far"""
+        breakdown = dict(self._breakdown)
+        name = self.state.__name__
+        breakdown[name] = breakdown.get(name, 0.0) + self.clock() - max(self.entered, self._breakdown_since)
+        return breakdown
+
+    def reset_breakdown(self):
+        """Start a new breakdown of the time spent in each state"""
+        self._breakdown = {}
+        self._breakdown_since = self.clock()
+
     def __str__(self):
         return self.__class__.__name__
-    
+
 class ControllerStates:
     """ Container class to hold all possible controller states
     """
-    
-    class PreviousState(State):
-        """Placeholder state to notify state machine to revert to previous state
-        """
-        pass
-    
+
+    PreviousState = PreviousState
+
     class PathBlockedState(State):
-        def determine_next_state(event):
-            match event:
-                case "path_unblocked":
-                    return ControllerStates.PreviousState
-                case "path_blocked":
-                    return ControllerStates.PathBlockedState
-                case _:
-                    return ControllerStates.PathBlockedState
-    
+        pass
+
     class MovingToAisleState(State):
-        def determine_next_state(event):
-            match event:
-                case "picking_init":
-                    return ControllerStates.PickingState
-                case "path_blocked":
-                    return ControllerStates.PathBlockedState
-                case _:
-                    return ControllerStates.MovingToAisleState 
+        pass
 
     class ExitAisleState(State):
-        def determine_next_state(event):
-            match event:
-                case "to_aisle":
-                    return ControllerStates.MovingToAisleState
-                case "to_hub":
-                    return ControllerStates.MovingToHubState
-                case "path_blocked":
-                    return ControllerStates.PathBlockedState
-                case _:
-                    return ControllerStates.ExitAisleState
-                
+        pass
+
     class MovingToHubState(State):
-        def determine_next_state(event):
-            match event:
-                case "movement_complete":
-                    return ControllerStates.IdleState
-                case "path_blocked":
-                    return ControllerStates.PathBlockedState
-                case _:
-                    return ControllerStates.MovingToHubState 
-                
+        pass
+
     class PickingState(State):
-        def determine_next_state(event):
-            match event:
-                case "order_complete":
-                    return ControllerStates.MovingToHubState
-                case "aisle_complete":
-                    return ControllerStates.MovingToAisleState
-                case "path_blocked":
-                    return ControllerStates.PathBlockedState
-                case "color_detected":
-                    return ControllerStates.GrabbingState
-                case "not_detected":
-                    return ControllerStates.ExitAisleState
-                case _:
-                    return ControllerStates.PickingState 
-                
+        pass
+
     class GrabbingState(State):
-        def determine_next_state(event):
-            match event:
-                case "order_grabbed":
-                    return ControllerStates.PickingState
-                case "exiting":
-                    return ControllerStates.ExitAisleState
-                case _:
-                    return ControllerStates.GrabbingState 
-        
+        pass
+
     class IdleState(State):
-        def determine_next_state(event):
-            match event:
-                case "order_received":
-                    return ControllerStates.MovingToAisleState
-                case _:
-                    return ControllerStates.IdleState
-                    
+        pass
+
     class InitState(State):
-        def determine_next_state(event):
-            match event:
-                case "init_done":
-                    return ControllerStates.IdleState
-                case _:
-                    return ControllerStates.InitState
-    
+        pass
+
     def __new__(cls):
         return [
             cls.PreviousState,
@@ -170,16 +194,54 @@ class ControllerStates:
             cls.IdleState,
             cls.InitState
         ]
-    
-class ControllerStateMachine(StateMachine):      
+
+CONTROLLER_TRANSITIONS: TransitionTable = {
+    ControllerStates.PathBlockedState: {
+        "path_unblocked": ControllerStates.PreviousState,
+    },
+    ControllerStates.MovingToAisleState: {
+        "picking_init": ControllerStates.PickingState,
+        "path_blocked": ControllerStates.PathBlockedState,
+    },
+    ControllerStates.ExitAisleState: {
+        "to_aisle": ControllerStates.MovingToAisleState,
+        "to_hub": ControllerStates.MovingToHubState,
+        "path_blocked": ControllerStates.PathBlockedState,
+    },
+    ControllerStates.MovingToHubState: {
+        "movement_complete": ControllerStates.IdleState,
+        "path_blocked": ControllerStates.PathBlockedState,
+    },
+    ControllerStates.PickingState: {
+        "order_complete": ControllerStates.MovingToHubState,
+        "aisle_complete": ControllerStates.MovingToAisleState,
+        "path_blocked": ControllerStates.PathBlockedState,
+        "color_detected": ControllerStates.GrabbingState,
+        "not_detected": ControllerStates.ExitAisleState,
+    },
+    ControllerStates.GrabbingState: {
+        "order_grabbed": ControllerStates.PickingState,
+        "exiting": ControllerStates.ExitAisleState,
+    },
+    ControllerStates.IdleState: {
+        "order_received": ControllerStates.MovingToAisleState,
+    },
+    ControllerStates.InitState: {
+        "init_done": ControllerStates.IdleState,
+    },
+}
+# fail at import rather than on the robot if the table is broken
+validate_transitions(CONTROLLER_TRANSITIONS, ControllerStates.InitState)
+
+class ControllerStateMachine(StateMachine):
     instance = None
-    _initialized = False  
-    def __new__(cls): 
+    _initialized = False
+    def __new__(cls):
         if cls.instance == None:
             cls.instance = super().__new__(cls)
         return cls.instance
-    
+
     def __init__(self):
         if not self._initialized:
-            self.previous_state = None
-            self.state = ControllerStates.InitState
\ No newline at end of file
+            super().__init__(CONTROLLER_TRANSITIONS, ControllerStates.InitState, TRACE_CAPACITY)
+            self._initialized = True
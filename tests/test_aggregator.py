@@ -0,0 +1,60 @@
+"""
+Rolling fleet metrics of the hub
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from aggregator import StatusAggregator  # noqa: E402
+from common import StatusEventType, validate_status_event  # noqa: E402
+from metrics import Histogram  # noqa: E402
+
+
+def _dropoff(order_id: str, timestamp: float) -> dict:
+    package = {"color": "RED", "aisle": 1}
+    return {"type": StatusEventType.DROPOFF, "robot": "r1", "timestamp": timestamp, "order_id": order_id,
+            "packages": [package], "failed": []}
+
+
+def test_throughput_counts_the_whole_window():
+    aggregator = StatusAggregator(history=16, window=100.0, max_rate=10.0)
+    for i in range(500):
+        aggregator.record(_dropoff(f"o{i}", i * 0.1), i * 0.1)
+    assert aggregator.snapshot(50.0)["orders_per_hour"] == 500 * 3600 / 100
+
+
+def test_orders_never_dropped_off_expire():
+    aggregator = StatusAggregator(window=100.0, expiry=1000.0)
+    aggregator.expect("lost", 10)
+    aggregator.record(
+        {"type": StatusEventType.ORDER_ACCEPTED, "robot": "r1", "timestamp": 5.0, "order_id": "lost",
+         "orders": ["lost"]},
+        5.0,
+    )
+    assert aggregator.snapshot(500.0)["orders_out"] == 1
+    snapshot = aggregator.snapshot(1200.0)
+    assert snapshot["orders_out"] == 0
+    assert snapshot["deadline_miss_rate"] == 1.0
+    assert not aggregator.accepted
+
+
+def test_malformed_events_are_rejected():
+    assert validate_status_event(_dropoff("o1", 0.0))
+    assert not validate_status_event({**_dropoff("o1", 0.0), "packages": "RED"})
+    assert not validate_status_event({**_dropoff("o1", 0.0), "failed": [1]})
+    assert not validate_status_event({**_dropoff("o1", 0.0), "order_id": ["o1"]})
+    assert not validate_status_event({"type": StatusEventType.STATE_DWELL, "robot": "r1", "timestamp": 0.0, "dwell": []})
+
+
+def test_histograms_that_cannot_be_merged_are_skipped():
+    aggregator = StatusAggregator()
+    histogram = Histogram()
+    histogram.record(1.0)
+    other = Histogram(sub_buckets=8)
+    other.record(2.0)
+    for robot, dwell in (("r1", histogram.export()), ("r2", other.export()), ("r3", {"count": "many"})):
+        event = {"type": StatusEventType.STATE_DWELL, "robot": robot, "timestamp": 0.0, "dwell": {"IdleState": dwell}}
+        assert validate_status_event(event)
+        aggregator.record(event, 0.0)
+    assert aggregator.snapshot(0.0)["time_in_state"]["IdleState"]["count"] == 1
@@ -0,0 +1,28 @@
+"""
+Order in which the scheduler serves the queued orders
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from scheduler import Scheduler, SchedulingPolicy  # noqa: E402
+
+
+def _order(order_id: str, deadline: int, num_packages: int) -> dict:
+    return {"id": order_id, "deadline": deadline, "packages": [{"color": "RED", "aisle": 1}] * num_packages}
+
+
+def test_least_slack_follows_the_correction():
+    scheduler = Scheduler(SchedulingPolicy.LEAST_SLACK)
+    scheduler.push(_order("small", 200, 1))
+    scheduler.push(_order("large", 260, 5))
+    assert scheduler.orders.peek()["id"] == "small"
+
+    # trips take far longer than estimated: the large order now has the least slack
+    trip = _order("trip", 0, 1)
+    scheduler.dispatched(trip, [], 0)
+    scheduler.completed("trip", 400)
+    assert scheduler.key_correction == scheduler.correction
+    assert scheduler.slack(scheduler.orders.get("large"), 0) < scheduler.slack(scheduler.orders.get("small"), 0)
+    assert scheduler.next_order(0)["id"] == "large"
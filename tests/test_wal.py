@@ -0,0 +1,138 @@
+"""
+Recovery of the hub's order state from the write-ahead log
+"""
+
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import wal  # noqa: E402
+from scheduler import Scheduler  # noqa: E402
+from wal import WriteAheadLog  # noqa: E402
+
+
+def _order(i: int) -> dict:
+    return {"id": f"o{i}", "deadline": 100 + i, "packages": [{"color": "RED", "aisle": 1 + i % 3}]}
+
+
+def _recover(directory: str) -> tuple[Scheduler, dict]:
+    scheduler, assignments = Scheduler(), {}
+    log = WriteAheadLog(directory, sync=False)
+    log.recover(scheduler, assignments)
+    log.close()
+    return scheduler, assignments
+
+
+def test_changes_while_snapshot_is_written(tmp_path, monkeypatch):
+    resume = threading.Event()
+    write_snapshot = WriteAheadLog._write_snapshot
+
+    def delayed_write(self, *args):
+        resume.wait()
+        write_snapshot(self, *args)
+
+    monkeypatch.setattr(WriteAheadLog, "_write_snapshot", delayed_write)
+    log = WriteAheadLog(str(tmp_path), sync=False)
+    scheduler = Scheduler()
+    for i in range(5):
+        scheduler.push(_order(i))
+        log.log_arrival(_order(i))
+    log.snapshot(scheduler, {})
+    # the book changes after it was copied but before the copy is written out
+    scheduler.update_deadline("o2", 50)
+    log.log_update(scheduler.orders.get("o2"))
+    scheduler.cancel("o4")
+    log.log_cancel("o4")
+    resume.set()
+    log.close()
+
+    recovered, _ = _recover(str(tmp_path))
+    assert sorted(order["id"] for order in recovered.orders) == ["o0", "o1", "o2", "o3"]
+    assert recovered.orders.get("o2")["deadline"] == 50
+    assert recovered.next_order(0)["id"] == "o2"
+
+
+def test_recovery_loads_chunks_lazily(tmp_path, monkeypatch):
+    monkeypatch.setattr(wal, "CHUNK_ENTRIES", 10)
+    log = WriteAheadLog(str(tmp_path), sync=False)
+    scheduler, assignments = Scheduler(), {}
+    for i in reversed(range(100)):
+        scheduler.push(_order(i))
+        log.log_arrival(_order(i))
+    trip = {"id": "o0", "orders": ["o0"], "deadline": 100, "packages": _order(0)["packages"]}
+    scheduler.next_order(0)
+    scheduler.dispatched(trip, [_order(0)], 5.0)
+    assignments[b"robot"] = trip
+    log.log_dispatch(b"robot", trip, 5.0)
+    log.snapshot(scheduler, assignments)
+    scheduler.cancel("o1")
+    log.log_cancel("o1")
+    log.close()
+
+    recovered, recovered_assignments = _recover(str(tmp_path))
+    assert recovered_assignments == assignments
+    assert "o0" in recovered.in_flight
+    assert len(recovered) == 98
+    assert recovered.orders.load_cold(0)
+    # orders already dispatched are not accepted again
+    assert recovered.push(_order(0)) is None
+    served = [recovered.next_order(0)["id"] for _ in range(98)]
+    assert served == [f"o{i}" for i in range(2, 100)]
+    assert recovered.next_order(0) is None
+
+
+def test_orders_outside_the_packed_encoding(tmp_path):
+    log = WriteAheadLog(str(tmp_path), sync=False)
+    huge_deadline = {**_order(0), "deadline": 2**70}
+    long_id = {**_order(1), "id": "x" * 70000}
+    log.log_arrival(huge_deadline)
+    log.log_arrival(long_id)
+    log.close()
+
+    recovered, _ = _recover(str(tmp_path))
+    assert recovered.orders.get("o0") == huge_deadline
+    assert recovered.orders.get(long_id["id"]) == long_id
+
+
+def test_epoch_survives_a_crash_before_the_first_snapshot(tmp_path):
+    log = WriteAheadLog(str(tmp_path), sync=False)
+    log.log_epoch(1000.0)
+    log.log_arrival(_order(0))
+    log.close()
+
+    log = WriteAheadLog(str(tmp_path), sync=False)
+    log.recover(Scheduler(), {})
+    assert log.epoch == 1000.0
+    log.log_epoch(log.epoch)
+    log.snapshot(Scheduler(), {})
+    log.close()
+    # the snapshot is gone, the segment after it still holds the epoch
+    os.remove(tmp_path / "snapshot.bin")
+    log = WriteAheadLog(str(tmp_path), sync=False)
+    log.recover(Scheduler(), {})
+    log.close()
+    assert log.epoch == 1000.0
+
+
+def test_lookups_load_only_the_chunk_holding_the_order(tmp_path, monkeypatch):
+    monkeypatch.setattr(wal, "CHUNK_ENTRIES", 10)
+    log = WriteAheadLog(str(tmp_path), sync=False)
+    scheduler = Scheduler()
+    for i in range(50):
+        scheduler.push(_order(i))
+    scheduler.next_order(0)
+    log.snapshot(scheduler, {})
+    log.close()
+
+    recovered, _ = _recover(str(tmp_path))
+    cold = len(recovered.orders._cold)
+    assert cold
+    # an order already dispatched is in no chunk
+    assert "o0" not in recovered.orders
+    assert recovered.cancel("o0") is None
+    assert len(recovered.orders._cold) == cold
+    # an order of a cold chunk loads that chunk alone
+    assert recovered.cancel("o49")["id"] == "o49"
+    assert len(recovered.orders._cold) == cold - 1
+    assert len(recovered) == 48
@@ -0,0 +1,41 @@
+"""
+Compatibility of the binary wire format across wire versions
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import wire  # noqa: E402
+from common import StatusEventType  # noqa: E402
+
+
+def test_version_negotiation():
+    assert wire.peer_version(wire.HELLO) == wire.WIRE_VERSION
+    assert wire.peer_version(bytes((wire.MAGIC, wire.WIRE_VERSION + 1))) == wire.WIRE_VERSION
+    for hello in (bytes((wire.MAGIC, 0)), bytes((wire.MAGIC,))):
+        with pytest.raises(ValueError):
+            wire.peer_version(hello)
+
+
+def test_unknown_indices_are_rejected():
+    event = {"type": StatusEventType.DROPOFF, "robot": "r1"}
+    (frame,) = wire.encode(event, wire.MessageKind.STATUS)
+    assert wire.decode([frame]) == event
+    # the value of the first field, its type, is an event type index
+    type_index = frame.index(bytes((ord("e"), list(StatusEventType).index(StatusEventType.DROPOFF))))
+    corrupted = bytearray(frame)
+    corrupted[type_index + 1] = 200
+    with pytest.raises(ValueError, match="unknown event type index"):
+        wire.decode([bytes(corrupted)])
+
+
+def test_out_of_range_integers_fall_back_to_json():
+    event = {"type": StatusEventType.DROPOFF, "robot": "r1", "count": 2**63}
+    frames = wire.encode(event, wire.MessageKind.STATUS)
+    assert not wire.is_binary(frames[0])
+    assert wire.decode(frames) == event
+    order = {"deadline": -(2**70), "packages": [{"color": "RED", "aisle": 1}]}
+    assert wire.decode(wire.encode(order, wire.MessageKind.ORDER)) == order
@@ -3,16 +3,24 @@
 
 import json
 import logging
-import sys
 import threading
 import time
 import zmq
-sys.path.append('/home/pi/TurboPi/')
-import HiwonderSDK.Sonar as Sonar
+import hal
+from metrics import RingBuffer
+from periodic import PeriodicLoop
 
 logging.basicConfig(filename="logs.txt", level=logging.DEBUG, format=f'[ULTRASONIC] %(asctime)s - %(levelname)s - %(message)s')
 
-HWSONAR = Sonar.Sonar()
+HWSONAR = hal.sonar()
+
+# the distance is the average of the last few samples because the sonar can be wonky sometimes
+SAMPLE_PERIOD = 0.02
+SAMPLES = 5
+# distance under which the path is blocked (cm)
+BLOCKED_DISTANCE = 10.0
+# time blocked after which the controller is notified (s)
+BLOCKED_TIMEOUT = 10
 
 # open communication with the controller
 context = zmq.Context()
@@ -48,33 +56,39 @@ msg_thread = threading.Thread(target=msg)
 msg_thread.daemon = True
 msg_thread.start()
 
+def report_loop(loop: PeriodicLoop):
+    """Send the loop's histograms to the controller, which publishes them for the hub"""
+    dealer_socket.send_multipart([b"", json.dumps({"loops": loop.export()}).encode()])
+
+
+loop = PeriodicLoop("ultrasonic", SAMPLE_PERIOD, report_loop)
+samples = RingBuffer(SAMPLES)
+
 while True:
     if _is_running:
-        dist = 0
-        for i in range(0,5):
-            # this loop is to get an average because the sonar can be wonky sometimes
-            tmp_dist = HWSONAR.getDistance() / 10.0 # 获取超声波传感器距离数据(get ultrasonic sensor distance data)
-            dist += tmp_dist
-            time.sleep(0.01)
-        dist /= 5
-        
-        if time_blocked >= 10:
+        samples.append(HWSONAR.getDistance() / 10.0) # 获取超声波传感器距离数据(get ultrasonic sensor distance data)
+        blocked = len(samples) == SAMPLES and samples.mean() <= BLOCKED_DISTANCE
+
+        if time_blocked >= BLOCKED_TIMEOUT:
             # we've been blocked for a while, notify controller
             time_blocked = 0
             dealer_socket.send_multipart([b"", "blocked_timeout".encode()])
             time.sleep(1)
-            
-        if dist <= 10.0:
+            loop.restart()
+
+        if blocked:
             if is_blocked == False:
                 dealer_socket.send_multipart([b"", "path_blocked".encode()])
                 is_blocked = True
-            time_blocked += 0.1
-            time.sleep(0.1)
+            time_blocked += SAMPLE_PERIOD
         else:
             if is_blocked == True:
                 dealer_socket.send_multipart([b"", "path_unblocked".encode()])
             is_blocked = False
-            time.sleep(0.1)
+        loop.wait()
     else:
         is_blocked = False
-        time_blocked = 0
\ No newline at end of file
+        time_blocked = 0
+        samples.clear()
+        time.sleep(SAMPLE_PERIOD)
+        loop.restart()
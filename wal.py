@@ -0,0 +1,442 @@
+"""
+Write-ahead log for the hub's order state
+
+Every order arrival, dispatch, completion, amendment and robot status update is appended to a compact binary
+log before it is forgotten, so a restarted hub can rebuild its queue. Records are committed in groups by a
+background thread, and the queue is periodically written out as a snapshot after which older log segments
+are deleted. Recovery loads the latest snapshot and replays the segments written after it. Only the most urgent
+chunk of queued orders is loaded right away, the other chunks are loaded as the hub needs them (OrderBook.restore).
+
+Layout of the log directory:
+    wal-<generation>.log   log segments, one record after the other
+    snapshot.bin           queue state as of the start of the segment of its generation
+"""
+
+import gc
+import json
+import logging
+import marshal
+import os
+import struct
+import threading
+import time
+import zlib
+from enum import IntEnum
+from functools import cache, partial
+
+from common import OrderData, PackageColor
+from order_book import ColdEntries, Entry
+from scheduler import Scheduler
+
+
+class RecordType(IntEnum):
+    """Kinds of log records"""
+
+    ARRIVAL = 1
+    DISPATCH = 2  # dispatch with its time, so the trip is in flight again after recovery
+    COMPLETE = 3
+    CANCEL = 4
+    UPDATE_ORDER = 5  # amended order in full, queued again if it is missing when replayed
+    STATUS = 6
+    ARRIVAL_JSON = 7  # arrival of an order that does not fit the packed encoding
+    EPOCH = 8  # start of the hub clock, first record of every segment
+
+
+# type, payload length, crc32 of the payload
+RECORD_HEADER = struct.Struct("<BII")
+# deadline, number of packages, length of the id
+ARRIVAL_HEADER = struct.Struct("<qHH")
+# aisle, color index
+PACKAGE = struct.Struct("<IB")
+# dispatch time on the hub clock, length of the robot id
+DISPATCH_HEADER = struct.Struct("<dB")
+# start of the hub clock (time.time)
+EPOCH = struct.Struct("<d")
+
+SNAPSHOT_MAGIC = b"DPSNAP1\0"
+# generation of the first segment not contained in the snapshot
+SNAPSHOT_HEADER = struct.Struct("<8sI")
+# chunk tag, chunk length
+CHUNK_HEADER = struct.Struct("<BI")
+CHUNK_META = 1
+CHUNK_ORDERS = 2
+CHUNK_DEFERRED = 3
+CHUNK_SEEN = 4  # ids of every order ever accepted, separated by NUL
+# start of an orders chunk: lowest priority, number of live entries and highest sequence number of its entries, and
+# length of the ids of its live entries (separated by NUL) that follow
+ENTRIES_HEADER = struct.Struct("<dIqI")
+# heap entries per snapshot chunk, small enough that serialising one never stalls the hub noticeably
+CHUNK_ENTRIES = 10000
+
+# group commit: write out once this many bytes are pending or this long after the first pending record
+COMMIT_BYTES = 64 * 1024
+COMMIT_INTERVAL = 0.005
+# take a snapshot after this many records or seconds, whichever comes first
+SNAPSHOT_RECORDS = 100000
+SNAPSHOT_INTERVAL = 60
+
+_COLORS = list(PackageColor)
+_COLOR_INDEX = {color: i for i, color in enumerate(_COLORS)}
+
+
+class WriteAheadLog:
+    """
+    Append-only log of the hub's order state with group commit and snapshots
+
+    The append methods only encode the record into an in-memory buffer; a background thread writes and
+    (optionally) fsyncs the buffer in batches, so logging never waits for the disk.
+    """
+
+    def __init__(self, directory: str, sync: bool = True):
+        """
+        :param directory: directory holding the log segments and the snapshot, created if missing
+        :param sync: fsync every group commit, turn off to trade durability on power loss for speed
+        """
+        self.directory = directory
+        self.sync = sync
+        os.makedirs(directory, exist_ok=True)
+
+        segments = self._segments()
+        self.generation: int = segments[-1] + 1 if segments else 0
+        self._file = open(self._segment_path(self.generation), "ab")
+
+        self._cond = threading.Condition()
+        self._buffer = bytearray()
+        # buffers and segment switches waiting for the writer thread, in order
+        self._pending: list[bytearray | int] = []
+        self._closed = False
+        self._records_since_snapshot = 0
+        self._last_snapshot = time.monotonic()
+        self._snapshot_thread: threading.Thread | None = None
+        # start of the hub clock (time.time), kept in every segment and snapshot so the times of the recovered
+        # state stay valid
+        self.epoch: float | None = None
+
+        self._writer = threading.Thread(target=self._write_loop, name="WAL", daemon=True)
+        self._writer.start()
+
+    def log_epoch(self, epoch: float):
+        """Record the start of the hub clock, logged again at the start of every later segment"""
+        self.epoch = epoch
+        self._append(RecordType.EPOCH, EPOCH.pack(epoch))
+
+    def log_arrival(self, order: OrderData):
+        order_id = order["id"].encode()
+        try:
+            parts = [ARRIVAL_HEADER.pack(order["deadline"], len(order["packages"]), len(order_id)), order_id]
+            for package in order["packages"]:
+                parts.append(PACKAGE.pack(package["aisle"], _COLOR_INDEX[package["color"]]))
+        except (KeyError, struct.error):
+            self._append(RecordType.ARRIVAL_JSON, json.dumps(order).encode())
+            return
+        self._append(RecordType.ARRIVAL, b"".join(parts))
+
+    def log_dispatch(self, robot: bytes, trip: OrderData, now: float):
+        self._append(RecordType.DISPATCH, DISPATCH_HEADER.pack(now, len(robot)) + robot + json.dumps(trip).encode())
+
+    def log_complete(self, robot: bytes):
+        self._append(RecordType.COMPLETE, robot)
+
+    def log_cancel(self, order_id: str):
+        self._append(RecordType.CANCEL, order_id.encode())
+
+    def log_update(self, order: OrderData):
+        self._append(RecordType.UPDATE_ORDER, json.dumps(order).encode())
+
+    def log_status(self, msg: bytes):
+        self._append(RecordType.STATUS, msg)
+
+    def _append(self, kind: int, payload: bytes):
+        record = RECORD_HEADER.pack(kind, len(payload), zlib.crc32(payload)) + payload
+        with self._cond:
+            was_empty = not self._buffer
+            self._buffer += record
+            if was_empty or len(self._buffer) >= COMMIT_BYTES:
+                self._cond.notify()
+        self._records_since_snapshot += 1
+
+    def _write_loop(self):
+        while True:
+            with self._cond:
+                while not self._buffer and not self._pending and not self._closed:
+                    self._cond.wait()
+                if len(self._buffer) < COMMIT_BYTES and not self._pending and not self._closed:
+                    # give other records the chance to join this commit
+                    self._cond.wait(COMMIT_INTERVAL)
+                pending = self._pending + [self._buffer]
+                self._pending = []
+                self._buffer = bytearray()
+                closed = self._closed
+            for item in pending:
+                if isinstance(item, int):
+                    self._commit()
+                    self._file.close()
+                    self._file = open(self._segment_path(item), "ab")
+                elif item:
+                    self._file.write(item)
+            self._commit()
+            if closed:
+                self._file.close()
+                return
+
+    def _commit(self):
+        self._file.flush()
+        if self.sync:
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        """Write out every pending record and stop the writer thread"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._writer.join()
+        if self._snapshot_thread is not None:
+            self._snapshot_thread.join()
+
+    def maybe_snapshot(self, scheduler: Scheduler, assignments: dict[bytes, OrderData]):
+        """Take a snapshot in the background if enough records or time have passed since the last one"""
+        if self._snapshot_thread is not None and self._snapshot_thread.is_alive():
+            return
+        if (
+            self._records_since_snapshot < SNAPSHOT_RECORDS
+            and time.monotonic() - self._last_snapshot < SNAPSHOT_INTERVAL
+        ):
+            return
+        if self._records_since_snapshot == 0:
+            return
+        self.snapshot(scheduler, assignments)
+
+    def snapshot(self, scheduler: Scheduler, assignments: dict[bytes, OrderData]):
+        """Start a new log segment and write the current state out in the background
+
+        Only the heaps, their indexes and the seen ids are copied on the calling thread; heap entries are never
+        modified, so the copies are not affected by the orders removed or amended while the snapshot is being
+        written. Those changes are recorded in the new segment, replayed on top of the snapshot.
+        """
+        self.generation += 1
+        with self._cond:
+            self._pending += [self._buffer, self.generation]
+            self._buffer = bytearray()
+            self._cond.notify()
+        if self.epoch is not None:
+            # a crash before the snapshot is written leaves only the segments
+            self._append(RecordType.EPOCH, EPOCH.pack(self.epoch))
+        meta = {
+            "policy": str(scheduler.policy),
+            "assignments": {robot: json.dumps(trip) for robot, trip in assignments.items()},
+            "in_flight": dict(scheduler.in_flight),
+            "correction": scheduler.correction,
+            "key_correction": scheduler.key_correction,
+            "epoch": self.epoch,
+        }
+        self._records_since_snapshot = 0
+        self._last_snapshot = time.monotonic()
+        self._snapshot_thread = threading.Thread(
+            target=self._write_snapshot,
+            args=(
+                self.generation,
+                meta,
+                scheduler.orders.seen(),
+                scheduler.orders.export(),
+                scheduler.deferred.export(),
+            ),
+            name="WAL-SNAPSHOT",
+            daemon=True,
+        )
+        self._snapshot_thread.start()
+
+    def _write_snapshot(
+        self,
+        generation: int,
+        meta: dict,
+        seen: set[str],
+        orders: tuple[list[Entry], dict[str, Entry]],
+        deferred: tuple[list[Entry], dict[str, Entry]],
+    ):
+        start = time.perf_counter()
+        path = os.path.join(self.directory, "snapshot.bin")
+        with open(path + ".tmp", "wb") as f:
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, generation))
+            self._write_chunk(f, CHUNK_META, marshal.dumps(meta))
+            self._write_chunk(f, CHUNK_SEEN, "\0".join(seen).encode())
+            for tag, (heap, index) in ((CHUNK_ORDERS, orders), (CHUNK_DEFERRED, deferred)):
+                for i in range(0, len(heap), CHUNK_ENTRIES):
+                    # stale entries stay as placeholders, the heap order of the first chunk depends on them
+                    entries = [
+                        entry if index.get(entry[2]) is entry else (entry[0], entry[1], None, None)
+                        for entry in heap[i : i + CHUNK_ENTRIES]
+                    ]
+                    ids = [entry[2] for entry in entries if entry[2] is not None]
+                    ids_data = "\0".join(ids).encode()
+                    header = ENTRIES_HEADER.pack(
+                        min(entry[0] for entry in entries), len(ids), max(entry[1] for entry in entries), len(ids_data)
+                    )
+                    self._write_chunk(f, tag, header + ids_data + marshal.dumps(entries))
+                    time.sleep(0)  # let the hub thread run between chunks
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        for segment in self._segments():
+            if segment < generation:
+                os.remove(self._segment_path(segment))
+        logging.info(
+            f"snapshot of {len(orders[1]) + len(deferred[1])} orders written in {time.perf_counter() - start:.2f}s"
+        )
+
+    @staticmethod
+    def _write_chunk(f, tag: int, data: bytes):
+        f.write(CHUNK_HEADER.pack(tag, len(data)))
+        f.write(data)
+
+    def recover(self, scheduler: Scheduler, assignments: dict[bytes, OrderData]) -> int:
+        """Rebuild the scheduler's queues and the robot assignments from the snapshot and the log
+
+        Must be called before anything new is logged.
+
+        :return: number of log records replayed on top of the snapshot
+        """
+        start = time.perf_counter()
+        # building millions of small objects triggers the cyclic collector over and over for nothing
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            generation = self._load_snapshot(scheduler, assignments)
+            replayed = 0
+            for segment in self._segments():
+                if generation <= segment < self.generation:
+                    replayed += self._replay(self._segment_path(segment), scheduler, assignments)
+        finally:
+            # nor is there a point in it walking the recovered state, which lives as long as the hub
+            gc.freeze()
+            if gc_was_enabled:
+                gc.enable()
+        logging.info(
+            f"recovered {len(scheduler)} queued orders and {len(assignments)} assignments "
+            f"({replayed} log records) in {time.perf_counter() - start:.2f}s"
+        )
+        return replayed
+
+    def _load_snapshot(self, scheduler: Scheduler, assignments: dict[bytes, OrderData]) -> int:
+        path = os.path.join(self.directory, "snapshot.bin")
+        if not os.path.exists(path):
+            return 0
+        with open(path, "rb") as f:
+            data = memoryview(f.read())
+        magic, generation = SNAPSHOT_HEADER.unpack_from(data)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError(f"{path} is not a hub snapshot")
+        meta = {}
+        seen: list[str] = []
+        # the first chunk of a heap is a heap of its own, the others are loaded when needed
+        chunks: dict[int, list[list[Entry] | ColdEntries]] = {CHUNK_ORDERS: [], CHUNK_DEFERRED: []}
+        offset = SNAPSHOT_HEADER.size
+        while offset < len(data):
+            tag, length = CHUNK_HEADER.unpack_from(data, offset)
+            offset += CHUNK_HEADER.size
+            value = data[offset : offset + length]
+            offset += length
+            if tag == CHUNK_META:
+                meta = marshal.loads(value)
+            elif tag == CHUNK_SEEN:
+                seen = bytes(value).decode().split("\0") if value else []
+            else:
+                lowest, live, last_sequence, ids_length = ENTRIES_HEADER.unpack_from(value)
+                entries = value[ENTRIES_HEADER.size + ids_length :]
+                if not chunks[tag]:
+                    chunks[tag].append(marshal.loads(entries))
+                    continue
+                ids = cache(partial(_decode_ids, value[ENTRIES_HEADER.size : ENTRIES_HEADER.size + ids_length]))
+                load = partial(_load_entries, entries)
+                chunks[tag].append(ColdEntries(lowest, live, last_sequence, load, ids))
+        reprioritise = meta.get("policy") != str(scheduler.policy)
+        for tag, book in ((CHUNK_ORDERS, scheduler.orders), (CHUNK_DEFERRED, scheduler.deferred)):
+            hot, *cold = chunks[tag] or [[]]
+            book.restore(hot, reprioritise and book is scheduler.orders, cold)
+        scheduler.orders.remember(seen)
+        scheduler.in_flight.update(meta.get("in_flight", {}))
+        scheduler.correction = meta.get("correction", scheduler.correction)
+        if not reprioritise:
+            # the restored keys were computed with it
+            scheduler.key_correction = meta.get("key_correction", scheduler.key_correction)
+        self.epoch = meta.get("epoch")
+        for robot, trip in meta.get("assignments", {}).items():
+            assignments[robot] = json.loads(trip)
+        return generation
+
+    def _replay(self, path: str, scheduler: Scheduler, assignments: dict[bytes, OrderData]) -> int:
+        with open(path, "rb") as f:
+            data = memoryview(f.read())
+        offset = 0
+        count = 0
+        while offset + RECORD_HEADER.size <= len(data):
+            kind, length, crc = RECORD_HEADER.unpack_from(data, offset)
+            payload = data[offset + RECORD_HEADER.size : offset + RECORD_HEADER.size + length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                # torn write at the end of the log: everything before it is intact
+                logging.warning(f"discarding incomplete record at {path}:{offset}")
+                break
+            offset += RECORD_HEADER.size + length
+            count += 1
+            match kind:
+                case RecordType.ARRIVAL:
+                    scheduler.push(_decode_arrival(payload))
+                case RecordType.ARRIVAL_JSON:
+                    scheduler.push(json.loads(bytes(payload)))
+                case RecordType.DISPATCH:
+                    now, robot_length = DISPATCH_HEADER.unpack_from(payload)
+                    trip_start = DISPATCH_HEADER.size + robot_length
+                    robot = bytes(payload[DISPATCH_HEADER.size : trip_start])
+                    trip = json.loads(bytes(payload[trip_start:]))
+                    members = [scheduler.cancel(order_id) for order_id in trip["orders"]]
+                    scheduler.dispatched(trip, [order for order in members if order is not None], now)
+                    assignments[robot] = trip
+                case RecordType.COMPLETE:
+                    trip = assignments.pop(bytes(payload), None)
+                    if trip is not None:
+                        # how long the trip took is unknown, it only leaves the trips in flight
+                        scheduler.in_flight.pop(trip["id"], None)
+                case RecordType.CANCEL:
+                    scheduler.cancel(bytes(payload).decode())
+                case RecordType.EPOCH:
+                    (self.epoch,) = EPOCH.unpack_from(payload)
+                case RecordType.UPDATE_ORDER:
+                    order = json.loads(bytes(payload))
+                    if not scheduler.update_deadline(order["id"], order["deadline"]):
+                        scheduler.requeue(order)
+        return count
+
+    def _segment_path(self, generation: int) -> str:
+        return os.path.join(self.directory, f"wal-{generation:08d}.log")
+
+    def _segments(self) -> list[int]:
+        return sorted(
+            int(name[4:-4]) for name in os.listdir(self.directory) if name.startswith("wal-") and name.endswith(".log")
+        )
+
+
+def _load_entries(data: memoryview) -> list[Entry]:
+    """Unmarshal a chunk of heap entries loaded after recovery, keeping the collector from walking them later"""
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return marshal.loads(data)
+    finally:
+        gc.freeze()
+        if gc_was_enabled:
+            gc.enable()
+
+
+def _decode_ids(data: memoryview) -> set[str]:
+    """Ids of the live entries of a chunk, decoded the first time an order is looked up among them"""
+    return set(bytes(data).decode().split("\0")) if data else set()
+
+
+def _decode_arrival(payload: memoryview) -> OrderData:
+    deadline, num_packages, id_length = ARRIVAL_HEADER.unpack_from(payload)
+    offset = ARRIVAL_HEADER.size
+    order_id = bytes(payload[offset : offset + id_length]).decode()
+    offset += id_length
+    packages = []
+    for aisle, color in PACKAGE.iter_unpack(payload[offset : offset + num_packages * PACKAGE.size]):
+        packages.append({"color": _COLORS[color].value, "aisle": aisle})
+    return {"id": order_id, "deadline": deadline, "packages": packages}
@@ -0,0 +1,450 @@
+"""
+Discrete-event simulator of the warehouse
+
+Runs the hub's scheduling and batching against a fleet of simulated robots that go through the real controller
+state machine (states.CONTROLLER_TRANSITIONS), with driving, picking and path blockages modelled as timed
+events instead of sleeps. Nothing waits on the wall clock, so a day of operation is simulated in seconds.
+
+The robots follow the controller's sequence of events: a trip starts with order_received, every aisle is
+entered with picking_init, a package is either found (color_detected, order_grabbed) or the robot drives to the
+end of the aisle without seeing it (not_detected), an aisle is left with exiting towards the next aisle
+(to_aisle) or the hub (to_hub), and the trip ends with the drop-off (movement_complete). A path blockage while
+driving pauses the robot in PathBlockedState until it clears.
+"""
+
+import argparse
+import heapq
+import itertools
+import json
+import logging
+import math
+import random
+import sys
+import time
+from collections import deque
+from typing import Callable, Iterable, Iterator
+
+from batching import build_trip
+from common import OrderData, PackageData
+from generate_orders import generate_orders
+from route_planner import AisleLayout, pick_sequence, plan_route
+from scheduler import HopelessPolicy, Scheduler, SchedulingPolicy
+from server import TestOrderData, iter_orders
+from states import CONTROLLER_TRANSITIONS, ControllerStates, StateMachine
+
+# a day of order arrivals (seconds)
+DAY = 86400
+
+
+class RobotModel:
+    """Timing of the actions of a robot"""
+
+    def __init__(
+        self,
+        speed: float = 0.5,
+        turn_time: float = 1.5,
+        enter_time: float = 1.0,
+        detect_time: float = 0.5,
+        grab_time: float = 2.5,
+        dropoff_time: float = 6.0,
+        pick_failure: float = 0.02,
+        block_rate: float = 1 / 600,
+        block_mean: float = 5.0,
+        intersection_stop: float = 1.5,
+        route_upload: bool = True,
+        rearm_time: float = 1.0,
+        multi_color: bool = True,
+    ):
+        """
+        :param speed: driving speed along the line (layout distance units per second)
+        :param turn_time: time of a 90 degree turn, turning around takes twice as long
+        :param enter_time: time given to the robot to enter an aisle before it looks for the package
+        :param detect_time: time the camera needs to confirm a package once it is in view
+        :param grab_time: time spent grabbing a package
+        :param dropoff_time: time from reaching the hub to having dropped the packages off
+        :param pick_failure: probability that a package is not on its shelf
+        :param block_rate: mean number of path blockages per second of driving
+        :param block_mean: mean duration of a path blockage (seconds)
+        :param intersection_stop: time lost stopping at an intersection to ask the controller what to do and
+            driving on from it
+        :param route_upload: whether the controller uploads the route, so the robot drives past the aisles it
+            does not enter without stopping
+        :param rearm_time: time the camera takes to turn back towards the shelves when given a new color
+        :param multi_color: whether the camera looks for every package of an aisle at once, so it is not given a
+            new color (and re-armed) between the packages of an aisle
+        """
+        self.speed = speed
+        self.turn_time = turn_time
+        self.enter_time = enter_time
+        self.detect_time = detect_time
+        self.grab_time = grab_time
+        self.dropoff_time = dropoff_time
+        self.pick_failure = pick_failure
+        self.block_rate = block_rate
+        self.block_mean = block_mean
+        self.intersection_stop = intersection_stop
+        self.route_upload = route_upload
+        self.rearm_time = rearm_time
+        self.multi_color = multi_color
+
+
+class SimRobot:
+    """State of a simulated robot"""
+
+    def __init__(self, name: str, clock: Callable[[], float]):
+        self.name = name
+        self.state_machine = StateMachine(CONTROLLER_TRANSITIONS, ControllerStates.InitState, clock=clock)
+        self.trip: OrderData | None = None
+        self.remaining: list[PackageData] = []
+        self.picked = 0
+        self.failed = 0
+        self.trips = 0
+        self.blockages = 0
+        # time the current trip started and total time of the trips completed
+        self.trip_start = 0.0
+        self.trip_time = 0.0
+        # where the robot is: the aisle it is at (-1 for the hub) and how deep into it
+        self.aisle = -1
+        self.depth = 0.0
+
+    def event(self, event: str):
+        self.state_machine.transition(event)
+
+
+class WarehouseSimulation:
+    """
+    Event loop of the simulation
+
+    Events are (time, sequence number, callback, arguments) in a heap; the sequence number keeps events due at
+    the same time in the order they were scheduled. Orders are read from the trace one at a time as they arrive.
+    """
+
+    def __init__(
+        self,
+        orders: Iterable[TestOrderData],
+        num_robots: int = 1,
+        layout: AisleLayout | None = None,
+        model: RobotModel | None = None,
+        policy: SchedulingPolicy = SchedulingPolicy.EDF,
+        hopeless: HopelessPolicy = HopelessPolicy.KEEP,
+        seed: int | None = None,
+    ):
+        self.now = 0.0
+        self._events: list[tuple[float, int, Callable, tuple]] = []
+        self._sequence = itertools.count()
+        self.rng = random.Random(seed)
+        self.layout = layout or AisleLayout(num_aisles=3)
+        self.model = model or RobotModel()
+        self.scheduler = Scheduler(policy, hopeless)
+        self.robots = [SimRobot(f"robot-{i}", self.clock) for i in range(num_robots)]
+        self.waiting_robots: deque[SimRobot] = deque()
+        self._orders = iter(orders)
+        self.arrived = 0
+        self.events_processed = 0
+        self.end = 0.0
+
+    def clock(self) -> float:
+        return self.now
+
+    def schedule(self, delay: float, callback: Callable, *args):
+        heapq.heappush(self._events, (self.now + delay, next(self._sequence), callback, args))
+
+    def run(self, until: float | None = None) -> dict:
+        """Simulate until every order is delivered (or the given time) and report the results"""
+        for robot in self.robots:
+            robot.event("init_done")
+            self.waiting_robots.append(robot)
+        self._next_arrival()
+        events = self._events
+        while events and (until is None or events[0][0] <= until):
+            self.now, _, callback, args = heapq.heappop(events)
+            callback(*args)
+            self.events_processed += 1
+        self.end = self.now
+        return self.report()
+
+    # --- hub ---
+
+    def _next_arrival(self):
+        order = next(self._orders, None)
+        if order is not None:
+            self.schedule(max(0.0, order["time"] - self.now), self._arrive, order)
+
+    def _arrive(self, order: TestOrderData):
+        self.arrived += 1
+        self.scheduler.push({key: value for key, value in order.items() if key != "time"})
+        self._next_arrival()
+        self._dispatch()
+
+    def _dispatch(self):
+        """Hand out trips to waiting robots, the way the hub does"""
+        while self.waiting_robots and self.scheduler:
+            primary = self.scheduler.next_order(self.now)
+            if primary is None:
+                break
+            trip, members = build_trip(primary, self.scheduler.orders, self.now, estimate=self.scheduler.service_time)
+            self.scheduler.dispatched(trip, members, self.now)
+            self._start_trip(self.waiting_robots.popleft(), trip)
+
+    # --- robots ---
+
+    def _drive(self, robot: SimRobot, distance: float, then: Callable, *args):
+        """Drive the given distance and call then, pausing for the path blockages met on the way"""
+        duration = distance / self.model.speed
+        block_in = self.rng.expovariate(self.model.block_rate) if self.model.block_rate else math.inf
+        if block_in < duration:
+            self.schedule(block_in, self._blocked, robot, (duration - block_in) * self.model.speed, then, args)
+        else:
+            self.schedule(duration, then, robot, *args)
+
+    def _blocked(self, robot: SimRobot, remaining: float, then: Callable, args: tuple):
+        robot.blockages += 1
+        robot.event("path_blocked")
+        self.schedule(self.rng.expovariate(1 / self.model.block_mean), self._unblocked, robot, remaining, then, args)
+
+    def _unblocked(self, robot: SimRobot, remaining: float, then: Callable, args: tuple):
+        robot.event("path_unblocked")
+        self._drive(robot, remaining, then, *args)
+
+    def _start_trip(self, robot: SimRobot, trip: OrderData):
+        robot.trip = trip
+        robot.trip_start = self.now
+        robot.remaining = pick_sequence(plan_route(trip["packages"], self.layout))
+        robot.event("order_received")
+        self._to_next_aisle(robot)
+
+    def _to_next_aisle(self, robot: SimRobot):
+        """Drive along the main line to the aisle of the next package and turn into it"""
+        aisle = robot.remaining[0]["aisle"]
+        start = self.layout.position(robot.aisle) if robot.aisle >= 0 else 0.0
+        passes = max(abs(aisle - robot.aisle) - 1, 0)
+        robot.aisle = aisle
+        self.schedule(
+            self._passing_time(passes), self._drive, robot, abs(self.layout.position(aisle) - start), self._enter_aisle
+        )
+
+    def _passing_time(self, passes: int) -> float:
+        """Time lost driving past the given number of aisles"""
+        return 0.0 if self.model.route_upload else passes * self.model.intersection_stop
+
+    def _enter_aisle(self, robot: SimRobot):
+        robot.depth = 0.0
+        robot.event("picking_init")
+        self.schedule(self.model.turn_time + self.model.enter_time, self._look_for_package, robot)
+
+    def _look_for_package(self, robot: SimRobot):
+        package = robot.remaining[0]
+        if self.rng.random() < self.model.pick_failure:
+            # the camera never sees it: drive on to the end of the aisle
+            self._drive(robot, self.layout.aisle_length - robot.depth, self._not_found)
+        else:
+            depth = self.layout.depth(package)
+            self._drive(robot, max(0.0, depth - robot.depth), self._found, depth)
+
+    def _found(self, robot: SimRobot, depth: float):
+        robot.depth = depth
+        self.schedule(self.model.detect_time, self._grab, robot)
+
+    def _grab(self, robot: SimRobot):
+        robot.event("color_detected")
+        self.schedule(self.model.grab_time, self._grabbed, robot)
+
+    def _grabbed(self, robot: SimRobot):
+        robot.picked += 1
+        robot.remaining.pop(0)
+        if robot.remaining and robot.remaining[0]["aisle"] == robot.aisle:
+            # the next package is further down the same aisle
+            robot.event("order_grabbed")
+            self.schedule(0.0 if self.model.multi_color else self.model.rearm_time, self._look_for_package, robot)
+        else:
+            robot.event("exiting")
+            self._leave_aisle(robot)
+
+    def _not_found(self, robot: SimRobot):
+        robot.depth = self.layout.aisle_length
+        robot.failed += 1
+        robot.remaining.pop(0)
+        robot.event("not_detected")
+        self._leave_aisle(robot)
+
+    def _leave_aisle(self, robot: SimRobot):
+        """Turn around and drive back to the main line"""
+        self.schedule(2 * self.model.turn_time, self._drive, robot, robot.depth, self._at_main_line)
+
+    def _at_main_line(self, robot: SimRobot):
+        robot.depth = 0.0
+        if robot.remaining:
+            robot.event("to_aisle")
+            self.schedule(self.model.turn_time, self._to_next_aisle, robot)
+        else:
+            robot.event("to_hub")
+            self.schedule(
+                self.model.turn_time + self._passing_time(robot.aisle),
+                self._drive,
+                robot,
+                self.layout.position(robot.aisle),
+                self._at_hub,
+            )
+
+    def _at_hub(self, robot: SimRobot):
+        robot.aisle = -1
+        self.schedule(self.model.dropoff_time, self._dropped_off, robot)
+
+    def _dropped_off(self, robot: SimRobot):
+        robot.trips += 1
+        robot.trip_time += self.now - robot.trip_start
+        self.scheduler.completed(robot.trip["id"], self.now)
+        robot.trip = None
+        robot.event("movement_complete")
+        self.waiting_robots.append(robot)
+        self._dispatch()
+
+    # --- results ---
+
+    def report(self) -> dict:
+        """Throughput, deadline misses and robot utilisation over the simulated time"""
+        scheduling = self.scheduler.report()
+        hours = self.end / 3600
+        completed = scheduling["completed"]
+        robots = {}
+        for robot in self.robots:
+            breakdown = robot.state_machine.breakdown()
+            idle = breakdown.get(ControllerStates.IdleState.__name__, 0.0)
+            robots[robot.name] = {
+                "utilisation": 1 - idle / self.end if self.end else 0.0,
+                "trips": robot.trips,
+                "picked": robot.picked,
+                "failed": robot.failed,
+                "blockages": robot.blockages,
+                "time_in_state": breakdown,
+            }
+        picked = sum(robot.picked for robot in self.robots)
+        failed = sum(robot.failed for robot in self.robots)
+        trips = sum(robot.trips for robot in self.robots)
+        return {
+            "simulated_hours": hours,
+            "robots": len(self.robots),
+            "orders_arrived": self.arrived,
+            "orders_completed": completed,
+            "orders_dropped": scheduling["dropped"],
+            "orders_per_hour": completed / hours if hours else None,
+            "packages_per_hour": picked / hours if hours else None,
+            "deadline_miss_rate": scheduling["late"] / completed if completed else None,
+            "pick_success_rate": picked / (picked + failed) if picked + failed else None,
+            "trip_time_mean": sum(robot.trip_time for robot in self.robots) / trips if trips else None,
+            "utilisation": sum(r["utilisation"] for r in robots.values()) / len(robots) if robots else None,
+            "events": self.events_processed,
+            "per_robot": robots,
+            "scheduling": scheduling,
+        }
+
+
+def repeat_trace(make_trace: Callable[[int], Iterable[TestOrderData]], duration: float) -> Iterator[TestOrderData]:
+    """Play traces back to back until duration seconds of arrivals are covered
+
+    The shelves are restocked before every repetition. Order ids, if the trace has any, are made unique per
+    repetition so the hub does not drop the repeated orders as duplicates.
+
+    :param make_trace: trace of the given repetition, starting at time 0
+    """
+    offset = 0
+    for repetition in itertools.count():
+        last = None
+        for order in make_trace(repetition):
+            last = offset + order["time"]
+            if last > duration:
+                return
+            order = dict(order, time=last, deadline=offset + order["deadline"])
+            if "id" in order:
+                order["id"] = f"{order['id']}@{repetition}"
+            yield order
+        if last is None:
+            return
+        offset = math.ceil(last) + 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate the warehouse faster than real time")
+    parser.add_argument("--file", help="order trace to replay (JSON array or JSON lines), generated if not given")
+    parser.add_argument("--duration", type=float, default=DAY, help="seconds of order arrivals to simulate")
+    parser.add_argument("--robots", type=int, default=3, help="number of robots")
+    parser.add_argument("--aisles", type=int, default=3, help="number of aisles")
+    parser.add_argument("--policy", type=SchedulingPolicy, choices=list(SchedulingPolicy), default=SchedulingPolicy.EDF)
+    parser.add_argument("--hopeless", type=HopelessPolicy, choices=list(HopelessPolicy), default=HopelessPolicy.KEEP)
+    parser.add_argument("--seed", type=int)
+    trace = parser.add_argument_group("generated trace", "passed to generate_orders.py for every repetition")
+    trace.add_argument("--min-orders", type=int, default=3)
+    trace.add_argument("--max-orders", type=int, default=6)
+    trace.add_argument("--min-packages", type=int, default=1)
+    trace.add_argument("--max-packages", type=int, default=3)
+    trace.add_argument("--min-spacing", type=int, default=0)
+    trace.add_argument("--max-spacing", type=int, default=30)
+    robot = parser.add_argument_group("robot model")
+    robot.add_argument("--speed", type=float, default=RobotModel().speed, help="layout units per second")
+    robot.add_argument("--pick-failure", type=float, default=RobotModel().pick_failure)
+    robot.add_argument("--block-rate", type=float, default=RobotModel().block_rate, help="blockages per second")
+    robot.add_argument("--block-mean", type=float, default=RobotModel().block_mean, help="seconds")
+    robot.add_argument("--intersection-stop", type=float, default=RobotModel().intersection_stop, help="seconds")
+    robot.add_argument(
+        "--no-route-upload", dest="route_upload", action="store_false", help="stop at every intersection"
+    )
+    robot.add_argument(
+        "--single-color", dest="multi_color", action="store_false", help="re-arm the camera for every package"
+    )
+    parser.add_argument("--json", action="store_true", help="print the full report as JSON")
+    args = parser.parse_args()
+
+    # the transitions of thousands of simulated trips are not worth logging
+    logging.getLogger().setLevel(logging.WARNING)
+
+    if args.file:
+        make_trace = lambda repetition: iter_orders(args.file)
+    else:
+        try:
+            generate_orders(
+                args.min_orders, args.max_orders, args.min_packages, args.max_packages,
+                args.aisles, args.min_spacing, args.max_spacing,
+            )
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            exit(1)
+        make_trace = lambda repetition: generate_orders(
+            args.min_orders, args.max_orders, args.min_packages, args.max_packages,
+            args.aisles, args.min_spacing, args.max_spacing,
+            None if args.seed is None else args.seed + repetition,
+        )
+
+    simulation = WarehouseSimulation(
+        repeat_trace(make_trace, args.duration),
+        num_robots=args.robots,
+        layout=AisleLayout(num_aisles=args.aisles),
+        model=RobotModel(
+            speed=args.speed,
+            pick_failure=args.pick_failure,
+            block_rate=args.block_rate,
+            block_mean=args.block_mean,
+            intersection_stop=args.intersection_stop,
+            route_upload=args.route_upload,
+            multi_color=args.multi_color,
+        ),
+        policy=args.policy,
+        hopeless=args.hopeless,
+        seed=args.seed,
+    )
+    start = time.perf_counter()
+    report = simulation.run()
+    elapsed = time.perf_counter() - start
+    report["wall_seconds"] = elapsed
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"simulated {report['simulated_hours']:.1f} h in {elapsed:.2f} s ({report['events']} events)")
+        print(f"orders: {report['orders_arrived']} arrived, {report['orders_completed']} completed, "
+              f"{report['orders_dropped']} dropped")
+        print(f"throughput: {report['orders_per_hour'] or 0:.1f} orders/h, {report['packages_per_hour'] or 0:.1f} packages/h")
+        print(f"deadline miss rate: {report['deadline_miss_rate'] or 0:.1%}")
+        print(f"pick success rate: {report['pick_success_rate'] or 0:.1%}")
+        print(f"mean trip time: {report['trip_time_mean'] or 0:.1f} s")
+        for name, robot in report["per_robot"].items():
+            print(f"{name}: {robot['utilisation']:.1%} utilised, {robot['trips']} trips")
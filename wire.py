@@ -0,0 +1,311 @@
+"""
+Binary wire format for the messages exchanged between the server, the hub and the robots
+
+Every binary message starts with the MAGIC byte followed by the wire version and the message kind, so a
+receiver can tell it apart from a JSON message (which always starts with "{") and accept both. JSON remains
+the fallback: the hub accepts either from the server, and a robot that announces binary support with HELLO in
+its order request gets its trips in binary, after which it publishes its status events in binary too.
+
+HELLO carries the robot's wire version and the hub answers with the lower of its own and the robot's, which the
+robot then uses for its status events. Tables of the generic encoding are only ever appended to: adding to them
+takes a new version, for which encode_status must leave out what older versions do not know.
+
+Every message is a single frame, which receivers decode straight out of the received buffer (pyzmq copy=False).
+Orders are laid out as columns:
+    header    magic, version, kind, deadline, number of packages, number of merged order ids, flags
+    colors    one byte per package, the index of its PackageColor
+    aisles    one little-endian uint32 per package
+    strings   NUL-separated UTF-8: the order id, the merged order ids, the order id of every package
+Status events, which are rare and vary in shape, use a generic tagged encoding of their fields.
+"""
+
+import json
+import struct
+import sys
+from array import array
+from enum import IntEnum, StrEnum
+
+from common import OrderCommand, OrderData, PackageColor, StatusEvent, StatusEventType
+
+WIRE_VERSION = 1
+# first byte of every binary message
+MAGIC = 0xD1
+# order request payload of a robot that understands binary replies
+HELLO = bytes((MAGIC, WIRE_VERSION))
+
+
+class WireFormat(StrEnum):
+    """Encoding used on a connection"""
+
+    JSON = "json"
+    BINARY = "binary"
+
+
+class MessageKind(IntEnum):
+    """Kinds of binary messages"""
+
+    ORDER = 1
+    COMMAND = 2
+    STATUS = 3
+
+
+# magic, version, kind
+HEADER = struct.Struct("<BBB")
+# magic, version, kind, deadline, number of packages, number of merged order ids, flags
+ORDER_HEADER = struct.Struct("<BBBqHHB")
+ORDER_HAS_ID = 1
+ORDER_HAS_ORDERS = 2
+ORDER_HAS_PACKAGE_ORDERS = 4
+# magic, version, kind, command index, deadline (0 for a cancellation)
+COMMAND_HEADER = struct.Struct("<BBBBq")
+COMMANDS = ["cancel", "update_deadline"]
+
+_COLORS = [color.value for color in PackageColor]
+_COLOR_INDEX = {color: i for i, color in enumerate(_COLORS)}
+_EVENT_TYPES = list(StatusEventType)
+_SWAP_BYTES = sys.byteorder != "little"
+
+
+def encode_order(order: OrderData, version: int = WIRE_VERSION) -> list[bytes]:
+    """Frames of an order in the binary format
+
+    :raises ValueError: if the order cannot be represented, e.g. an unknown color or a NUL in an id
+    """
+    packages = order["packages"]
+    try:
+        colors = bytes([_COLOR_INDEX[package["color"]] for package in packages])
+        aisles = array("I", [package["aisle"] for package in packages])
+    except (KeyError, OverflowError) as e:
+        raise ValueError(f"order cannot be encoded: {e}") from None
+    if _SWAP_BYTES:
+        aisles.byteswap()
+    flags = 0
+    strings = []
+    if "id" in order:
+        flags |= ORDER_HAS_ID
+        strings.append(order["id"])
+    merged = order.get("orders", [])
+    if "orders" in order:
+        flags |= ORDER_HAS_ORDERS
+        strings.extend(merged)
+    if packages and "order_id" in packages[0]:
+        flags |= ORDER_HAS_PACKAGE_ORDERS
+        strings.extend(package["order_id"] for package in packages)
+    if any("\0" in string for string in strings):
+        raise ValueError("order cannot be encoded: NUL in an id")
+    header = ORDER_HEADER.pack(
+        MAGIC, version, MessageKind.ORDER, order["deadline"], len(packages), len(merged), flags
+    )
+    return [b"".join((header, colors, aisles.tobytes(), "\0".join(strings).encode()))]
+
+
+def decode_order(frames: list) -> OrderData:
+    data = memoryview(frames[0])
+    _, _, _, deadline, num_packages, num_merged, flags = ORDER_HEADER.unpack_from(data)
+    offset = ORDER_HEADER.size
+    colors = data[offset : offset + num_packages]
+    offset += num_packages
+    aisles = array("I")
+    aisles.frombytes(data[offset : offset + num_packages * aisles.itemsize])
+    offset += num_packages * aisles.itemsize
+    if _SWAP_BYTES:
+        aisles.byteswap()
+    if len(colors) != num_packages or len(aisles) != num_packages:
+        raise ValueError("truncated order")
+    packages = [{"color": _COLORS[color], "aisle": aisle} for color, aisle in zip(colors, aisles)]
+    order: OrderData = {"deadline": deadline, "packages": packages}
+    if not flags:
+        return order
+    strings = bytes(data[offset:]).decode().split("\0")
+    if flags & ORDER_HAS_ID:
+        order["id"] = strings[0]
+        del strings[0]
+    if flags & ORDER_HAS_ORDERS:
+        order["orders"] = strings[:num_merged]
+        del strings[:num_merged]
+    if flags & ORDER_HAS_PACKAGE_ORDERS:
+        for package, order_id in zip(packages, strings, strict=True):
+            package["order_id"] = order_id
+    return order
+
+
+def encode_command(command: OrderCommand, version: int = WIRE_VERSION) -> list[bytes]:
+    header = COMMAND_HEADER.pack(
+        MAGIC, version, MessageKind.COMMAND, COMMANDS.index(command["command"]), command.get("deadline", 0)
+    )
+    return [header + command["id"].encode()]
+
+
+def decode_command(frames: list) -> OrderCommand:
+    _, _, _, index, deadline = COMMAND_HEADER.unpack_from(frames[0])
+    command: OrderCommand = {"command": COMMANDS[index], "id": bytes(memoryview(frames[0])[COMMAND_HEADER.size :]).decode()}
+    if command["command"] == "update_deadline":
+        command["deadline"] = deadline
+    return command
+
+
+def encode_status(event: StatusEvent, version: int = WIRE_VERSION) -> list[bytes]:
+    parts = [HEADER.pack(MAGIC, version, MessageKind.STATUS)]
+    _pack(event, parts)
+    return [b"".join(parts)]
+
+
+def decode_status(frames: list) -> StatusEvent:
+    event, _ = _unpack(memoryview(frames[0]), HEADER.size)
+    return event
+
+
+# tags of the generic encoding: a tag byte followed by the value
+_NONE, _FALSE, _TRUE, _INT, _FLOAT, _SHORT_STR, _STR, _LIST, _DICT, _COLOR, _EVENT_TYPE, _KEY = b"NFTidsSlmcek"
+# field names sent as a single index byte
+_KEYS = [
+    "type", "robot", "timestamp", "order_id", "orders", "package", "reason", "packages", "failed",
+    "from_state", "to_state", "event", "color", "aisle",
+    "time_in_state", "dwell", "latency", "lowest", "highest", "sub_buckets", "buckets", "count", "sum",
+]
+_KEY_INDEX = {key: i for i, key in enumerate(_KEYS)}
+_INT64 = struct.Struct("<q")
+_FLOAT64 = struct.Struct("<d")
+_LENGTH = struct.Struct("<I")
+
+
+def _pack(value, parts: list[bytes]):
+    # enum members are checked first since they are also instances of str
+    if isinstance(value, StatusEventType):
+        parts.append(bytes((_EVENT_TYPE, _EVENT_TYPES.index(value))))
+    elif value is None:
+        parts.append(bytes((_NONE,)))
+    elif value is True or value is False:
+        parts.append(bytes((_TRUE if value else _FALSE,)))
+    elif isinstance(value, int):
+        parts.append(bytes((_INT,)) + _INT64.pack(value))
+    elif isinstance(value, float):
+        parts.append(bytes((_FLOAT,)) + _FLOAT64.pack(value))
+    elif isinstance(value, str):
+        if value in _COLOR_INDEX:
+            parts.append(bytes((_COLOR, _COLOR_INDEX[value])))
+        elif value in _KEY_INDEX:
+            parts.append(bytes((_KEY, _KEY_INDEX[value])))
+        else:
+            data = value.encode()
+            if len(data) < 256:
+                parts.append(bytes((_SHORT_STR, len(data))) + data)
+            else:
+                parts.append(bytes((_STR,)) + _LENGTH.pack(len(data)) + data)
+    elif isinstance(value, list):
+        parts.append(bytes((_LIST,)) + _LENGTH.pack(len(value)))
+        for item in value:
+            _pack(item, parts)
+    elif isinstance(value, dict):
+        parts.append(bytes((_DICT,)) + _LENGTH.pack(len(value)))
+        for key, item in value.items():
+            _pack(key, parts)
+            _pack(item, parts)
+    else:
+        raise ValueError(f"cannot encode {type(value).__name__}")
+
+
+def _unpack(data: memoryview, offset: int) -> tuple[object, int]:
+    tag = data[offset]
+    offset += 1
+    if tag == _KEY:
+        return _lookup(_KEYS, data[offset], "key"), offset + 1
+    if tag == _SHORT_STR:
+        length = data[offset]
+        offset += 1
+        return bytes(data[offset : offset + length]).decode(), offset + length
+    if tag == _STR:
+        (length,) = _LENGTH.unpack_from(data, offset)
+        offset += _LENGTH.size
+        return bytes(data[offset : offset + length]).decode(), offset + length
+    if tag == _COLOR:
+        return _lookup(_COLORS, data[offset], "color"), offset + 1
+    if tag == _INT:
+        return _INT64.unpack_from(data, offset)[0], offset + _INT64.size
+    if tag == _FLOAT:
+        return _FLOAT64.unpack_from(data, offset)[0], offset + _FLOAT64.size
+    if tag == _LIST or tag == _DICT:
+        (length,) = _LENGTH.unpack_from(data, offset)
+        offset += _LENGTH.size
+        items = []
+        for _ in range(length * (2 if tag == _DICT else 1)):
+            item, offset = _unpack(data, offset)
+            items.append(item)
+        if tag == _LIST:
+            return items, offset
+        return dict(zip(items[::2], items[1::2])), offset
+    if tag == _EVENT_TYPE:
+        return _lookup(_EVENT_TYPES, data[offset], "event type").value, offset + 1
+    if tag == _NONE:
+        return None, offset
+    if tag == _TRUE or tag == _FALSE:
+        return tag == _TRUE, offset
+    raise ValueError(f"unknown tag {tag}")
+
+
+def _lookup(table: list, index: int, name: str):
+    if index >= len(table):
+        raise ValueError(f"unknown {name} index {index}")
+    return table[index]
+
+
+_ENCODERS = {
+    MessageKind.ORDER: encode_order,
+    MessageKind.COMMAND: encode_command,
+    MessageKind.STATUS: encode_status,
+}
+_DECODERS = {
+    MessageKind.ORDER: decode_order,
+    MessageKind.COMMAND: decode_command,
+    MessageKind.STATUS: decode_status,
+}
+
+
+def encode(
+    message: dict, kind: MessageKind, wire_format: WireFormat = WireFormat.BINARY, version: int = WIRE_VERSION
+) -> list[bytes]:
+    """Frames of a message in the given format, falling back to JSON if it cannot be encoded in binary, e.g.
+    an integer that does not fit the binary format's 64 bits
+
+    :param version: wire version of the binary format, the one negotiated with the receiver (see peer_version)
+    """
+    if wire_format == WireFormat.BINARY:
+        try:
+            return _ENCODERS[kind](message, version)
+        except (ValueError, struct.error):
+            pass
+    return [json.dumps(message).encode()]
+
+
+def decode(frames: list) -> object:
+    """Decode a message received as a list of frames (bytes or zmq.Frame), whichever format it is in
+
+    :raises ValueError: if the message is malformed or uses an unsupported wire version
+    """
+    first = memoryview(frames[0])
+    if not first or first[0] != MAGIC:
+        return json.loads(bytes(first))
+    try:
+        _, version, kind = HEADER.unpack_from(first)
+        if not 1 <= version <= WIRE_VERSION:
+            raise ValueError(f"unsupported wire version {version}")
+        return _DECODERS[MessageKind(kind)](frames)
+    except (struct.error, IndexError, KeyError, UnicodeDecodeError) as e:
+        raise ValueError(f"malformed message: {e}") from None
+
+
+def is_binary(frame) -> bool:
+    """Whether a frame is the first of a binary message (or a HELLO)"""
+    data = memoryview(frame)
+    return len(data) > 0 and data[0] == MAGIC
+
+
+def peer_version(frame) -> int:
+    """Wire version to use with a peer, given a binary message or HELLO it sent: the lower of its and ours
+
+    :raises ValueError: if the frame carries no valid wire version
+    """
+    data = memoryview(frame)
+    if len(data) < 2 or data[1] < 1:
+        raise ValueError("no valid wire version")
+    return min(data[1], WIRE_VERSION)